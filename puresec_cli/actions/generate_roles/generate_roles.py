@@ -65,6 +65,19 @@ class GenerateRoles(Base):
         parser.add_argument('--no-remove-obsolete', action='store_true',
                             help="Don't remove obsolete roles that are no longer needed.")
 
+        parser.add_argument('--jobs', '-j', type=int, default=1,
+                            help="Number of functions to analyze in parallel (default: 1). Requires --no-input, as parallel functions can't prompt for input.")
+
+        parser.add_argument('--no-cache', action='store_true',
+                            help="Don't use or update the caches of previous runs (code analysis, dependency lists and cloud inventory, under ~/.puresec/cache).")
+        parser.add_argument('--refresh-inventory', action='store_true',
+                            help="Fetch the cloud inventory (e.g existing tables and buckets) again instead of using the cached one.")
+        parser.add_argument('--inventory-ttl', type=int, default=60 * 60,
+                            help="Seconds to reuse the cached cloud inventory of previous runs (default: 3600, 0 to disable).")
+
+        parser.add_argument('--scan-budget', type=float, default=10,
+                            help="Seconds to spend finding the service calls of each file (default: 10, 0 for no limit). Files taking longer fall back to '*' for their services.")
+
         parser.add_argument('--yes', '-y', action='store_true',
                             help="Yes for all - overwrite files, remove old roles, etc.")
 
@@ -92,6 +105,11 @@ class GenerateRoles(Base):
             no_reference=self.args.no_reference,
             remove_obsolete=self.args.remove_obsolete,
             no_remove_obsolete=self.args.no_remove_obsolete,
+            jobs=self.args.jobs,
+            no_cache=self.args.no_cache,
+            refresh_inventory=self.args.refresh_inventory,
+            inventory_ttl=self.args.inventory_ttl,
+            scan_budget=self.args.scan_budget,
             yes=self.args.yes,
             no_input=self.args.no_input,
         )
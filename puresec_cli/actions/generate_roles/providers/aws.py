@@ -1,6 +1,7 @@
 from functools import partial
 from importlib import import_module
 import json
+import multiprocessing
 import os
 import re
 import yaml
@@ -11,6 +12,7 @@ from puresec_cli.actions.generate_roles.providers.aws_api import AwsApi
 from puresec_cli.actions.generate_roles.runtimes import aws as runtimes
 from puresec_cli.providers.aws import Aws
 from puresec_cli.utils import eprint, camelcase
+from puresec_cli import stats
 
 class AwsProvider(AwsApi, Aws, Base):
     def __init__(self, path, config, resource_template=None, runtime=None, handler=None, function_name=None, framework=None, function=None, args=None):
@@ -248,16 +250,19 @@ class AwsProvider(AwsApi, Aws, Base):
         >>> handler.process()
         >>> list(handler._function_permissions.keys())
         ['functionOne']
+
+        >>> from puresec_cli.providers.aws import CloudFormationIndex
+        >>> CloudFormationIndex.INDEXES.clear()
         """
         self._function_real_names = {}
         self._function_permissions = {}
 
         if self.cloudformation_template:
-            resources = self.cloudformation_template.get('Resources', {})
+            function_resources = self.cloudformation_index.get_resources('AWS::Lambda::Function')
         else:
             function_name = self.function_name or 'Unnamed'
-            resources = {
-                '{}Function'.format(camelcase(function_name)): {
+            function_resources = [(
+                '{}Function'.format(camelcase(function_name)), {
                     'Type': 'AWS::Lambda::Function',
                     'Properties': {
                         'FunctionName': function_name,
@@ -265,47 +270,174 @@ class AwsProvider(AwsApi, Aws, Base):
                         'Handler': self.handler,
                     }
                 }
-            }
+            )]
+
+        functions = [] # [(name, resource_id, resource_config, runtime)]
+        for resource_id, resource_config in function_resources:
+            # Getting name
+            name = resource_config.get('Properties', {}).get('FunctionName')
+            if not name:
+                eprint("error: lambda name not specified at `{}`", resource_id)
+                raise SystemExit(2)
+            if self.framework:
+                name = self.framework.get_function_name(name)
+
+            if self.function and self.function != name:
+                continue
+
+            root = os.path.join(self.path, self._get_function_root(name))
+            # Getting runtime
+            runtime = resource_config.get('Properties', {}).get('Runtime')
+            if not runtime:
+                eprint("error: lambda runtime not specified for `{}`", name)
+                raise SystemExit(2)
+
+            runtime = re.sub(r"[\d\.]+$", '', runtime) # ignoring runtime version (e.g nodejs4.3)
+
+            if runtime not in runtimes.__all__:
+                eprint("warn: lambda runtime not yet supported: `{}` (for `{}`)", runtime, name)
+                continue
+
+            runtime = import_module("puresec_cli.actions.generate_roles.runtimes.aws.{}".format(runtime)).Runtime(
+                root,
+                resource_properties=resource_config['Properties'],
+                provider=weakref.proxy(self),
+            )
+            functions.append((name, resource_id, resource_config, runtime))
+
+        function_runtimes = [runtime for _, _, _, runtime in functions]
+        for runtime_class in sorted(set(type(runtime) for runtime in function_runtimes), key=lambda runtime_class: runtime_class.__name__):
+            runtime_class.prepare([runtime for runtime in function_runtimes if type(runtime) is runtime_class])
+
+        all_permissions = self._process_runtimes(function_runtimes)
+
+        # merging in a fixed order, regardless of how runtimes were processed
+        for (name, resource_id, resource_config, runtime), permissions in zip(functions, all_permissions):
+            self._function_permissions[name] = permissions
+            self._process_configurations(name, resource_id, resource_config)
+
+    def _process_runtimes(self, runtimes):
+        """ Processes runtimes sequentially or, with --jobs, in a pool of forked processes.
+
+        Returns the permissions of each runtime, in the same order.
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+        >>> mock.mock(None, 'eprint')
+
+        >>> with mock.open("path/to/cloudformation.json", 'w') as f:
+        ...     f.write('{}') and None
+        >>> class Args:
+        ...     pass
+        >>> args = Args()
+        >>> args.jobs = 1
+        >>> args.no_input = True
+        >>> provider = AwsProvider("path/to/project", config={}, resource_template="path/to/cloudformation.json", args=args)
+
+        >>> class Runtime:
+        ...     def __init__(self, name):
+        ...         self.name = name
+        ...     def process(self):
+        ...         if self.name == 'broken':
+        ...             eprint("error: broken function")
+        ...             raise SystemExit(-1)
+        ...         if self.name == 'slow':
+        ...             time.sleep(60)
+        ...         self.permissions = {'arn:aws:s3:::{}'.format(self.name): {'s3:GetObject'}}
+
+        >>> provider._process_runtimes([Runtime('a'), Runtime('b')])
+        [{'arn:aws:s3:::a': {'s3:GetObject'}}, {'arn:aws:s3:::b': {'s3:GetObject'}}]
+
+        >>> mock.mock(AwsProvider, 'default_region', "default_region")
+        >>> mock.mock(AwsProvider, 'default_account', "default_account")
+        >>> args.jobs = 3
+        >>> provider._process_runtimes([Runtime('a'), Runtime('b'), Runtime('c'), Runtime('d')])
+        [{'arn:aws:s3:::a': {'s3:GetObject'}}, {'arn:aws:s3:::b': {'s3:GetObject'}}, {'arn:aws:s3:::c': {'s3:GetObject'}}, {'arn:aws:s3:::d': {'s3:GetObject'}}]
+
+        >>> provider._process_runtimes([Runtime('a'), Runtime('broken')])
+        Traceback (most recent call last):
+        SystemExit: -1
+
+        Not waiting for the rest of the functions after a failure:
+        >>> import time
+        >>> start = time.monotonic()
+        >>> provider._process_runtimes([Runtime('broken'), Runtime('slow')])
+        Traceback (most recent call last):
+        SystemExit: -1
+        >>> time.monotonic() - start < 30
+        True
+
+        Sequentially when functions may prompt for input:
+        >>> args.no_input = False
+        >>> provider._process_runtimes([Runtime('a'), Runtime('b')])
+        [{'arn:aws:s3:::a': {'s3:GetObject'}}, {'arn:aws:s3:::b': {'s3:GetObject'}}]
+        >>> mock.calls_for('eprint')
+        'warn: --jobs requires --no-input, processing functions one by one'
+        """
+
+        jobs = min(getattr(self.args, 'jobs', None) or 1, len(runtimes))
 
-        for resource_id, resource_config in resources.items():
-            if resource_config.get('Type') == 'AWS::Lambda::Function':
-                # Getting name
-                name = resource_config.get('Properties', {}).get('FunctionName')
-                if not name:
-                    eprint("error: lambda name not specified at `{}`", resource_id)
-                    raise SystemExit(2)
-                if self.framework:
-                    name = self.framework.get_function_name(name)
-
-                if self.function and self.function != name:
-                    continue
-
-                root = os.path.join(self.path, self._get_function_root(name))
-                # Getting runtime
-                runtime = resource_config.get('Properties', {}).get('Runtime')
-                if not runtime:
-                    eprint("error: lambda runtime not specified for `{}`", name)
-                    raise SystemExit(2)
-
-                runtime = re.sub(r"[\d\.]+$", '', runtime) # ignoring runtime version (e.g nodejs4.3)
-
-                if runtime not in runtimes.__all__:
-                    eprint("warn: lambda runtime not yet supported: `{}` (for `{}`)", runtime, name)
-                    continue
-
-                runtime = import_module("puresec_cli.actions.generate_roles.runtimes.aws.{}".format(runtime)).Runtime(
-                    root,
-                    resource_properties=resource_config['Properties'],
-                    provider=weakref.proxy(self),
-                )
+        if jobs > 1 and not getattr(self.args, 'no_input', False):
+            # workers don't have STDIN, while runtimes may prompt (e.g for unknown accounts)
+            eprint("warn: --jobs requires --no-input, processing functions one by one")
+            jobs = 1
 
+        if jobs > 1:
+            try:
+                context = multiprocessing.get_context('fork')
+            except ValueError:
+                eprint("warn: --jobs is not supported on this platform, processing functions one by one")
+                jobs = 1
+
+        if jobs <= 1:
+            permissions = []
+            for runtime in runtimes:
                 runtime.process()
-                self._function_permissions[name] = runtime.permissions
-                self._process_configurations(name, resource_id, resource_config)
+                permissions.append(runtime.permissions)
+            return permissions
+
+        # resolving lazy properties once, instead of in every worker
+        self.default_region
+        self.default_account
+
+        global _pool_runtimes
+        _pool_runtimes = runtimes
+        permissions = []
+        try:
+            with context.Pool(jobs, initializer=_init_pool_worker) as pool:
+                # in order, stopping at the first failure (the remaining workers are terminated)
+                for runtime_permissions, eprints, exit_code in pool.imap(_process_pool_runtime, range(len(runtimes)), chunksize=1):
+                    stats.payload.setdefault('eprints', []).extend(eprints)
+                    if exit_code is not None:
+                        raise SystemExit(exit_code)
+                    permissions.append(runtime_permissions)
+        finally:
+            _pool_runtimes = None
+        return permissions
 
     def _process_configurations(self, name, resource_id, resource_config):
         for processor in AwsProvider.CONFIGURATION_PROCESSORS:
             processor(self)(name, resource_id, resource_config)
 
+# Process pool workers (forked, see AwsProvider._process_runtimes)
+
+_pool_runtimes = None
+
+def _init_pool_worker():
+    # clients hold connection pools, which must not be shared with the parent process
+    AwsApi.CLIENTS_CACHE.clear()
+    stats.payload['eprints'] = []
+
+def _process_pool_runtime(index):
+    """ Returns (permissions, eprints, exit code) - SystemExit would otherwise kill the worker and hang the pool. """
+    runtime = _pool_runtimes[index]
+    eprints = stats.payload['eprints']
+    del eprints[:]
+    try:
+        runtime.process()
+    except SystemExit as e:
+        return None, list(eprints), e.code
+    return runtime.permissions, list(eprints), None
+
 Provider = AwsProvider
 
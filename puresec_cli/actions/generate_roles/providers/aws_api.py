@@ -1,9 +1,15 @@
 """ Methods for AWS API. """
 
+from botocore.utils import parse_timestamp
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from puresec_cli.cache import Cache
+from puresec_cli.providers.aws import CloudFormationIndex
 from puresec_cli.utils import eprint
 import boto3
 import botocore
 import re
+import time
 
 class AwsApi:
     CONFIGURATION_PROCESSORS = [
@@ -66,7 +72,6 @@ class AwsApi:
         'GetShardIterator',
         'ListStreams',
     )
-    FUNCTION_ID_PATTERN = r"\b({}|{})\b"
     def _process_stream_configuration(self, name, resource_id, resource_config):
         """
         >>> from tests.utils import normalize_dict
@@ -86,7 +91,7 @@ class AwsApi:
         >>> normalize_dict(provider._function_permissions)
         {'functionName': {'arn:aws:kinesis:us-east-1:1234:stream/SomeStream': {'kinesis:DescribeStream', 'kinesis:GetRecords', 'kinesis:GetShardIterator', 'kinesis:ListStreams'}}}
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
 
         >>> provider.cloudformation_template = {'Resources': {'Mapping': {'Type': 'AWS::Lambda::EventSourceMapping',
         ...                                                               'Properties': {'FunctionName': 'arn:aws:lambda:us-east-1:1234:function:SomeFunction',
@@ -96,7 +101,7 @@ class AwsApi:
         >>> normalize_dict(provider._function_permissions)
         {'functionName': {'arn:aws:kinesis:us-east-1:1234:stream/SomeStream': {'kinesis:DescribeStream', 'kinesis:GetRecords', 'kinesis:GetShardIterator', 'kinesis:ListStreams'}}}
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
 
         >>> provider.cloudformation_template = {'Resources': {'Mapping': {'Type': 'AWS::Lambda::EventSourceMapping',
         ...                                                               'Properties': {'FunctionName': 'AnotherFunction',
@@ -106,7 +111,7 @@ class AwsApi:
         >>> provider._function_permissions
         {}
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
 
         >>> provider.cloudformation_template = {'Resources': {'Mapping': {'Type': 'AWS::Lambda::EventSourceMapping',
         ...                                                               'Properties': {'FunctionName': 'SomeFunction',
@@ -116,7 +121,7 @@ class AwsApi:
         >>> provider._function_permissions
         {}
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
 
         >>> provider.cloudformation_template = {'Resources': {'Mapping': {'Type': 'AWS::DynamoDB::Table'}}}
         >>> provider._function_permissions = {}
@@ -124,54 +129,66 @@ class AwsApi:
         >>> provider._function_permissions
         {}
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
 
         >>> provider.cloudformation_template = None
 
-        >>> mock.mock(provider, 'get_cached_api_result', {'EventSourceMappings': [{'EventSourceArn': 'arn:aws:kinesis:us-east-1:1234:stream/SomeStream'}]})
+        >>> mock.mock(provider, 'get_cached_api_result', {'EventSourceMappings': [
+        ...     {'FunctionArn': 'arn:aws:lambda:us-east-1:1234:function:SomeFunction', 'EventSourceArn': 'arn:aws:kinesis:us-east-1:1234:stream/SomeStream'},
+        ...     {'FunctionArn': 'arn:aws:lambda:us-east-1:1234:function:SomeFunction:live', 'EventSourceArn': 'arn:aws:kinesis:us-east-1:1234:stream/LiveStream'},
+        ...     {'FunctionArn': 'arn:aws:lambda:us-east-1:1234:function:AnotherFunction', 'EventSourceArn': 'arn:aws:kinesis:us-east-1:1234:stream/AnotherStream'},
+        ... ]})
         >>> provider._function_permissions = {}
         >>> provider._process_stream_configuration('functionName', 'SomeFunctionName', {'Properties': {'FunctionName': 'SomeFunction'}})
         >>> normalize_dict(provider._function_permissions)
-        {'functionName': {'arn:aws:kinesis:us-east-1:1234:stream/SomeStream': {'kinesis:DescribeStream', 'kinesis:GetRecords', 'kinesis:GetShardIterator', 'kinesis:ListStreams'}}}
+        {'functionName': {'arn:aws:kinesis:us-east-1:1234:stream/SomeStream': {'kinesis:DescribeStream', 'kinesis:GetRecords', 'kinesis:GetShardIterator', 'kinesis:ListStreams'},
+                          'arn:aws:kinesis:us-east-1:1234:stream/LiveStream': {'kinesis:DescribeStream', 'kinesis:GetRecords', 'kinesis:GetShardIterator', 'kinesis:ListStreams'}}}
+        >>> mock.calls_for('AwsApi.get_cached_api_result')
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
+
+        Listed once for all the functions:
+        >>> provider._process_stream_configuration('anotherFunction', 'AnotherFunctionName', {'Properties': {'FunctionName': 'AnotherFunction'}})
+        >>> sorted(provider._function_permissions['anotherFunction'])
+        ['arn:aws:kinesis:us-east-1:1234:stream/AnotherStream']
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
 
-        >>> mock.mock(provider, 'get_cached_api_result', {'EventSourceMappings': [{'EventSourceArn': 'arn:aws:dynamodb:us-east-1:1234:table/SomeTable'}]})
+        >>> mock.mock(provider, 'get_cached_api_result', {'EventSourceMappings': [
+        ...     {'FunctionArn': 'arn:aws:lambda:us-east-1:1234:function:SomeFunction', 'EventSourceArn': 'arn:aws:dynamodb:us-east-1:1234:table/SomeTable'},
+        ... ]})
         >>> provider._function_permissions = {}
         >>> provider._process_stream_configuration('functionName', 'SomeFunctionName', {'Properties': {'FunctionName': 'SomeFunction'}})
         >>> provider._function_permissions
         {}
         >>> mock.calls_for('AwsApi.get_cached_api_result')
-        'lambda', account='1234', api_kwargs={'FunctionName': 'SomeFunction'}, api_method='list_event_source_mappings', region='us-east-1'
+        'lambda', account='1234', api_method='list_event_source_mappings', region='us-east-1'
+        >>> CloudFormationIndex.INDEXES.clear()
+        >>> AwsApi.EVENT_SOURCE_MAPPINGS.clear()
         """
 
         function_name = resource_config['Properties']['FunctionName']
         # From CloudFormation
-        if self.cloudformation_template:
-            function_id_pattern = re.compile(AwsApi.FUNCTION_ID_PATTERN.format(function_name, resource_id), re.IGNORECASE)
-            for other_resource_id, other_resource_config in self.cloudformation_template.get('Resources', {}).items():
-                if other_resource_config.get('Type') == 'AWS::Lambda::EventSourceMapping':
-                    # either ARN, function name, or broken intrinsic function
-                    target = other_resource_config.get('Properties', {}).get('FunctionName')
-                    if target and function_id_pattern.search(target):
-                        arn = other_resource_config['Properties'].get('EventSourceArn')
-                        if not arn:
-                            eprint("warn: event source mapping for `{}` missing `EventSourceArn`", name)
-                            continue
-
-                        service_match = AwsApi.STREAM_ARN_SERVICE_PATTERN.match(arn)
-                        if not service_match:
-                            continue
-                        service = service_match.group(1)
-
-                        self._function_permissions. \
-                            setdefault(name, {}).   \
-                            setdefault(arn, set()). \
-                            update("{}:{}".format(service, action) for action in AwsApi.STREAM_ACTIONS)
+        cloudformation_index = CloudFormationIndex.get(self.cloudformation_template)
+        if cloudformation_index:
+            for other_resource_id, other_resource_config in cloudformation_index.get_event_source_mappings(function_name, resource_id):
+                arn = other_resource_config['Properties'].get('EventSourceArn')
+                if not arn:
+                    eprint("warn: event source mapping for `{}` missing `EventSourceArn`", name)
+                    continue
+
+                service_match = AwsApi.STREAM_ARN_SERVICE_PATTERN.match(arn)
+                if not service_match:
+                    continue
+                service = service_match.group(1)
+
+                self._function_permissions. \
+                    setdefault(name, {}).   \
+                    setdefault(arn, set()). \
+                    update("{}:{}".format(service, action) for action in AwsApi.STREAM_ACTIONS)
 
         # From production environment
-        event_source_mappings = self.get_cached_api_result('lambda', region=self.default_region, account=self.default_account, api_method='list_event_source_mappings', api_kwargs={'FunctionName': function_name})
-        for event_source_mapping in event_source_mappings['EventSourceMappings']:
+        event_source_mappings = self._get_event_source_mappings(self.default_region, self.default_account).get(function_name, ())
+        for event_source_mapping in event_source_mappings:
             service_match = AwsApi.STREAM_ARN_SERVICE_PATTERN.match(event_source_mapping['EventSourceArn'])
             if not service_match:
                 continue
@@ -182,29 +199,286 @@ class AwsApi:
                 setdefault(event_source_mapping['EventSourceArn'], set()). \
                 update("{}:{}".format(service, action) for action in AwsApi.STREAM_ACTIONS)
 
+    # arn:aws:lambda:us-east-1:<account>:function:(<name>)(:<qualifier>)
+    FUNCTION_ARN_PATTERN = re.compile(r"^arn:[^:]*:lambda:[^:]*:[^:]*:function:(([^:]+)(?::.+)?)$")
+    # { (region, account): (API result, { function ARN, name, or name:qualifier: [event source mapping] }) }
+    EVENT_SOURCE_MAPPINGS = {}
+    def _get_event_source_mappings(self, region, account):
+        """ All the event source mappings of the region, listed once (instead of once per function) and grouped by
+        function. """
+
+        result = self.get_cached_api_result('lambda', region=region, account=account, api_method='list_event_source_mappings')
+        entry = AwsApi.EVENT_SOURCE_MAPPINGS.get((region, account))
+        if entry is None or entry[0] is not result:
+            function_mappings = {}
+            for event_source_mapping in result['EventSourceMappings']:
+                function_arn = event_source_mapping.get('FunctionArn')
+                if not function_arn:
+                    continue
+                function_ids = {function_arn}
+                function_match = AwsApi.FUNCTION_ARN_PATTERN.match(function_arn)
+                if function_match:
+                    function_ids.update(function_match.groups())
+                for function_id in function_ids:
+                    function_mappings.setdefault(function_id, []).append(event_source_mapping)
+            entry = AwsApi.EVENT_SOURCE_MAPPINGS[(region, account)] = (result, function_mappings)
+        return entry[1]
+
     # Utilities
 
-    # { (client, api_method, api_kwargs): { resource: resource_pattern } } }
+    # { (service, region, account, api_method, api_kwargs): result }
     RESOURCE_CACHE = {}
     def get_cached_api_result(self, service, region, account, api_method, api_kwargs={}):
-        client = self.get_client(service, region, account)
-        if client is None:
-            eprint("error: cannot create {} client for region: '{}', account: '{}'", service, region, account)
-            return
+        """
+        >>> from tempfile import TemporaryDirectory
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+        >>> directory = TemporaryDirectory()
+        >>> mock.mock(Cache, 'DIRECTORY', directory.name)
+
+        >>> class Client:
+        ...     def can_paginate(self, api_method):
+        ...         return False
+        ...     def list_tables(self):
+        ...         return {'TableNames': ["table-1"], 'ResponseMetadata': {'RequestId': "id"}}
+        >>> provider = AwsApi()
+        >>> mock.mock(provider, 'get_client', Client())
+
+        >>> class Args:
+        ...     pass
+        >>> provider.args = Args()
+        >>> provider.args.no_cache = False
+        >>> provider.args.refresh_inventory = False
+        >>> provider.args.inventory_ttl = 60
+
+        >>> provider.get_cached_api_result('dynamodb', 'us-east-1', '1234', 'list_tables')
+        {'TableNames': ['table-1'], 'ResponseMetadata': {'RequestId': 'id'}}
+        >>> mock.calls_for('AwsApi.get_client')
+        'dynamodb', 'us-east-1', '1234'
+
+        Persistent between runs:
+        >>> AwsApi.RESOURCE_CACHE.clear()
+        >>> provider.get_cached_api_result('dynamodb', 'us-east-1', '1234', 'list_tables')
+        {'TableNames': ['table-1']}
+        >>> 'AwsApi.get_client' in mock.calls
+        False
+
+        Expired:
+        >>> AwsApi.RESOURCE_CACHE.clear()
+        >>> provider.args.inventory_ttl = -1
+        >>> provider.get_cached_api_result('dynamodb', 'us-east-1', '1234', 'list_tables')
+        {'TableNames': ['table-1'], 'ResponseMetadata': {'RequestId': 'id'}}
+        >>> mock.calls_for('AwsApi.get_client')
+        'dynamodb', 'us-east-1', '1234'
+        >>> provider.args.inventory_ttl = 60
+
+        >>> AwsApi.RESOURCE_CACHE.clear()
+        >>> provider.args.refresh_inventory = True
+        >>> provider.get_cached_api_result('dynamodb', 'us-east-1', '1234', 'list_tables')
+        {'TableNames': ['table-1'], 'ResponseMetadata': {'RequestId': 'id'}}
+        >>> mock.calls_for('AwsApi.get_client')
+        'dynamodb', 'us-east-1', '1234'
+
+        >>> AwsApi.RESOURCE_CACHE.clear()
+        >>> directory.cleanup()
+        """
+
+        result = self._get_cached_api_result(service, region, account, api_method, api_kwargs)
+
+        if result is None:
+            client = self.get_client(service, region, account)
+            if client is None:
+                eprint("error: cannot create {} client for region: '{}', account: '{}'", service, region, account)
+                return
+
+            result = self._call_api(client, service, region, account, api_method, api_kwargs)
+
+        return result
+
+    def _call_api(self, client, service, region, account, api_method, api_kwargs):
+        """
+        >>> class Paginator:
+        ...     def paginate(self, **kwargs):
+        ...         return self
+        ...     def build_full_result(self):
+        ...         return {'EventSourceMappings': [{'UUID': "1"}, {'UUID': "2"}]}
+        >>> class Client:
+        ...     def can_paginate(self, api_method):
+        ...         return api_method == 'list_event_source_mappings'
+        ...     def get_paginator(self, api_method):
+        ...         return Paginator()
+        >>> provider = AwsApi()
+        >>> provider.args = None
+        >>> provider._call_api(Client(), 'lambda', 'us-east-1', '1234', 'list_event_source_mappings', {})
+        {'EventSourceMappings': [{'UUID': '1'}, {'UUID': '2'}]}
+        >>> AwsApi.RESOURCE_CACHE.clear()
+        """
+
+        try:
+            if client.can_paginate(api_method):
+                # all the pages at once, e.g more than 100 event source mappings
+                result = client.get_paginator(api_method).paginate(**api_kwargs).build_full_result()
+            else:
+                result = getattr(client, api_method)(**api_kwargs)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            eprint("error: failed to list resources on {}:\n{}", service, e)
+            raise SystemExit(-1)
+
+        AwsApi.RESOURCE_CACHE[AwsApi._get_resource_cache_key(service, region, account, api_method, api_kwargs)] = result
+        inventory_key = AwsApi._get_inventory_key(service, region, account, api_method, api_kwargs)
+        if inventory_key:
+            self._set_inventory(inventory_key, result)
+        return result
 
-        cache_key = (client, api_method, frozenset(api_kwargs.items()))
+    def _get_cached_api_result(self, service, region, account, api_method, api_kwargs):
+        """ Result from this run or from previous ones, None if not cached. """
 
+        cache_key = AwsApi._get_resource_cache_key(service, region, account, api_method, api_kwargs)
         result = AwsApi.RESOURCE_CACHE.get(cache_key)
 
         if result is None:
-            try:
-                result = AwsApi.RESOURCE_CACHE[cache_key] = getattr(client, api_method)(**api_kwargs)
-            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
-                eprint("error: failed to list resources on {}:\n{}", service, e)
-                raise SystemExit(-1)
+            inventory_key = AwsApi._get_inventory_key(service, region, account, api_method, api_kwargs)
+            if inventory_key:
+                result = self._get_inventory(inventory_key)
+                if result is not None:
+                    AwsApi.RESOURCE_CACHE[cache_key] = result
 
         return result
 
+    @staticmethod
+    def _get_resource_cache_key(service, region, account, api_method, api_kwargs):
+        # not keyed by client, so that results survive clearing CLIENTS_CACHE (e.g in forked workers)
+        return (service, region, account, api_method, frozenset(api_kwargs.items()))
+
+    PREFETCH_THREADS = 8
+    def prefetch_api_results(self, calls):
+        """ Fills the cache of get_cached_api_result for all the given calls at once, so that latencies overlap.
+
+        calls = [(service, region, account, api_method, api_kwargs)]
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> class Client:
+        ...     def __init__(self, region):
+        ...         self.region = region
+        ...     def can_paginate(self, api_method):
+        ...         return False
+        ...     def list_tables(self):
+        ...         return {'TableNames': ["table-{}".format(self.region)]}
+        >>> provider = AwsApi()
+        >>> provider.args = None
+        >>> mock.mock(provider, 'get_client', lambda service, region, account: Client(region))
+
+        >>> AwsApi.RESOURCE_CACHE[('dynamodb', 'cached-region', '1234', 'list_tables', frozenset())] = {'TableNames': ["cached"]}
+        >>> provider.prefetch_api_results([
+        ...     ('dynamodb', 'us-east-1', '1234', 'list_tables', {}),
+        ...     ('dynamodb', 'us-west-1', '1234', 'list_tables', {}),
+        ...     ('dynamodb', 'us-east-1', '1234', 'list_tables', {}),
+        ...     ('dynamodb', 'cached-region', '1234', 'list_tables', {}),
+        ... ])
+        >>> mock.calls_for('AwsApi.get_client')
+        'dynamodb', 'us-east-1', '1234'
+        'dynamodb', 'us-west-1', '1234'
+        >>> provider.get_cached_api_result('dynamodb', 'us-west-1', '1234', 'list_tables')
+        {'TableNames': ['table-us-west-1']}
+        >>> 'AwsApi.get_client' in mock.calls
+        False
+
+        >>> AwsApi.RESOURCE_CACHE.clear()
+        """
+
+        pending = []
+        for call in calls:
+            if call in pending:
+                continue
+            if self._get_cached_api_result(*call) is None:
+                pending.append(call)
+        if not pending:
+            return
+
+        # clients are created (and may prompt for input) one by one, only the API calls are concurrent
+        clients = {}
+        for service, region, account, _, _ in pending:
+            if (service, region, account) not in clients:
+                clients[(service, region, account)] = self.get_client(service, region, account)
+
+        with ThreadPoolExecutor(max_workers=min(AwsApi.PREFETCH_THREADS, len(pending))) as executor:
+            futures = [
+                executor.submit(self._call_api, clients[(service, region, account)], service, region, account, api_method, api_kwargs)
+                for service, region, account, api_method, api_kwargs in pending
+                # errors are reported by get_cached_api_result later on
+                if clients[(service, region, account)] is not None
+            ]
+        for future in futures:
+            future.result() # raising errors (e.g SystemExit)
+
+    @property
+    def inventory_cache(self):
+        """ AWS API results shared between runs (for --inventory-ttl), None if disabled. """
+
+        if not hasattr(self, '_inventory_cache'):
+            if getattr(self, 'args', None) is None or self.args.no_cache or not self.args.inventory_ttl:
+                self._inventory_cache = None
+            else:
+                self._inventory_cache = Cache('inventory')
+        return self._inventory_cache
+
+    @staticmethod
+    def _get_inventory_key(service, region, account, api_method, api_kwargs):
+        if region == '*' or account == '*':
+            # depends on the default session, which may change between runs
+            return None
+        return Cache.key('inventory', account, region, service, api_method, sorted(api_kwargs.items()))
+
+    def _get_inventory(self, key):
+        if self.inventory_cache is None or self.args.refresh_inventory:
+            return None
+        entry = self.inventory_cache.get(key)
+        if entry is None or time.time() - entry['time'] > self.args.inventory_ttl:
+            return None
+        return AwsApi._decode_inventory(entry['result'])
+
+    def _set_inventory(self, key, result):
+        if self.inventory_cache is None:
+            return
+        self.inventory_cache.set(key, {'time': time.time(), 'result': AwsApi._encode_inventory(result)})
+
+    @staticmethod
+    def _encode_inventory(value):
+        """ JSON-serializable API result.
+
+        >>> from dateutil.tz import tzutc
+        >>> encoded = AwsApi._encode_inventory({'stateMachines': [{'name': "machine", 'creationDate': datetime(2017, 1, 2, tzinfo=tzutc())}],
+        ...                                     'ResponseMetadata': {'RequestId': "id"}})
+        >>> encoded
+        {'stateMachines': [{'name': 'machine', 'creationDate': {'__datetime__': '2017-01-02T00:00:00+00:00'}}]}
+        >>> AwsApi._decode_inventory(encoded)['stateMachines'][0]['creationDate'] == datetime(2017, 1, 2, tzinfo=tzutc())
+        True
+        """
+
+        if isinstance(value, dict):
+            return dict(
+                (key, AwsApi._encode_inventory(inner_value))
+                for key, inner_value in value.items()
+                if key != 'ResponseMetadata'
+            )
+        elif isinstance(value, (list, tuple)):
+            return [AwsApi._encode_inventory(inner_value) for inner_value in value]
+        elif isinstance(value, datetime):
+            return {'__datetime__': value.isoformat()}
+        return value
+
+    @staticmethod
+    def _decode_inventory(value):
+        if isinstance(value, dict):
+            if '__datetime__' in value:
+                return parse_timestamp(value['__datetime__'])
+            return dict((key, AwsApi._decode_inventory(inner_value)) for key, inner_value in value.items())
+        elif isinstance(value, list):
+            return [AwsApi._decode_inventory(inner_value) for inner_value in value]
+        return value
+
     # { (service, region, account): client }
     CLIENTS_CACHE = {}
     def get_client(self, service, region, account):
@@ -1,3 +1,4 @@
+from puresec_cli.cache import Cache
 from puresec_cli.utils import eprint
 from puresec_cli import stats
 import abc
@@ -36,6 +37,33 @@ class Base:
     def result(self):
         pass
 
+    @property
+    def analysis_cache(self):
+        """ Per-file analysis results shared between runs, None if disabled.
+
+        >>> class Provider(Base):
+        ...     pass
+        >>> class Args:
+        ...     pass
+        >>> args = Args()
+
+        >>> Provider("path/to/project", config={}).analysis_cache
+
+        >>> args.no_cache = True
+        >>> Provider("path/to/project", config={}, args=args).analysis_cache
+
+        >>> args.no_cache = False
+        >>> Provider("path/to/project", config={}, args=args).analysis_cache
+        <puresec_cli.cache.Cache object at ...>
+        """
+
+        if not hasattr(self, '_analysis_cache'):
+            if self.args is None or self.args.no_cache:
+                self._analysis_cache = None
+            else:
+                self._analysis_cache = Cache('analysis')
+        return self._analysis_cache
+
     def _get_function_root(self, name):
         """
         >>> from tests.mock import Mock
@@ -3,12 +3,18 @@ from copy import deepcopy
 from functools import reduce
 from puresec_cli.actions.generate_roles.runtimes.base import Base as RuntimeBase
 from puresec_cli.actions.generate_roles.runtimes.aws.base_api import BaseApi
+from puresec_cli.actions.generate_roles.runtimes.file_index import ExcludedPackages, FileIndex
+from puresec_cli.cache import Cache
+from puresec_cli.matchers import KeywordMatcher
 from puresec_cli.utils import deepmerge, eprint
+from hashlib import sha256
 import abc
 import boto3
 import botocore
 import fnmatch
+import os
 import re
+import time
 
 class Base(RuntimeBase, BaseApi):
     __metaclass__ = abc.ABCMeta
@@ -22,6 +28,19 @@ class Base(RuntimeBase, BaseApi):
         # { service: { region: { account: { resource: {action} } } } }
         self._permissions = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(set))))
 
+        # [(filename, contents or None if too large)]
+        self._scanned_files = []
+        # { filename: { key: result } }, of the current chunk for large files (see _walk_scanned)
+        self._file_index = defaultdict(dict)
+        # { filename: time.monotonic() deadline }, of the whole file even when scanned in chunks
+        self._scan_deadlines = {}
+        # per-file results persisted between runs, None if disabled
+        self.analysis_cache = getattr(provider, 'analysis_cache', None)
+        # [filename] of the handler's dependencies, listed by prepare()
+        self._resolved_dependencies = None
+        # seconds for finding the service calls of each file, None or 0 for no limit
+        self.scan_budget = getattr(getattr(provider, 'args', None), 'scan_budget', None)
+
     @property
     def permissions(self):
         """
@@ -53,8 +72,11 @@ class Base(RuntimeBase, BaseApi):
     # Processing (override these)
 
     def process(self):
+        self._scan()
+
         self._process_services()
         self._process_regions()
+        self._prefetch_inventory()
         self._process_resources()
         self._process_actions()
 
@@ -65,13 +87,15 @@ class Base(RuntimeBase, BaseApi):
         pass
 
     try:
-        REGION_PATTERNS = dict(
-                (region, re.compile(r"\b{}\b".format(re.escape(region))))
-                for region in boto3.Session().get_available_regions('ec2')
-                )
+        REGIONS = frozenset(boto3.Session().get_available_regions('ec2'))
     except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
         eprint("error: failed to create aws session:\n{}", e)
         raise SystemExit(-1)
+    # all regions in one pass, same as searching r"\bREGION\b" for each
+    REGION_MATCHER = KeywordMatcher(sorted(REGIONS), word_boundary=True)
+    # any region at the start of a value in one match, same as matching r"\bREGION\b" for each
+    REGION_PREFIX_PATTERN = re.compile(r"(?:{})\b".format('|'.join(re.escape(region) for region in sorted(REGIONS))))
+
     # regions = set()
     def _get_regions(self, filename, contents, regions, service, account):
         """
@@ -86,18 +110,119 @@ class Base(RuntimeBase, BaseApi):
         """
 
         # From file
-        regions.update(
-            region for region, pattern in Base.REGION_PATTERNS.items()
-            if pattern.search(contents)
-        )
+        regions.update(self._get_cached(filename, contents, 'regions', lambda: sorted(Base.REGION_MATCHER.find_all(contents))))
         # From environment
         if not hasattr(self, '_environment_regions'):
-            self._environment_regions = set(
-                region for region, pattern in Base.REGION_PATTERNS.items()
-                if any(pattern.search(value) for value in self.environment_variables.values() if isinstance(value, str))
-            )
+            self._environment_regions = set()
+            for value in self.environment_variables.values():
+                if isinstance(value, str):
+                    self._environment_regions.update(Base.REGION_MATCHER.find_all(value))
         regions.update(self._environment_regions)
 
+    def _is_region(self, value):
+        """ Whether value starts with a region, as matching r"\bREGION\b" against it for each region.
+
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=object())
+
+        >>> runtime._is_region('us-east-1')
+        True
+        >>> runtime._is_region('us-east-1-something')
+        True
+        >>> runtime._is_region('us-east-12')
+        False
+        >>> runtime._is_region('localhost')
+        False
+        >>> runtime._is_region('prefix-us-east-1')
+        False
+        >>> runtime._is_region('us-east-1_x')
+        False
+        """
+
+        return value in Base.REGIONS or Base.REGION_PREFIX_PATTERN.match(value) is not None
+
+    def _get_variable_from_value(self, value):
+        """ Value of an argument from a call index of the runtime (region of get_call_index).
+
+        Returns the same as _get_variable_from_arguments of the runtimes:
+            1. str value if found
+            2. None if argument doesn't exist
+            3. '' if can't process argument value
+
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={'Environment': {'Variables': {'var': "us-west-2"}}}, provider=object())
+        >>> [runtime._get_variable_from_value(value) for value in (None, ['string', 'us-east-1'], ['environ', 'var'], ['environ', 'var2'], ['unknown'])]
+        [None, 'us-east-1', 'us-west-2', '', '']
+        """
+
+        if value is None:
+            return None
+        if value[0] == 'string':
+            return value[1]
+        if value[0] == 'environ':
+            return self.environment_variables.get(value[1], '')
+        return ''
+
+    def _get_scan_deadline(self, filename):
+        """ time.monotonic() value for scanning filename within the budget, None if unlimited.
+
+        Set when the file is first scanned, and shared by all the passes over it (e.g parsing, then regular expressions),
+        and by all the chunks of a large file.
+
+        >>> class Args:
+        ...     scan_budget = 10
+        >>> class Provider:
+        ...     args = Args()
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=Provider())
+
+        >>> deadline = runtime._get_scan_deadline('path/to/function/bundle.js')
+        >>> 0 < deadline - time.monotonic() <= 10
+        True
+        >>> runtime._file_index.clear() # next chunk
+        >>> runtime._get_scan_deadline('path/to/function/bundle.js') == deadline
+        True
+        """
+
+        if not self.scan_budget:
+            return None
+        if filename not in self._scan_deadlines:
+            self._scan_deadlines[filename] = time.monotonic() + self.scan_budget
+        return self._scan_deadlines[filename]
+
+    def _set_any_services(self, filename, contents, service_call_matchers):
+        """ For files not scanned within the budget - any region and account of the services they might call.
+
+        >>> from pprint import pprint
+        >>> from tests.utils import normalize_dict
+        >>> from tests.mock import Mock
+        >>> from puresec_cli.matchers import CallMatcher
+        >>> mock = Mock(__name__)
+        >>> mock.mock(None, 'eprint')
+
+        >>> class Args:
+        ...     scan_budget = 10
+        >>> class Provider:
+        ...     args = Args()
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=Provider())
+
+        >>> runtime._set_any_services('path/to/function/bundle.js', "x.S3 y.SNS", [('s3', CallMatcher(["S3"])), ('kms', CallMatcher(["KMS"]))])
+        >>> pprint(normalize_dict(runtime._permissions))
+        {'s3': {'*': {'*': {}}}}
+        >>> mock.calls_for('eprint')
+        "warn: scan budget of {} seconds exceeded (in {}), falling back to '*'", 10, 'path/to/function/bundle.js'
+        """
+
+        eprint("warn: scan budget of {} seconds exceeded (in {}), falling back to '*'", self.scan_budget, filename)
+        for service, matcher in service_call_matchers:
+            if matcher.literal in contents:
+                self._permissions[service]['*']['*'] # accessing to initialize defaultdict
+
     # resources = defaultdict(set)
     @abc.abstractmethod
     def _get_resources(self, filename, contents, resources, region, account, service):
@@ -108,10 +233,337 @@ class Base(RuntimeBase, BaseApi):
     def _get_actions(self, filename, contents, actions, service):
         pass
 
+    # Scanning
+
+    def _scan(self):
+        """ Reads every file of the function once, all stages then run against this in-memory pass.
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=object())
+
+        >>> def walk(self, processor):
+        ...     processor('path/to/function/a', "a content")
+        ...     processor('path/to/function/b', "b content")
+        >>> mock.mock(Base, '_walk', walk)
+
+        >>> runtime._scan()
+        >>> processed = []
+        >>> runtime._walk_scanned(lambda filename, contents, custom: processed.append((filename, contents, custom)), 'custom')
+        >>> runtime._walk_scanned(lambda filename, contents, custom: processed.append((filename, contents, custom)), custom='again')
+        >>> processed
+        [('path/to/function/a', 'a content', 'custom'),
+         ('path/to/function/b', 'b content', 'custom'),
+         ('path/to/function/a', 'a content', 'again'),
+         ('path/to/function/b', 'b content', 'again')]
+        >>> len(mock.calls['Base._walk'])
+        1
+        """
+
+        # contents is None for large files, which are streamed by _walk_scanned instead
+        self._scanned_files = []
+        self._file_index.clear()
+        self._scan_deadlines.clear()
+        self._walk(lambda filename, contents: self._scanned_files.append((filename, contents)))
+
+    # processor: function(filename, contents, *args, **kwargs)
+    def _walk_scanned(self, processor, *args, **kwargs):
+        self._walk_scanned_all([(processor, args, kwargs)])
+
+    # calls: [(processor, args, kwargs)]
+    def _walk_scanned_all(self, calls):
+        """ Runs all the calls over each file, so that large files are read only once for all of them.
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=object())
+        >>> runtime._scanned_files = [('path/to/function/a', "a content"), ('path/to/function/bundle.js', None)]
+        >>> mock.mock(Base, '_read_chunks', lambda self, filename: iter(["first chunk", "second chunk"]))
+
+        >>> processed = []
+        >>> def processor(filename, contents, name):
+        ...     runtime._get_indexed(filename, ('key', name), lambda: processed.append((filename, contents, name)))
+        >>> runtime._walk_scanned_all([(processor, ('first',), {}), (processor, (), {'name': 'second'})])
+        >>> processed
+        [('path/to/function/a', 'a content', 'first'),
+         ('path/to/function/a', 'a content', 'second'),
+         ('path/to/function/bundle.js', 'first chunk', 'first'),
+         ('path/to/function/bundle.js', 'first chunk', 'second'),
+         ('path/to/function/bundle.js', 'second chunk', 'first'),
+         ('path/to/function/bundle.js', 'second chunk', 'second')]
+        >>> mock.calls_for('Base._read_chunks')
+        Runtime, 'path/to/function/bundle.js'
+        """
+
+        for filename, contents in self._scanned_files:
+            if contents is not None:
+                for processor, args, kwargs in calls:
+                    processor(filename, contents, *args, **kwargs)
+                continue
+
+            # too large to keep, reading again chunk by chunk, each indexed on its own
+            for chunk in self._read_chunks(filename):
+                self._file_index.pop(filename, None)
+                for processor, args, kwargs in calls:
+                    processor(filename, chunk, *args, **kwargs)
+            self._file_index.pop(filename, None)
+
+    def _get_indexed(self, filename, key, getter):
+        """ Per-file match index, getter() is only called the first time a key is looked up for a file.
+
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=object())
+
+        >>> runtime._get_indexed('path/to/function/a', 'key', lambda: 'computed')
+        'computed'
+        >>> runtime._get_indexed('path/to/function/a', 'key', lambda: 'computed again')
+        'computed'
+        >>> runtime._get_indexed('path/to/function/b', 'key', lambda: 'computed again')
+        'computed again'
+        """
+
+        index = self._file_index[filename]
+        if key not in index:
+            index[key] = getter()
+        return index[key]
+
+    def _get_cached(self, filename, contents, key, getter):
+        """ Same as _get_indexed, also persisted in the analysis cache by the digest of the contents.
+
+        getter() must return a JSON-serializable value, preferably lists (tuples come back from the cache as lists).
+
+        >>> from tempfile import TemporaryDirectory
+        >>> directory = TemporaryDirectory()
+        >>> original_directory, Cache.DIRECTORY = Cache.DIRECTORY, directory.name
+
+        >>> class Provider:
+        ...     analysis_cache = Cache('analysis')
+        >>> class Runtime(Base):
+        ...     pass
+
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=Provider())
+        >>> runtime._get_cached('path/to/function/a', "contents", 'key', lambda: ['computed'])
+        ['computed']
+        >>> runtime._get_cached('path/to/function/a', "contents", 'key', lambda: ['computed again'])
+        ['computed']
+
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=Provider())
+        >>> runtime._get_cached('path/to/function/b', "contents", 'key', lambda: ['computed again']) # same contents, from previous run
+        ['computed']
+        >>> runtime._get_cached('path/to/function/b', "other contents", 'key', lambda: ['computed again']) # same file, in-memory index
+        ['computed']
+        >>> runtime._get_cached('path/to/function/c', "other contents", 'key', lambda: ['computed again'])
+        ['computed again']
+
+        >>> directory.cleanup()
+        >>> Cache.DIRECTORY = original_directory
+        """
+
+        def getter_or_cached():
+            if self.analysis_cache is None:
+                return getter()
+
+            cache_key = Cache.key(type(self).__name__, self._get_digest(filename, contents), key)
+            result = self.analysis_cache.get(cache_key)
+            if result is None:
+                result = getter()
+                self.analysis_cache.set(cache_key, result)
+            return result
+
+        return self._get_indexed(filename, key, getter_or_cached)
+
+    def _get_digest(self, filename, contents):
+        return self._get_indexed(filename, 'digest', lambda: sha256(contents.encode('utf-8', 'replace')).hexdigest())
+
+    def _decode(self, filename, data):
+        """ Also indexes the digest of the raw bytes, instead of encoding the contents back later on.
+
+        >>> from tempfile import TemporaryDirectory
+        >>> directory = TemporaryDirectory()
+        >>> original_directory, Cache.DIRECTORY = Cache.DIRECTORY, directory.name
+
+        >>> class Provider:
+        ...     analysis_cache = Cache('analysis')
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=Provider())
+
+        >>> runtime._decode('path/to/function/a', b"contents")
+        'contents'
+        >>> runtime._get_digest('path/to/function/a', "ignored") == sha256(b"contents").hexdigest()
+        True
+
+        >>> directory.cleanup()
+        >>> Cache.DIRECTORY = original_directory
+        """
+
+        if self.analysis_cache is not None:
+            self._file_index[filename]['digest'] = sha256(data).hexdigest()
+        return super()._decode(filename, data)
+
+    # packages never resolved or scanned (e.g AWS SDKs bundled with the function), in addition to `excluded_packages` of puresec.yml
+    EXCLUDED_PACKAGES = ()
+    # suffix of the name of the directory holding the packages (e.g 'node_modules'), None for any directory
+    EXCLUDED_PACKAGES_PARENT = None
+
+    def _get_file_index(self):
+        """ Without the directories of excluded packages, never walked into. """
+        return FileIndex.get(self.root, self.ignore_rules, ExcludedPackages(self.excluded_packages, parent=type(self).EXCLUDED_PACKAGES_PARENT))
+
+    @property
+    def excluded_packages(self):
+        """
+        >>> class Runtime(Base):
+        ...     EXCLUDED_PACKAGES = ('sdk',)
+        >>> class Provider:
+        ...     config = {}
+
+        >>> Runtime('path/to/function', resource_properties={}, provider=object()).excluded_packages
+        ['sdk']
+        >>> Runtime('path/to/function', resource_properties={}, provider=Provider()).excluded_packages
+        ['sdk']
+        >>> Provider.config = {'excluded_packages': ['numpy', 'pandas', 'sdk']}
+        >>> Runtime('path/to/function', resource_properties={}, provider=Provider()).excluded_packages
+        ['numpy', 'pandas', 'sdk']
+        """
+
+        config = getattr(self.provider, 'config', None) or {}
+        return sorted(set(type(self).EXCLUDED_PACKAGES).union(config.get('excluded_packages') or ()))
+
+    def _get_dependencies(self, filename):
+        """ Dependencies of the handler file: listed by prepare(), kept from a previous run if none of them changed,
+        or listed now with _list_dependencies(filename).
+        """
+
+        if self._resolved_dependencies is not None:
+            return self._resolved_dependencies[:]
+
+        dependencies = self._get_cached_dependencies(filename)
+        if dependencies is None:
+            dependencies = self._list_dependencies(filename)
+            self._set_cached_dependencies(filename, dependencies)
+        return dependencies[:]
+
+    def _get_dependencies_cache_key(self, filename):
+        return Cache.key(type(self).__name__, 'dependencies', filename, self.root, self.resource_properties.get('Runtime'), self.excluded_packages)
+
+    def _get_cached_dependencies(self, filename):
+        """ Dependencies listed by a previous run, None if not cached or if any of the files or their directories changed.
+
+        Files are compared by modification time and size, and by digest when only the modification time changed.
+        Directories are compared by modification time, for new files that may now be imported instead.
+
+        >>> import time
+        >>> from tempfile import TemporaryDirectory
+        >>> directory = TemporaryDirectory()
+        >>> original_directory, Cache.DIRECTORY = Cache.DIRECTORY, directory.name
+        >>> root = os.path.join(directory.name, 'function')
+        >>> os.makedirs(os.path.join(root, 'lib'))
+        >>> def write(path, contents):
+        ...     with open(os.path.join(root, path), 'w') as f:
+        ...         f.write(contents) and None
+        >>> write('index.py', "import lib.a")
+        >>> write('lib/__init__.py', "")
+        >>> write('lib/a.py', "a = 1")
+        >>> dependencies = [os.path.join(root, path) for path in ('index.py', 'lib/__init__.py', 'lib/a.py')]
+
+        >>> class Provider:
+        ...     analysis_cache = Cache('analysis')
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime(root, resource_properties={'Runtime': 'python3.6'}, provider=Provider())
+        >>> handler = dependencies[0]
+
+        >>> runtime._get_cached_dependencies(handler)
+        >>> runtime._set_cached_dependencies(handler, dependencies)
+        >>> runtime._get_cached_dependencies(handler) == dependencies
+        True
+
+        >>> past = time.time() - 60
+        >>> os.utime(os.path.join(root, 'lib/a.py'), (past, past)) # touched
+        >>> runtime._get_cached_dependencies(handler) == dependencies
+        True
+        >>> cached = runtime.analysis_cache.get(runtime._get_dependencies_cache_key(handler))
+        >>> cached['files'][2][1] == os.stat(os.path.join(root, 'lib/a.py')).st_mtime_ns # refreshed
+        True
+        >>> write('lib/a.py', "a = 2") # modified
+        >>> runtime._get_cached_dependencies(handler)
+
+        >>> runtime._set_cached_dependencies(handler, dependencies)
+        >>> os.utime(os.path.join(root, 'lib'), (past, past)) # file added or removed
+        >>> runtime._get_cached_dependencies(handler)
+
+        >>> runtime._set_cached_dependencies(handler, dependencies)
+        >>> os.remove(os.path.join(root, 'lib/a.py'))
+        >>> runtime._get_cached_dependencies(handler)
+
+        >>> directory.cleanup()
+        >>> Cache.DIRECTORY = original_directory
+        """
+
+        if self.analysis_cache is None:
+            return None
+        cached = self.analysis_cache.get(self._get_dependencies_cache_key(filename))
+        if cached is None:
+            return None
+
+        touched = False # only modification times changed, same digests
+        try:
+            for file in cached['files']:
+                path, mtime, size, digest = file
+                stat = self._stat(path)
+                if stat.st_size != size:
+                    return None
+                if stat.st_mtime_ns != mtime:
+                    if self._get_file_digest(path) != digest:
+                        return None
+                    file[1] = stat.st_mtime_ns
+                    touched = True
+            for path, mtime in cached['directories']:
+                if self._stat(path).st_mtime_ns != mtime:
+                    return None
+        except OSError:
+            return None
+        if touched:
+            # not digesting them again next time
+            self.analysis_cache.set(self._get_dependencies_cache_key(filename), cached)
+        return cached['dependencies']
+
+    def _set_cached_dependencies(self, filename, dependencies):
+        if self.analysis_cache is None:
+            return
+
+        directories = set([self.root])
+        directories.update(os.path.dirname(path) for path in dependencies)
+        try:
+            files = [
+                [path, stat.st_mtime_ns, stat.st_size, self._get_file_digest(path)]
+                for path, stat in ((path, self._stat(path)) for path in dependencies)
+            ]
+            directories = [[path, self._stat(path).st_mtime_ns] for path in sorted(directories)]
+        except OSError:
+            return
+        self.analysis_cache.set(self._get_dependencies_cache_key(filename), {
+            'dependencies': dependencies,
+            'files': files,
+            'directories': directories,
+        })
+
+    def _get_file_digest(self, path):
+        with open(path, 'rb') as file:
+            return sha256(file.read()).hexdigest()
+
     # Sub processors
 
     def _process_services(self):
-        self._walk(self._get_services)
+        self._walk_scanned(self._get_services)
         self._normalize_permissions(self._permissions)
 
     def _process_regions(self):
@@ -126,72 +578,174 @@ class Base(RuntimeBase, BaseApi):
         ...     pass
         >>> runtime = Runtime('path/to/function', resource_properties={}, provider=object())
 
-        >>> mock.mock(Base, '_walk', lambda self, processor, possible_regions, service, account: possible_regions.update({'us-east-1', 'us-east-2'}))
+        >>> def walk_scanned_all(self, calls):
+        ...     for processor, (possible_regions,), kwargs in calls:
+        ...         possible_regions.update({'us-east-1', 'us-east-2'})
+        >>> mock.mock(Base, '_walk_scanned_all', walk_scanned_all)
         >>> runtime._permissions = {
         ...     'dynamodb': {'us-west-1': {'111': {'table/a': set(), 'table/b': set()}}},
         ...     'ses': defaultdict(dict, {'*': {'111': {'*': set()}, '222': {'*': set()}}})
         ... }
         >>> runtime._process_regions()
-        >>> mock.calls_for('Base._walk')
-        Runtime, _get_regions, {'us-east-1', 'us-east-2'}, account='111', service='ses'
-        Runtime, _get_regions, {'us-east-1', 'us-east-2'}, account='222', service='ses'
+        >>> len(mock.calls['Base._walk_scanned_all'])
+        1
         >>> pprint(normalize_dict(runtime._permissions))
         {'dynamodb': {'us-west-1': {'111': {'table/a': set(), 'table/b': set()}}},
          'ses': {'us-east-1': {'111': {'*': set()}, '222': {'*': set()}}, 'us-east-2': {'111': {'*': set()}, '222': {'*': set()}}}}
         """
 
+        # [(regions, account, possible regions)]
+        expanded = []
+        calls = []
         for service, regions in self._permissions.items():
             if '*' in regions:
-                for account, resources in sorted(regions['*'].items()):
+                for account in sorted(regions['*']):
                     possible_regions = set()
-                    self._walk(
+                    expanded.append((regions, account, possible_regions))
+                    calls.append((
                         self._get_regions,
                         # custom arguments to processor
-                        possible_regions,
-                        service=service,
-                        account=account
-                    )
-                    # moving the account from '*' to possible regions
-                    if possible_regions:
-                        for region in possible_regions:
-                            regions[region][account] = deepcopy(resources)
-                        del regions['*'][account]
-
+                        (possible_regions,),
+                        {'service': service, 'account': account},
+                    ))
+        if not calls:
+            return
+        self._walk_scanned_all(calls)
+
+        for regions, account, possible_regions in expanded:
+            # moving the account from '*' to possible regions
+            if possible_regions:
+                resources = regions['*'].pop(account)
+                for region in possible_regions:
+                    regions[region][account] = deepcopy(resources)
                 if not regions['*']:
                     # all moved
                     del regions['*']
 
+    def _prefetch_inventory(self):
+        """ Lists all resources needed by _process_resources at once, instead of one blocking call at a time while matching files.
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> class Provider:
+        ...     pass
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('path/to/function', resource_properties={}, provider=Provider())
+        >>> mock.mock(runtime.provider, 'prefetch_api_results')
+
+        >>> runtime._permissions['kms']['us-east-1']['111'] = defaultdict(set)
+        >>> runtime._permissions['kms']['us-west-1']['111'] = defaultdict(set)
+        >>> runtime._permissions['ses']['us-east-1']['111'] = defaultdict(set)
+        >>> runtime._prefetch_inventory() # nothing scanned
+        >>> 'Provider.prefetch_api_results' in mock.calls
+        False
+
+        >>> runtime._scanned_files.append(('path/to/function/index.py', "code"))
+        >>> runtime._prefetch_inventory()
+        >>> mock.calls_for('Provider.prefetch_api_results')
+        [('kms', 'us-east-1', '111', 'list_keys', {}),
+         ('kms', 'us-west-1', '111', 'list_keys', {}),
+         ('kms', 'us-east-1', '111', 'list_aliases', {}),
+         ('kms', 'us-west-1', '111', 'list_aliases', {})]
+
+        Streams of the tables matched within any of the files:
+        >>> runtime.provider.cloudformation_template = None
+        >>> mock.mock(runtime.provider, 'get_cached_api_result', {'TableNames': ["table-1", "table-2", "table-3"]})
+        >>> runtime._permissions.clear()
+        >>> runtime._permissions['dynamodb']['us-east-1']['111'] = defaultdict(set)
+        >>> runtime._scanned_files.append(('path/to/function/other.py', "table-2 and table-1"))
+        >>> runtime._prefetch_inventory()
+        >>> mock.calls_for('Provider.prefetch_api_results')
+        [('dynamodb', 'us-east-1', '111', 'list_tables', {})]
+        [('dynamodbstreams', 'us-east-1', '111', 'list_streams', {'TableName': 'table-1'}),
+         ('dynamodbstreams', 'us-east-1', '111', 'list_streams', {'TableName': 'table-2'})]
+        >>> BaseApi.RESOURCE_TABLES.clear()
+        """
+
+        if not self._scanned_files:
+            return
+
+        calls = []
+        for service, regions in self._permissions.items():
+            for api_service, api_method in Base.SERVICE_INVENTORY_CALLS.get(service, ()):
+                for region, accounts in regions.items():
+                    for account in accounts:
+                        calls.append((api_service, region, account, api_method, {}))
+        if calls:
+            self.provider.prefetch_api_results(calls)
+
+        # then the calls depending on matched resources (e.g streams of tables), all the files at once
+        calls = []
+        processor_calls = []
+        for service, regions in self._permissions.items():
+            processor = Base.SERVICE_DEPENDENT_INVENTORY_CALLS.get(service)
+            if processor is None:
+                continue
+            for region, accounts in regions.items():
+                for account in accounts:
+                    processor_calls.append((
+                        processor(self),
+                        # custom arguments to processor
+                        (calls,),
+                        {'region': region, 'account': account},
+                    ))
+        if processor_calls:
+            self._walk_scanned_all(processor_calls)
+        if calls:
+            self.provider.prefetch_api_results(calls)
+
     def _process_resources(self):
+        calls = []
         for service, regions in self._permissions.items():
             for region, accounts in regions.items():
                 for account, resources in accounts.items():
-                    self._walk(
+                    calls.append((
                         self._get_resources,
                         # custom arguments to processor
-                        resources,
-                        region=region,
-                        account=account,
-                        service=service,
-                    )
-                    self._normalize_resources(resources, (service, region, account))
+                        (resources,),
+                        {'region': region, 'account': account, 'service': service},
+                    ))
+        self._walk_scanned_all(calls)
+
+        for (_, (resources,), kwargs) in calls:
+            self._normalize_resources(resources, (kwargs['service'], kwargs['region'], kwargs['account']))
 
     def _process_actions(self):
-        for service, regions in self._permissions.items():
-            actions = set()
-            self._walk(
-                self._get_actions,
+        # { service: {action} }
+        service_actions = {service: set() for service in self._permissions}
+        self._walk_scanned_all([
+            (
+                self._get_file_actions,
                 # custom arguments to processor
-                actions,
-                service=service,
+                (actions,),
+                {'service': service},
             )
+            for service, actions in service_actions.items()
+        ])
 
+        for service, regions in self._permissions.items():
+            actions = service_actions[service]
             for region, accounts in regions.items():
                 for account, resources in accounts.items():
                     self._match_resources_actions(service, resources, actions)
 
                     self._normalize_actions(resources, (service, region, account))
 
-    # get_all_resources_method: (region, account) => {resource: pattern}
+    def _get_file_actions(self, filename, contents, actions, service):
+        """ Cached _get_actions. """
+
+        def get_actions():
+            file_actions = set()
+            self._get_actions(filename, contents, file_actions, service=service)
+            return sorted(file_actions)
+
+        # actions processors check the file type
+        _, extension = os.path.splitext(filename)
+        actions.update(self._get_cached(filename, contents, ('actions', service, extension.lower()), get_actions))
+
+    # get_all_resources_method: (region, account) => KeywordMatcher of resources
     def _get_generic_resources(self, filename, contents, resources, region, account, resource_format, get_all_resources_method):
         """ Simply greps resources inside the given contents.
 
@@ -226,14 +780,18 @@ class Base(RuntimeBase, BaseApi):
             return
 
         # From file
-        for resource, pattern in all_resources.items():
-            if pattern.search(contents):
-                resources[resource_format.format(resource)]
+        for resource in self._get_cached(filename, contents, ('resources', all_resources.digest), lambda: sorted(all_resources.find_all(contents))):
+            resources[resource_format.format(resource)]
 
         # From environment
-        for resource, pattern in all_resources.items():
-            if any(pattern.search(value) for value in self.environment_variables.values() if isinstance(value, str)):
-                resources[resource_format.format(resource)]
+        environment_resources = set()
+        for value in self.environment_variables.values():
+            if isinstance(value, str):
+                environment_resources.update(all_resources.find_all(value))
+        if environment_resources:
+            for resource in all_resources:
+                if resource in environment_resources:
+                    resources[resource_format.format(resource)]
 
     def _match_resources_actions(self, service, resources, actions):
         """
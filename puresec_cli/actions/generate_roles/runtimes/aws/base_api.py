@@ -2,10 +2,38 @@
 
 from collections import defaultdict
 from functools import partial
+from puresec_cli.matchers import KeywordMatcher
+from puresec_cli.providers.aws import CloudFormationIndex
 from puresec_cli.utils import eprint
 import abc
 import re
 
+def index_action_calls(action_calls):
+    """ { service: ((action, call tokens)) } => { service: { call token: {actions} } }
+
+    >>> from pprint import pprint
+    >>> from tests.utils import normalize_dict
+    >>> pprint(normalize_dict(index_action_calls({'s3': (
+    ...     ('s3:GetObject', ('get_object', "generate_presigned_url('get_object')")),
+    ...     ('s3:GetObject', ('download_file',)),
+    ...     ('s3:PutObject', ('copy',)),
+    ...     ('s3:GetObject', ('copy',)),
+    ... )})))
+    {'s3': {'copy': {'s3:GetObject', 's3:PutObject'},
+            'download_file': {'s3:GetObject'},
+            "generate_presigned_url('get_object')": {'s3:GetObject'},
+            'get_object': {'s3:GetObject'}}}
+    """
+
+    index = {}
+    for service, calls in action_calls.items():
+        service_index = defaultdict(set)
+        for action, tokens in calls:
+            for token in tokens:
+                service_index[token].add(action)
+        index[service] = dict(service_index)
+    return index
+
 class BaseApi:
     __metaclass__ = abc.ABCMeta
 
@@ -26,6 +54,24 @@ class BaseApi:
         'states':   lambda self: self._get_states_resources,
     }
 
+    SERVICE_INVENTORY_CALLS = {
+        # service: ((api service, api method), ...) - calls made by SERVICE_RESOURCES_PROCESSOR regardless of contents
+        'dynamodb': (('dynamodb', 'list_tables'),),
+        'kinesis':  (('kinesis', 'list_streams'),),
+        'kms':      (('kms', 'list_keys'), ('kms', 'list_aliases')),
+        'lambda':   (('lambda', 'list_functions'),),
+        's3':       (('s3', 'list_buckets'),),
+        'sns':      (('sns', 'list_topics'),),
+        'states':   (('stepfunctions', 'list_state_machines'), ('stepfunctions', 'list_activities')),
+    }
+
+    SERVICE_DEPENDENT_INVENTORY_CALLS = {
+        # service: function(self, filename, contents, calls, region, account) - appends the calls made by
+        # SERVICE_RESOURCES_PROCESSOR for the resources matched within contents (e.g streams of the matched tables)
+        'dynamodb': lambda self: self._get_dynamodb_inventory_calls,
+        'states':   lambda self: self._get_states_inventory_calls,
+    }
+
     SERVICE_RESOURCE_ACTION_MATCHERS = {
         # service: (resource_pattern, resource_default, (action, ...))
         'dynamodb': (
@@ -203,10 +249,11 @@ class BaseApi:
         )
     }
 
-    RESOURCE_PATTERN = r"\b{}\b"
+    # { (service, template_type, region, account, api_method, api_attribute, api_inner_attribute, api_kwargs):
+    #   (template, api result, KeywordMatcher) } - shared by all files and functions
+    RESOURCE_TABLES = {}
     def _get_generic_all_resources(self, service, region, account, template_type, api_method, api_attribute, api_inner_attribute=None, resource_converter=None, api_kwargs={}, warn=True):
         """
-        >>> from pprint import pprint
         >>> from tests.mock import Mock
         >>> mock = Mock(__name__)
 
@@ -223,9 +270,8 @@ class BaseApi:
         >>> runtime.provider.cloudformation_template = {'Resources': {'T1': {'Type': 'AWS::DynamoDB::Table', 'Properties': {'TableName': 'table-1'}},
         ...                                                           'T2': {'Type': 'AWS::DynamoDB::Table', 'Properties': {'TableName': 'table-2'}},
         ...                                                           'B1': {'Type': 'AWS::S3::Bucket', 'Properties': {'TableName': 'not-table-2'}}}}
-        >>> pprint(runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames'))
-        {'table-1': re.compile('\\\\btable\\\\-1\\\\b', re.IGNORECASE),
-         'table-2': re.compile('\\\\btable\\\\-2\\\\b', re.IGNORECASE)}
+        >>> list(runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames'))
+        ['table-1', 'table-2']
         >>> mock.calls_for('Provider.get_cached_api_result')
         'dynamodb', account='some-account', api_kwargs={}, api_method='list_tables', region='us-east-1'
 
@@ -233,25 +279,23 @@ class BaseApi:
 
         >>> mock.mock(runtime.provider, 'get_cached_api_result', {'TableNames': ['table-1', 'table-2']})
 
-        >>> pprint(runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames'))
-        {'table-1': re.compile('\\\\btable\\\\-1\\\\b', re.IGNORECASE),
-         'table-2': re.compile('\\\\btable\\\\-2\\\\b', re.IGNORECASE)}
+        >>> list(runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames'))
+        ['table-1', 'table-2']
         >>> mock.calls_for('Provider.get_cached_api_result')
         'dynamodb', account='some-account', api_kwargs={}, api_method='list_tables', region='us-east-1'
 
         >>> mock.mock(runtime.provider, 'get_cached_api_result', {'Buckets': [{'Name': "bucket-1"}, {'Name': "bucket-2"}]})
 
-        >>> pprint(runtime._get_generic_all_resources('s3', 'us-east-1', 'some-account', 'AWS::S3::Bucket', 'list_buckets', 'Buckets', 'Name'))
-        {'bucket-1': re.compile('\\\\bbucket\\\\-1\\\\b', re.IGNORECASE),
-         'bucket-2': re.compile('\\\\bbucket\\\\-2\\\\b', re.IGNORECASE)}
+        >>> list(runtime._get_generic_all_resources('s3', 'us-east-1', 'some-account', 'AWS::S3::Bucket', 'list_buckets', 'Buckets', 'Name'))
+        ['bucket-1', 'bucket-2']
         >>> mock.calls_for('Provider.get_cached_api_result')
         's3', account='some-account', api_kwargs={}, api_method='list_buckets', region='us-east-1'
 
         >>> mock.mock(runtime.provider, 'get_cached_api_result', {'Topics': [{'TopicArn': "arn:aws:sns:us-east-1:123456789012:my_topic"}]})
 
-        >>> pprint(runtime._get_generic_all_resources('sns', 'us-east-1', 'some-account', 'AWS::SNS::Topic', 'list_topics', 'Topics', 'TopicArn',
-        ...                                           resource_converter=lambda topic_arn: BaseApi.ARN_RESOURCE_PATTERN.match(topic_arn).group(1)))
-        {'my_topic': re.compile('\\\\bmy_topic\\\\b', re.IGNORECASE)}
+        >>> list(runtime._get_generic_all_resources('sns', 'us-east-1', 'some-account', 'AWS::SNS::Topic', 'list_topics', 'Topics', 'TopicArn',
+        ...                                     resource_converter=lambda topic_arn: BaseApi.ARN_RESOURCE_PATTERN.match(topic_arn).group(1)))
+        ['my_topic']
         >>> mock.calls_for('Provider.get_cached_api_result')
         'sns', account='some-account', api_kwargs={}, api_method='list_topics', region='us-east-1'
 
@@ -259,35 +303,35 @@ class BaseApi:
 
         >>> mock.mock(runtime.provider, 'get_cached_api_result', {'TableNames': []})
 
-        >>> runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames')
-        {}
+        >>> list(runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames'))
+        []
         >>> mock.calls_for('eprint')
         "warn: no {} resources ({}) on '{}:{}', you're using this service but your AWS account and CloudFormation are empty", 'dynamodb', 'AWS::DynamoDB::Table', 'us-east-1', 'some-account'
         >>> mock.calls_for('Provider.get_cached_api_result')
         'dynamodb', account='some-account', api_kwargs={}, api_method='list_tables', region='us-east-1'
-        """
 
-        resources = {}
-
-        if self.provider.cloudformation_template and template_type:
-            name_attribute = "{}Name".format(template_type.split('::')[-1])
-            for logical_id, properties in self.provider.cloudformation_template.get('Resources', {}).items():
-                if properties.get('Type') == template_type:
-                    resource = properties.get('Properties', {}).get(name_attribute)
-                    if resource:
-                        resources[resource] = re.compile(BaseApi.RESOURCE_PATTERN.format(re.escape(resource)), re.IGNORECASE)
-
-        api_resources = self.provider.get_cached_api_result(service, region=region, account=account, api_method=api_method, api_kwargs=api_kwargs)[api_attribute]
-
-        if api_inner_attribute:
-            api_resources = (resource[api_inner_attribute] for resource in api_resources)
-        if resource_converter:
-            api_resources = (resource_converter(resource) for resource in api_resources)
+        Built once for the same template and API result:
+        >>> table = runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames')
+        >>> runtime._get_generic_all_resources('dynamodb', 'us-east-1', 'some-account', 'AWS::DynamoDB::Table', 'list_tables', 'TableNames') is table
+        True
+        >>> mock.calls_for('eprint')
+        >>> BaseApi.RESOURCE_TABLES.clear()
+        >>> CloudFormationIndex.INDEXES.clear()
+        """
 
-        resources.update(
-                (resource, re.compile(BaseApi.RESOURCE_PATTERN.format(re.escape(resource)), re.IGNORECASE))
-                for resource in api_resources
-                )
+        template = self.provider.cloudformation_template
+        api_result = self.provider.get_cached_api_result(service, region=region, account=account, api_method=api_method, api_kwargs=api_kwargs)
+
+        # resource_converter is left out, it's the same for every (service, api_method)
+        table_key = (service, template_type, region, account, api_method, api_attribute, api_inner_attribute, frozenset(api_kwargs.items()))
+        table = BaseApi.RESOURCE_TABLES.get(table_key)
+        # built from the very same template and API result, e.g not another provider's
+        if table is None or table[0] is not template or table[1] is not api_result:
+            table = BaseApi.RESOURCE_TABLES[table_key] = (
+                template, api_result,
+                self._build_resource_table(template, api_result, template_type, api_attribute, api_inner_attribute, resource_converter),
+            )
+        resources = table[2]
 
         if not resources and warn:
             if not hasattr(self, '_no_resources_warnings'):
@@ -296,10 +340,32 @@ class BaseApi:
             if warning_arguments not in self._no_resources_warnings:
                 eprint("warn: no {} resources ({}) on '{}:{}', you're using this service but your AWS account and CloudFormation are empty", *warning_arguments)
                 self._no_resources_warnings.add(warning_arguments)
-            return {}
 
         return resources
 
+    @staticmethod
+    def _build_resource_table(template, api_result, template_type, api_attribute, api_inner_attribute, resource_converter):
+        resources = []
+
+        if template and template_type:
+            name_attribute = "{}Name".format(template_type.split('::')[-1])
+            for logical_id, properties in CloudFormationIndex.get(template).get_resources(template_type):
+                resource = properties.get('Properties', {}).get(name_attribute)
+                if resource:
+                    resources.append(resource)
+
+        api_resources = api_result[api_attribute]
+
+        if api_inner_attribute:
+            api_resources = (resource[api_inner_attribute] for resource in api_resources)
+        if resource_converter:
+            api_resources = (resource_converter(resource) for resource in api_resources)
+
+        resources.extend(api_resources)
+
+        # same as searching \bresource\b case-insensitively, for all resources at once
+        return KeywordMatcher(resources, ignore_case=True, word_boundary=True)
+
     def _get_s3_resources(self, filename, contents, resources, region, account):
         # buckets
         buckets = defaultdict(set)
@@ -314,7 +380,7 @@ class BaseApi:
         # tables
         tables = defaultdict(set)
         self._get_generic_resources(filename, contents, tables, region=region, account=account, resource_format="table/{}",
-                                    get_all_resources_method=partial(self._get_generic_all_resources, 'dynamodb', template_type='AWS::DynamoDB::Table', api_method='list_tables', api_attribute='TableNames'))
+                                    get_all_resources_method=self._get_all_dynamodb_tables)
         resources.update(tables)
         # streams
         for table in tables:
@@ -325,6 +391,19 @@ class BaseApi:
                 self._get_generic_resources(filename, contents, resources, region=region, account=account, resource_format="table/{}/stream/{{}}".format(table),
                                             get_all_resources_method=partial(self._get_generic_all_resources, 'dynamodbstreams', template_type=None, api_method='list_streams', api_attribute='Streams', api_inner_attribute='StreamLabel', api_kwargs={'TableName': table}, warn=False))
 
+    def _get_dynamodb_inventory_calls(self, filename, contents, calls, region, account):
+        """ Streams of the tables matched within contents. """
+
+        tables = defaultdict(set)
+        self._get_generic_resources(filename, contents, tables, region=region, account=account, resource_format="{}",
+                                    get_all_resources_method=self._get_all_dynamodb_tables)
+        for table in tables:
+            if not table.endswith('*'):
+                calls.append(('dynamodbstreams', region, account, 'list_streams', {'TableName': table}))
+
+    def _get_all_dynamodb_tables(self, region, account):
+        return self._get_generic_all_resources('dynamodb', region=region, account=account, template_type='AWS::DynamoDB::Table', api_method='list_tables', api_attribute='TableNames')
+
     def _get_kms_resources(self, filename, contents, resources, region, account):
         # keys
         self._get_generic_resources(filename, contents, resources, region=region, account=account, resource_format="key/{}",
@@ -339,17 +418,13 @@ class BaseApi:
         # state machines
         state_machines = defaultdict(set)
         self._get_generic_resources(filename, contents, state_machines, region=region, account=account, resource_format="stateMachine:{}",
-                                    get_all_resources_method=partial(self._get_generic_all_resources, 'stepfunctions', template_type='AWS::StepFunctions::StateMachine', api_method='list_state_machines', api_attribute='stateMachines', api_inner_attribute='name'))
+                                    get_all_resources_method=self._get_all_state_machines)
         resources.update(state_machines)
         # activities
         self._get_generic_resources(filename, contents, resources, region=region, account=account, resource_format="activity:{}",
                                     get_all_resources_method=partial(self._get_generic_all_resources, 'stepfunctions', template_type='AWS::StepFunctions::Activity', api_method='list_activities', api_attribute='activities', api_inner_attribute='name'))
         # executions
-        state_machine_arns = dict(
-                (state_machine['name'], state_machine['stateMachineArn'])
-                for state_machine in
-                self.provider.get_cached_api_result('stepfunctions', region=region, account=account, api_method='list_state_machines')['stateMachines']
-                )
+        state_machine_arns = self._get_state_machine_arns(region, account)
         for state_machine in state_machines:
             if state_machine.endswith('*'):
                 resources["executions:*:*"]
@@ -358,3 +433,27 @@ class BaseApi:
                 self._get_generic_resources(filename, contents, resources, region=region, account=account, resource_format="execution:{}:{{}}".format(state_machine),
                                             get_all_resources_method=partial(self._get_generic_all_resources, 'stepfunctions', template_type=None, api_method='list_executions', api_attribute='executions', api_inner_attribute='name', api_kwargs={'stateMachineArn': state_machine_arns[state_machine]}))
 
+    def _get_states_inventory_calls(self, filename, contents, calls, region, account):
+        """ Executions of the state machines matched within contents. """
+
+        state_machines = defaultdict(set)
+        self._get_generic_resources(filename, contents, state_machines, region=region, account=account, resource_format="{}",
+                                    get_all_resources_method=self._get_all_state_machines)
+        state_machine_arns = None
+        for state_machine in state_machines:
+            if not state_machine.endswith('*'):
+                if state_machine_arns is None:
+                    state_machine_arns = self._get_state_machine_arns(region, account)
+                if state_machine not in state_machine_arns:
+                    continue # only from CloudFormation, left to _get_states_resources
+                calls.append(('stepfunctions', region, account, 'list_executions', {'stateMachineArn': state_machine_arns[state_machine]}))
+
+    def _get_all_state_machines(self, region, account):
+        return self._get_generic_all_resources('stepfunctions', region=region, account=account, template_type='AWS::StepFunctions::StateMachine', api_method='list_state_machines', api_attribute='stateMachines', api_inner_attribute='name')
+
+    def _get_state_machine_arns(self, region, account):
+        return dict(
+                (state_machine['name'], state_machine['stateMachineArn'])
+                for state_machine in
+                self.provider.get_cached_api_result('stepfunctions', region=region, account=account, api_method='list_state_machines')['stateMachines']
+                )
@@ -1,3 +1,4 @@
+import json
 import pkg_resources
 import os
 import re
@@ -6,15 +7,21 @@ import subprocess
 from puresec_cli.utils import eprint, get_inner_parentheses
 from puresec_cli.actions.generate_roles.runtimes.aws.base import Base
 from puresec_cli.actions.generate_roles.runtimes.aws.nodejs_api import NodejsApi
+from puresec_cli.matchers import ScanBudgetExceeded
 
 class NodejsRuntime(Base, NodejsApi):
     JAVASCRIPT_FILENAME_PATTERN = re.compile(r"\.js$", re.IGNORECASE)
+    # within node_modules, provided by the Lambda environment
+    EXCLUDED_PACKAGES = ('aws-sdk',)
+    EXCLUDED_PACKAGES_PARENT = 'node_modules'
 
     def _walk(self, processor, *args, **kwargs):
         """
-        >>> from collections import namedtuple
         >>> from tests.mock import Mock
+        >>> from puresec_cli.actions.generate_roles.runtimes import base as runtime_base
+        >>> from puresec_cli.actions.generate_roles.runtimes.file_index import FileIndex
         >>> mock = Mock(__name__)
+        >>> mock.mock(runtime_base, 'open', lambda *args, **kwargs: mock.open(*args, **kwargs))
 
         >>> mock.mock(pkg_resources, 'resource_filename', "/path/to/node_modules")
 
@@ -22,14 +29,11 @@ class NodejsRuntime(Base, NodejsApi):
         >>> def processor(filename, contents, custom_positional, custom_keyword):
         ...     processed.append((filename, contents, custom_positional, custom_keyword))
 
-        >>> def stat(self, filename):
-        ...     return namedtuple('Stat', ('st_size',))(5*1024*1024 if filename == "/path/to/function/large-file" else 512)
-        >>> mock.mock(NodejsRuntime, '_stat', stat)
-
         >>> mock.filesystem = {'': {'path': {'to': {'function': {
-        ...     'large-file': True,
+        ...     'large-file': 5*1024*1024,
         ...     'config': True,
         ...     'unreferenced': True,
+        ...     'node_modules': {'aws-sdk': {'config': True}}, # excluded, never walked into
         ... }}}}}
         >>> with mock.open("/path/to/function/config", 'w') as f:
         ...     f.write("some config") and None
@@ -44,26 +48,45 @@ class NodejsRuntime(Base, NodejsApi):
         >>> processed
         [('/path/to/function/src/index.js', 'some code config large-file more code', 'positional', 'keyword'),
          ('/path/to/function/config', 'some config', 'positional', 'keyword')]
+        >>> FileIndex.INDEXES.clear()
         """
 
         if hasattr(self, '_dependencies'):
             # cached
             for filename in self._dependencies:
-                with open(filename, 'r', errors='replace') as file:
-                    processor(filename, file.read(), *args, **kwargs)
+                processor(filename, self._read_file(filename), *args, **kwargs)
             return
 
-        # getting main JavaScript file (from Handler)
-        handler = self.resource_properties.get('Handler')
-        if not handler:
+        filename = self._get_handler_filename()
+        if filename is None:
             # dummy CloudFormation? walking everything
             super()._walk(processor, *args, **kwargs)
             return
-        module = '.'.join(handler.split('.')[0:-1]) # all except the last part which is the method
-        filename = os.path.abspath(os.path.join(self.root, "{}.js".format(module)))
         if not os.path.exists(filename):
             return
 
+        dependencies = self._get_dependencies(filename)
+        self._dependencies = dependencies[:] # cache
+
+        # getting all non-dependency files (without excluded packages)
+        resources = [ # (abspath, filename)
+            (os.path.abspath(entry.path), entry.name)
+            for entry in self._get_file_index().files
+            if not NodejsRuntime.JAVASCRIPT_FILENAME_PATTERN.search(entry.name) and entry.size < NodejsRuntime.MAX_FILE_SIZE
+        ]
+
+        self._walk_dependencies(dependencies, resources, processor, *args, **kwargs)
+
+    def _get_handler_filename(self):
+        """ Main JavaScript file (from Handler), None without a handler. """
+
+        handler = self.resource_properties.get('Handler')
+        if not handler:
+            return None
+        module = '.'.join(handler.split('.')[0:-1]) # all except the last part which is the method
+        return os.path.abspath(os.path.join(self.root, "{}.js".format(module)))
+
+    def _list_dependencies(self, filename):
         # acquiring dependencies using NPM's dependency-tree
         dependency_tree_cli_path = os.path.abspath(os.path.join(pkg_resources.resource_filename('puresec_cli', 'resources/node_modules'), 'dependency-tree/bin/cli.js'))
         try:
@@ -75,48 +98,101 @@ class NodejsRuntime(Base, NodejsApi):
             eprint("error: failed to get dependency tree:\n{}", e.output.decode())
             raise SystemExit(-1)
 
-        dependencies = [
-            dependency for dependency in dependencies.decode().split('\n')
-            # skipping last blank line and aws-sdk
-            if dependency and '/node_modules/aws-sdk/' not in dependency
+        # skipping last blank line
+        return self._skip_excluded_packages(dependency for dependency in dependencies.decode().split('\n') if dependency)
+
+    def _skip_excluded_packages(self, dependencies):
+        excluded_paths = ["/node_modules/{}/".format(package) for package in self.excluded_packages]
+        return [
+            dependency for dependency in dependencies
+            if not any(excluded_path in dependency for excluded_path in excluded_paths)
         ]
-        self._dependencies = dependencies[:] # cache
 
-        # getting all non-dependency files
-        resources = [] # (abspath, filename)
-        for path, dirs, filenames in os.walk(self.root):
-            if path.endswith('node_modules'):
-                # skipping aws-sdk
-                try:
-                    dirs.remove('aws-sdk')
-                except ValueError:
-                    pass
-
-            paths_generator = (
-                (os.path.abspath(os.path.join(path, filename)), filename)
-                for filename in filenames
-                if not NodejsRuntime.JAVASCRIPT_FILENAME_PATTERN.search(filename)
-            )
-            resources.extend(
-                paths_tuple for paths_tuple in paths_generator
-                if self._stat(paths_tuple[0]).st_size < NodejsRuntime.MAX_FILE_SIZE
-            )
-
-        while dependencies:
-            filename = dependencies.pop(0)
-            with open(filename, 'r', errors='replace') as file:
-                # adding resources referenced by current file
-                used_resources_indexes = []
-                contents = file.read()
-                for index, (resource_abspath, resource_filename) in enumerate(resources):
-                    if resource_filename in contents:
-                        dependencies.append(resource_abspath)
-                        self._dependencies.append(resource_abspath)
-                        used_resources_indexes.append(index)
-                for index in reversed(used_resources_indexes):
-                    resources.pop(index)
-                # processing current file
-                processor(filename, contents, *args, **kwargs)
+    @classmethod
+    def prepare(cls, runtimes):
+        """ Lists the dependencies of all handlers with one resources/dependency-tree-worker.js process,
+        skipping handlers whose dependencies didn't change since a previous run.
+
+        The worker keeps dependency-tree's resolution cache between handlers, so shared modules are only parsed once.
+        Failures are left for _walk, which lists the dependencies of each handler on its own.
+
+        >>> import io
+        >>> import json
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> mock.mock(pkg_resources, 'resource_filename', "/path/to/dependency-tree-worker.js")
+        >>> for function in ('a', 'b', 'c'):
+        ...     with mock.open("/path/to/{}/index.js".format(function), 'w') as f:
+        ...         f.write("some code") and None
+
+        >>> runtimes = [
+        ...     NodejsRuntime('/path/to/a', resource_properties={'Handler': "index.handler"}, provider=object()),
+        ...     NodejsRuntime('/path/to/b', resource_properties={'Handler': "index.handler"}, provider=object()),
+        ...     NodejsRuntime('/path/to/c', resource_properties={'Handler': "index.handler"}, provider=object()),
+        ...     NodejsRuntime('/path/to/d', resource_properties={'Handler': "index.handler"}, provider=object()),
+        ...     NodejsRuntime('/path/to/e', resource_properties={}, provider=object()),
+        ... ]
+        >>> requests = []
+        >>> class Process:
+        ...     def __init__(self, command, stdin, stdout, stderr):
+        ...         pass
+        ...     def communicate(self, input):
+        ...         requests.append(input.decode())
+        ...         responses = []
+        ...         for line in input.decode().splitlines():
+        ...             request = json.loads(line)
+        ...             if request['directory'] == '/path/to/b':
+        ...                 responses.append({'error': "Error: something"})
+        ...             else:
+        ...                 responses.append({'dependencies': [
+        ...                     request['directory'] + '/node_modules/aws-sdk/index.js',
+        ...                     request['filename'].replace('index.js', 'lib.js'),
+        ...                     request['filename'],
+        ...                 ]})
+        ...         return ''.join(json.dumps(response) + '\\n' for response in responses).encode(), None
+        >>> mock.mock(subprocess, 'Popen', Process)
+
+        >>> NodejsRuntime.prepare(runtimes)
+        >>> mock.calls_for('subprocess.Popen')
+        ['node', '/path/to/dependency-tree-worker.js'], stderr=-3, stdin=-1, stdout=-1
+        >>> print(''.join(requests))
+        {"directory": "/path/to/a", "excludedPackages": ["aws-sdk"], "filename": "/path/to/a/index.js"}
+        {"directory": "/path/to/b", "excludedPackages": ["aws-sdk"], "filename": "/path/to/b/index.js"}
+        {"directory": "/path/to/c", "excludedPackages": ["aws-sdk"], "filename": "/path/to/c/index.js"}
+        >>> [runtime._resolved_dependencies for runtime in runtimes]
+        [['/path/to/a/lib.js', '/path/to/a/index.js'], None, ['/path/to/c/lib.js', '/path/to/c/index.js'], None, None]
+        """
+
+        batch = [] # [(runtime, filename)]
+        for runtime in runtimes:
+            filename = runtime._get_handler_filename()
+            if filename is None or not os.path.exists(filename):
+                continue
+            dependencies = runtime._get_cached_dependencies(filename)
+            if dependencies is not None:
+                # unchanged since a previous run
+                runtime._resolved_dependencies = dependencies
+            else:
+                batch.append((runtime, filename))
+        if not batch:
+            return
+
+        worker_path = pkg_resources.resource_filename('puresec_cli', 'resources/dependency-tree-worker.js')
+        requests = ''.join(
+            json.dumps({'filename': filename, 'directory': runtime.root, 'excludedPackages': runtime.excluded_packages}, sort_keys=True) + '\n'
+            for runtime, filename in batch
+        )
+        try:
+            process = subprocess.Popen(['node', worker_path], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            output, _ = process.communicate(requests.encode())
+            responses = [json.loads(line) for line in output.decode().splitlines() if line]
+        except (OSError, ValueError):
+            return
+        for (runtime, filename), response in zip(batch, responses):
+            if 'dependencies' in response:
+                runtime._resolved_dependencies = runtime._skip_excluded_packages(response['dependencies'])
+                runtime._set_cached_dependencies(filename, runtime._resolved_dependencies)
 
     # Processors
 
@@ -151,17 +227,20 @@ class NodejsRuntime(Base, NodejsApi):
         >>> pprint(normalize_dict(runtime._permissions))
         {'s3': {'default_region': {'default_account': {}}}}
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
 
         >>> runtime._get_services("filename.js", ".S3({ region: 'localhost' })")
         >>> pprint(normalize_dict(runtime._permissions))
         {'s3': {'default_region': {'default_account': {}}}}
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
 
         >>> runtime._get_services("filename.js", ".S3({ region: 'us-east-1' })")
         >>> pprint(normalize_dict(runtime._permissions))
         {'s3': {'us-east-1': {'default_account': {}}}}
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.js", '''
         ... aws.
         ...     S3({
@@ -172,6 +251,7 @@ class NodejsRuntime(Base, NodejsApi):
         {'s3': {'us-east-1': {'default_account': {}}}}
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.js", '''
         ... aws.
         ...     S3({
@@ -184,6 +264,7 @@ class NodejsRuntime(Base, NodejsApi):
         >>> mock.mock(None, 'eprint')
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.js", '''
         ... aws.
         ...     S3({
@@ -196,6 +277,7 @@ class NodejsRuntime(Base, NodejsApi):
         "warn: incomprehensive region: {} (in {}), falling back to '*'", '{\\n        region: getRegion()\\n    }', 'filename.js'
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.js", '''
         ... aws.
         ...     S3({
@@ -208,6 +290,7 @@ class NodejsRuntime(Base, NodejsApi):
         "warn: incomprehensive region: {} (in {}), falling back to '*'", "{\\n        region: 'us-' + region\\n    }", 'filename.js'
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.js", '''
         ... aws.
         ...     S3({
@@ -218,36 +301,84 @@ class NodejsRuntime(Base, NodejsApi):
         {'s3': {'default_region': {'*': {}}}}
         >>> mock.calls_for('eprint')
         "warn: unknown account: {} (in {}), falling back to '*'", '{\\n        accessKeyId: "some key"\\n    }', 'filename.js'
+
+        Budget exceeded while indexing the file:
+        >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
+        >>> runtime.scan_budget = 10
+        >>> from puresec_cli.actions.generate_roles.runtimes.aws import base as aws_base
+        >>> mock.mock(aws_base, 'eprint')
+        >>> mock.mock(runtime, '_get_scan_deadline', 0)
+        >>> runtime._get_services("filename.js", "const s3 = new AWS.S3();")
+        >>> pprint(normalize_dict(runtime._permissions))
+        {'s3': {'*': {'*': {}}}}
+        >>> mock.calls_for('puresec_cli.actions.generate_roles.runtimes.aws.base.eprint')
+        "warn: scan budget of {} seconds exceeded (in {}), falling back to '*'", 10, 'filename.js'
         """
 
         if not NodejsRuntime.JAVASCRIPT_FILENAME_PATTERN.search(filename):
             return
 
-        for service, pattern in NodejsApi.SERVICE_CALL_PATTERNS:
-            for service_match in pattern.finditer(contents):
-                arguments = get_inner_parentheses(service_match.group(1))
-                if arguments:
-                    # region
-                    region = self._get_variable_from_arguments(arguments, NodejsRuntime.REGION_PATTERN)
-                    if region is None or region == 'localhost':
-                        region = self.provider.default_region
-                    elif not region:
-                        eprint("warn: incomprehensive region: {} (in {}), falling back to '*'", arguments, filename)
-                        region = '*'
-                    elif not any(pattern.match(region) for pattern in NodejsRuntime.REGION_PATTERNS.values()):
-                        eprint("warn: incomprehensive region: {} (in {}), falling back to '*'", arguments, filename)
-                        region = '*'
-                    # account
-                    if NodejsRuntime.AUTH_PATTERN.search(arguments):
-                        eprint("warn: unknown account: {} (in {}), falling back to '*'", arguments, filename)
-                        account = '*'
-                    else:
-                        account = self.provider.default_account
-                else:
-                    region = self.provider.default_region
-                    account = self.provider.default_account
-
-                self._permissions[service][region][account] # accessing to initialize defaultdict
+        # [(service, region - see _get_variable_from_arguments, authenticated, arguments)]
+        try:
+            call_index = self._get_call_index(filename, contents)
+            if call_index is not None:
+                service_calls = [
+                    (service, self._get_variable_from_value(region), authenticated, arguments)
+                    for service, region, authenticated, arguments in call_index['services']
+                ]
+            else:
+                service_calls = [
+                    (
+                        service,
+                        self._get_variable_from_arguments(arguments, NodejsRuntime.REGION_PATTERN) if arguments else None,
+                        bool(arguments) and NodejsRuntime.AUTH_PATTERN.search(arguments) is not None,
+                        arguments,
+                    )
+                    for service, arguments in self._get_cached(filename, contents, 'service_calls',
+                                                               lambda: self._get_service_calls(contents, self._get_scan_deadline(filename)))
+                ]
+        except ScanBudgetExceeded:
+            self._set_any_services(filename, contents, NodejsApi.SERVICE_CALL_MATCHERS)
+            return
+
+        for service, region, authenticated, arguments in service_calls:
+            # region
+            if region is None or region == 'localhost':
+                region = self.provider.default_region
+            elif not region:
+                eprint("warn: incomprehensive region: {} (in {}), falling back to '*'", arguments, filename)
+                region = '*'
+            elif not self._is_region(region):
+                eprint("warn: incomprehensive region: {} (in {}), falling back to '*'", arguments, filename)
+                region = '*'
+            # account
+            if authenticated:
+                eprint("warn: unknown account: {} (in {}), falling back to '*'", arguments, filename)
+                account = '*'
+            else:
+                account = self.provider.default_account
+
+            self._permissions[service][region][account] # accessing to initialize defaultdict
+
+    def _get_service_calls(self, contents, deadline=None):
+        """ [(service, arguments within parentheses or None)]
+
+        Matchers only run over contents containing their literals, a substring search rejects most files at once.
+        deadline: see CallMatcher.finditer
+
+        >>> runtime = NodejsRuntime('path/to/function', resource_properties={}, provider=object())
+        >>> runtime._get_service_calls("new AWS.S3(); new AWS.DynamoDB.DocumentClient({region: 'us-east-1'})")
+        [('dynamodb', "{region: 'us-east-1'}"), ('s3', '')]
+        >>> runtime._get_service_calls("const s3 = 'DynamoDB';")
+        []
+        """
+
+        return [
+            (service, get_inner_parentheses(arguments))
+            for service, matcher in NodejsApi.SERVICE_CALL_MATCHERS
+            for arguments in matcher.finditer(contents, deadline)
+        ]
 
     def _get_regions(self, filename, contents, regions, service, account):
         processor = NodejsRuntime.SERVICE_REGIONS_PROCESSOR.get(service)
@@ -2,17 +2,31 @@
 
 from functools import partial
 from itertools import chain
+from puresec_cli.actions.generate_roles.runtimes.aws.base_api import index_action_calls
+from puresec_cli.actions.generate_roles.runtimes.aws.nodejs_calls import get_call_index
+from puresec_cli.matchers import CallMatcher, ScanBudgetExceeded
 from puresec_cli.utils import lowerize
 import re
 
-# .VALUE(OUTPUT) including opening parantheses and 512 characters after
-CALL_PATTERN_TEMPLATE = r"\.\s*{0}(\(.{{0,512}})"
-# .VALUE(OUTPUT) or .getSignedUrl('VALUE'OUTPUT) including opening paranthesis and 512 characters after
-SIGNED_URL_PATTERN_TEMPLATE = r"{0}|\.\s*getSignedUrl(\(\s*['\"]{{0}}['\"].{{{{0,512}}}})".format(CALL_PATTERN_TEMPLATE)
+SIGNED_URL_METHOD = 'getSignedUrl'
+CALL_TOKEN_PATTERN = re.compile(r"\.\s*(\w+)\(") # .VALUE(
+SIGNED_URL_TOKEN_PATTERN = re.compile(r"\.\s*getSignedUrl\(\s*['\"](\w+)['\"]") # .getSignedUrl('VALUE'
+
+def signed_url_token(method):
+    return "{}('{}')".format(SIGNED_URL_METHOD, method)
+
+def call(method):
+    """ Call tokens of .method(...) """
+    return (method,)
+
+def signed_url_call(method):
+    """ Call tokens of .method(...) or .getSignedUrl('method', ...) """
+    return (method, signed_url_token(method))
 
 class NodejsApi:
-    SERVICE_CALL_PATTERNS = [
-        (name, re.compile(CALL_PATTERN_TEMPLATE.format(client_name), re.MULTILINE | re.DOTALL))
+    # [(service, CallMatcher)] of .VALUE(OUTPUT) including opening parantheses and 512 characters after
+    SERVICE_CALL_MATCHERS = [
+        (name, CallMatcher((client_name,)))
         for name, client_name in (
                 ('dynamodb', r"DynamoDB"),
                 ('dynamodb', r"DocumentClient"),
@@ -27,6 +41,11 @@ class NodejsApi:
         )
     ]
 
+    # { client name: service }
+    SERVICE_CLIENT_NAMES = dict((matcher.literal, service) for service, matcher in SERVICE_CALL_MATCHERS)
+    # .VALUE( of any client name, within every file constructing a service
+    SERVICE_CLIENT_NAME_PATTERN = re.compile(r"\.\s*(?:{})\(".format('|'.join(re.escape(name) for name in sorted(SERVICE_CLIENT_NAMES))))
+
     SERVICE_ACTIONS_PROCESSOR = {
         # service: function(self, filename, contents, actions)
         'dynamodb': lambda self: partial(self._get_generic_actions, service='dynamodb'),
@@ -39,13 +58,13 @@ class NodejsApi:
         'states':   lambda self: partial(self._get_generic_actions, service='states'),
     }
 
-    # { service: (action, pattern) }
-    ACTION_CALL_PATTERNS = {
+    # { service: ((action, call tokens)) }
+    ACTION_CALLS = {
         'dynamodb': tuple(chain(
             (
                 (
                     "dynamodb:{}".format(action),
-                    re.compile(CALL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                    call(lowerize(action))
                 )
                 for action in (
                         'BatchGetItem', 'BatchWriteItem', 'CreateTable', 'DeleteItem', 'DeleteTable',
@@ -56,7 +75,7 @@ class NodejsApi:
                 )
             ), (
                 # DocumentClient
-                ("dynamodb:{}".format(action), re.compile(CALL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("dynamodb:{}".format(action), call(method))
                 for action, method in (
                         ('BatchGetItem', 'batchGet'),
                         ('BatchWriteItem', 'batchWrite'),
@@ -70,7 +89,7 @@ class NodejsApi:
         'kinesis': tuple(
             (
                 "kinesis:{}".format(action),
-                re.compile(CALL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                call(lowerize(action))
             )
             for action in (
                     'AddTagsToStream', 'CreateStream', 'DecreaseStreamRetentionPeriod', 'DeleteStream', 'DescribeLimits',
@@ -83,7 +102,7 @@ class NodejsApi:
             (
                 (
                     "kms:{}".format(action),
-                    re.compile(CALL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                    call(lowerize(action))
                 )
                 for action in (
                         'CancelKeyDeletion', 'CreateAlias', 'CreateGrant', 'CreateKey', 'Decrypt',
@@ -94,7 +113,7 @@ class NodejsApi:
                         'PutKeyPolicy', 'RevokeGrant', 'ScheduleKeyDeletion', 'UpdateAlias', 'UpdateKeyDescription',
                 )
             ), (
-                ("kms:{}".format(action), re.compile(CALL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("kms:{}".format(action), call(method))
                 for action, method in (
                         ('ReEncryptFrom', 'reEncrypt'),
                         ('ReEncryptTo', 'reEncrypt'),
@@ -105,7 +124,7 @@ class NodejsApi:
             (
                 (
                     "lambda:{}".format(action),
-                    re.compile(CALL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                    call(lowerize(action))
                 )
                 for action in (
                         'AddPermission', 'CreateAlias', 'CreateEventSourceMapping', 'CreateFunction', 'DeleteAlias',
@@ -115,7 +134,7 @@ class NodejsApi:
                         'UpdateAlias', 'UpdateEventSourceMapping', 'UpdateFunctionCode', 'UpdateFunctionConfiguration',
                 )
             ), (
-                ("lambda:{}".format(action), re.compile(CALL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("lambda:{}".format(action), call(method))
                 for action, method in (
                         ('InvokeFunction', 'invoke'),
                 )
@@ -125,7 +144,7 @@ class NodejsApi:
             (
                 (
                     "s3:{}".format(action),
-                    re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                    signed_url_call(lowerize(action))
                 )
                 for action in (
                         'AbortMultipartUpload', 'CreateBucket', 'DeleteBucket', 'DeleteBucketPolicy', 'DeleteBucketWebsite',
@@ -137,7 +156,7 @@ class NodejsApi:
                         'PutObjectTagging', 'RestoreObject',
                 )
             ), (
-                ("s3:{}".format(action), re.compile(CALL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("s3:{}".format(action), call(method))
                 for action, method in (
                         ('DeleteObject', 'deleteObjects'),
                         ('DeleteReplicationConfiguration', 'deleteBucketReplication'),
@@ -190,7 +209,7 @@ class NodejsApi:
             (
                 (
                     "ses:{}".format(action),
-                    re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                    signed_url_call(lowerize(action))
                 )
                 for action in (
                         'CloneReceiptRuleSet', 'CreateReceiptFilter', 'CreateReceiptRule', 'CreateReceiptRuleSet', 'DeleteIdentity',
@@ -203,7 +222,7 @@ class NodejsApi:
                         'VerifyDomainDkim', 'VerifyDomainIdentity', 'VerifyEmailAddress', 'VerifyEmailIdentity',
                 )
             ), (
-                ("ses:{}".format(action), re.compile(CALL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("ses:{}".format(action), call(method))
                 for action, method in (
                         #('CreateConfigurationSet'),
                         #('CreateConfigurationSetEventDestination'),
@@ -221,7 +240,7 @@ class NodejsApi:
         'sns': tuple(
             (
                 "sns:{}".format(action),
-                re.compile(CALL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                call(lowerize(action))
             )
             for action in (
                     'AddPermission', 'CheckIfPhoneNumberIsOptedOut', 'ConfirmSubscription', 'CreatePlatformApplication', 'CreatePlatformEndpoint',
@@ -235,7 +254,7 @@ class NodejsApi:
         'states': tuple(
             (
                 "states:{}".format(action),
-                re.compile(CALL_PATTERN_TEMPLATE.format(lowerize(action)), re.MULTILINE | re.DOTALL)
+                call(lowerize(action))
             )
             for action in (
                     'CreateActivity', 'CreateStateMachine', 'DeleteActivity', 'DeleteStateMachine', 'DescribeActivity',
@@ -246,9 +265,13 @@ class NodejsApi:
         ),
     }
 
-    def _get_generic_actions(self, filename, contents, actions, service, patterns=None):
+    # { service: { call token: {actions} } }
+    ACTION_CALL_TOKENS = index_action_calls(ACTION_CALLS)
+
+    def _get_generic_actions(self, filename, contents, actions, service):
         """
-        >>> runtime = NodejsApi()
+        >>> from puresec_cli.actions.generate_roles.runtimes.aws.nodejs import NodejsRuntime
+        >>> runtime = NodejsRuntime('path/to/function', resource_properties={}, provider=object())
 
         >>> actions = set()
         >>> runtime._get_generic_actions("path/to/file.js", "code .putItem() code", actions, service='dynamodb')
@@ -256,13 +279,54 @@ class NodejsApi:
         ['dynamodb:PutItem']
 
         >>> actions = set()
-        >>> runtime._get_generic_actions("path/to/file.js", "code .putObject(params) .getSignedUrl('getObject', params) code", actions, service='s3')
+        >>> runtime._get_generic_actions("path/to/other.js", "code .putObject(params) .getSignedUrl('getObject', params) code", actions, service='s3')
         >>> sorted(actions)
         ['s3:GetObject', 's3:PutObject']
         """
-        if patterns is None:
-            patterns = NodejsApi.ACTION_CALL_PATTERNS[service]
-        for action, pattern in patterns:
-            if pattern.search(contents):
-                actions.add(action)
 
+        action_call_tokens = NodejsApi.ACTION_CALL_TOKENS[service]
+        try:
+            call_index = self._get_call_index(filename, contents)
+        except ScanBudgetExceeded:
+            call_index = None # the regular expressions are linear to the contents anyway
+        if call_index is not None:
+            tokens = call_index['calls']
+        else:
+            tokens = self._get_indexed(filename, 'call_tokens', lambda: self._get_call_tokens(contents))
+        for token in tokens:
+            actions.update(action_call_tokens.get(token, ()))
+
+    def _get_call_index(self, filename, contents):
+        """ Services and calls from lexing the file (see get_call_index), None if brackets aren't balanced - regular
+        expressions are used instead.
+
+        Lexing costs far more than the regular expressions, so only files that might construct a service are lexed.
+
+        >>> from pprint import pprint
+        >>> from puresec_cli.actions.generate_roles.runtimes.aws.nodejs import NodejsRuntime
+        >>> runtime = NodejsRuntime('path/to/function', resource_properties={}, provider=object())
+
+        >>> pprint(runtime._get_call_index("path/to/file.js", "new AWS.StepFunctions().startExecution(params)"))
+        {'calls': ['StepFunctions', 'startExecution'], 'services': [['states', None, False, None]]}
+        >>> runtime._get_call_index("path/to/other.js", "new AWS.StepFunctions() }")
+        >>> runtime._get_call_index("path/to/another.js", "table.putItem()")
+        """
+
+        def get_file_call_index():
+            if not NodejsApi.SERVICE_CLIENT_NAME_PATTERN.search(contents):
+                return False
+            # False for unbalanced sources too, as None is a miss of the analysis cache
+            return get_call_index(contents, NodejsApi.SERVICE_CLIENT_NAMES, SIGNED_URL_METHOD, self._get_scan_deadline(filename)) or False
+
+        return self._get_cached(filename, contents, 'call_index', get_file_call_index) or None
+
+    def _get_call_tokens(self, contents):
+        """ Tokenizes the contents once into all method calls, so that matching actions is a lookup.
+
+        >>> sorted(NodejsApi()._get_call_tokens("code .putObject(params) .getSignedUrl('getObject', params) code"))
+        ['getSignedUrl', "getSignedUrl('getObject')", 'putObject']
+        """
+
+        tokens = set(match.group(1) for match in CALL_TOKEN_PATTERN.finditer(contents))
+        tokens.update(signed_url_token(match.group(1)) for match in SIGNED_URL_TOKEN_PATTERN.finditer(contents))
+        return tokens
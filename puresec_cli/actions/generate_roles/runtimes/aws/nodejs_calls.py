@@ -0,0 +1,231 @@
+""" Index of AWS SDK usage within JavaScript sources, from a single lexing pass over each file. """
+
+from puresec_cli.matchers import check_deadline
+import re
+
+# keys of client options with other credentials, possibly of another account
+AUTH_KEYS = frozenset(('accessKeyId', 'secretAccessKey', 'sessionToken', 'credentials'))
+
+# comments and whitespaces are skipped, strings (also unterminated, up to the end of line) are single tokens
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|/\*(?:[^*]|\*(?!/))*(?:\*/)?)
+  | (?P<string>'(?:[^'\\\n]|\\.)*'?|"(?:[^"\\\n]|\\.)*"?|`(?:[^`\\]|\\.)*`?)
+  | (?P<name>(?:[^\W\d]|\$)[\w$]*)
+  | (?P<number>\d[\w.]*)
+  | (?P<punctuation>.)
+""", re.VERBOSE | re.DOTALL)
+# after a token that can't end an expression, a slash starts a regular expression rather than a division
+REGEX_PATTERN = re.compile(r"/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\]?)*/?[\w$]*")
+REGEX_PRECEDING_KEYWORDS = frozenset((
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw', 'case', 'do', 'else', 'yield', 'await',
+))
+BRACKETS = {')': '(', ']': '[', '}': '{'}
+
+def get_call_index(contents, client_names, signed_url_method, deadline=None):
+    """ Lexes contents once into the service constructions and member calls, None if brackets aren't balanced (e.g
+    not JavaScript, or a part of a file).
+
+    client_names: { client name (e.g 'DocumentClient'): service (e.g 'dynamodb') }
+    signed_url_method: method getting a signed URL of another method, a call token of its own (e.g 'getSignedUrl')
+    deadline: time.monotonic() value, raising ScanBudgetExceeded once passed - checked every few thousand tokens
+
+    Returns (JSON-serializable):
+        'services': [[service, region, authenticated, arguments]]
+            region: None if not given, ['string', value], ['environ', variable name] or ['unknown']
+            arguments: source within the call's parentheses (for warnings), None without region and authentication
+        'calls': [call token] - called methods, and signed_url_method('method') for signed URLs
+
+    >>> from pprint import pprint
+    >>> pprint(get_call_index('''
+    ... const AWS = require('aws-sdk');
+    ... const s3 = new AWS.S3();
+    ... const ddb = new AWS.DynamoDB.DocumentClient({ region: process.env.REGION, params: { TableName: 'x' } });
+    ... const sns = new AWS.SNS({ 'region': "us-east-1", credentials });
+    ... const kms = new AWS.KMS({ region: getRegion() });
+    ... // new AWS.Lambda()
+    ... const text = "new AWS.Lambda()", re = /\\\\.Lambda\\\\(/g, half = 1 / 2;
+    ... exports.handler = async () => {
+    ...     await ddb.put({ Item: {} }).promise();
+    ...     s3.getSignedUrl('getObject', {});
+    ...     console.log(`${s3.putObject()}`);
+    ... };
+    ... ''', {'S3': 's3', 'DocumentClient': 'dynamodb', 'SNS': 'sns', 'KMS': 'kms', 'Lambda': 'lambda'}, 'getSignedUrl'))
+    {'calls': ['DocumentClient',
+               'KMS',
+               'S3',
+               'SNS',
+               'getSignedUrl',
+               "getSignedUrl('getObject')",
+               'log',
+               'promise',
+               'put'],
+     'services': [['s3', None, False, None],
+                  ['dynamodb',
+                   ['environ', 'REGION'],
+                   False,
+                   "{ region: process.env.REGION, params: { TableName: 'x' } }"],
+                  ['sns',
+                   ['string', 'us-east-1'],
+                   True,
+                   '{ \\'region\\': "us-east-1", credentials }'],
+                  ['kms', ['unknown'], False, '{ region: getRegion() }']]}
+
+    >>> get_call_index("new AWS.S3({ region: 'us-east-1' }", {'S3': 's3'}, 'getSignedUrl')
+
+    >>> from puresec_cli.matchers import ScanBudgetExceeded
+    >>> try:
+    ...     get_call_index("new AWS.S3()", {'S3': 's3'}, 'getSignedUrl', deadline=0)
+    ... except ScanBudgetExceeded:
+    ...     print("exceeded")
+    exceeded
+    """
+
+    services = []
+    calls = set()
+    # [(bracket, member call name or None, end of the bracket)]
+    stack = []
+    previous = None # (kind, text) of the last token
+    before_previous = None
+    for count, (kind, text, start, end) in enumerate(_tokenize(contents, 0, len(contents))):
+        if not count & 0xfff:
+            check_deadline(deadline)
+        if kind == 'punctuation':
+            if text in '([{':
+                if text == '(' and previous is not None and previous[0] == 'name' and before_previous == ('punctuation', '.'):
+                    stack.append((text, previous[1], end))
+                else:
+                    stack.append((text, None, end))
+            elif text in BRACKETS:
+                if not stack or stack[-1][0] != BRACKETS[text]:
+                    return None
+                bracket, method, arguments_start = stack.pop()
+                if method is not None:
+                    calls.add(method)
+                    service = client_names.get(method)
+                    if service is not None:
+                        services.append([service] + _get_options(contents, arguments_start, start))
+                    elif method == signed_url_method:
+                        signed_method = _get_first_string(contents, arguments_start, start)
+                        if signed_method is not None:
+                            calls.add("{}('{}')".format(signed_url_method, signed_method))
+        before_previous, previous = previous, (kind, text)
+    if stack:
+        return None
+
+    # in the order of the calls (closed last for nested ones)
+    return {
+        'services': services,
+        'calls': sorted(calls),
+    }
+
+def _tokenize(contents, start, end):
+    """ Yields (kind, text, start, end) of the tokens between start and end, without whitespaces and comments.
+
+    >>> [text for kind, text, start, end in _tokenize("a = b / c; d = /[/]+/g.test(`e ${f}`) // g", 0, 42)]
+    ['a', '=', 'b', '/', 'c', ';', 'd', '=', '/[/]+/g', '.', 'test', '(', '`e ${f}`', ')']
+    """
+
+    match_token = TOKEN_PATTERN.match
+    previous = None # (kind, text) of the last token
+    position = start
+    while position < end:
+        match = match_token(contents, position, end)
+        kind = match.lastgroup
+        if kind == 'punctuation' and match.group() == '/' and _starts_expression(previous):
+            match = REGEX_PATTERN.match(contents, position, end)
+            kind = 'regex'
+        position = match.end()
+        if kind == 'space' or kind == 'comment':
+            continue
+        text = match.group()
+        yield kind, text, match.start(), position
+        previous = (kind, text)
+
+def _starts_expression(previous):
+    """ Whether an expression may start after previous token (kind, text). """
+
+    if previous is None:
+        return True
+    kind, text = previous
+    if kind == 'name':
+        return text in REGEX_PRECEDING_KEYWORDS
+    if kind == 'punctuation':
+        return text not in (')', ']', '}')
+    return False # strings, numbers and regular expressions
+
+def _get_first_string(contents, start, end):
+    """ Value of the first argument if a string literal, else None. """
+
+    first = next(_tokenize(contents, start, end), None)
+    if first is None or first[0] != 'string':
+        return None
+    return _get_string(first[1])
+
+def _get_string(text):
+    """ Value of a string token, None if unterminated or a template with expressions. """
+
+    if len(text) < 2 or text[0] != text[-1] or '${' in text:
+        return None
+    return text[1:-1]
+
+def _get_options(contents, start, end):
+    """ [region, authenticated, arguments] of the object literal passed to a client. """
+
+    region = None
+    authenticated = False
+    tokens = list(_tokenize(contents, start, end))
+    if tokens and tokens[0][1] == '{':
+        depth = 0
+        for index, (kind, text, token_start, token_end) in enumerate(tokens):
+            if kind == 'punctuation' and text in '([{':
+                depth += 1
+            elif kind == 'punctuation' and text in BRACKETS:
+                depth -= 1
+            elif depth == 1 and kind in ('name', 'string') and tokens[index - 1][1] in ('{', ','):
+                # a key of the options, e.g `region: VALUE` or `'region': VALUE` or `credentials` (shorthand)
+                key = _get_string(text) if kind == 'string' else text
+                if key in AUTH_KEYS:
+                    authenticated = True
+                elif key == 'region':
+                    region = _get_value(_get_property_value(tokens, index + 1))
+
+    arguments = contents[start:end] if region is not None or authenticated else None
+    return [region, authenticated, arguments]
+
+def _get_property_value(tokens, index):
+    """ Tokens of the value after `:` at index, up to the end of the property. """
+
+    if index >= len(tokens) or tokens[index][1] != ':':
+        return [] # shorthand
+    value_start = value_end = index + 1
+    depth = 0
+    while value_end < len(tokens):
+        kind, text = tokens[value_end][:2]
+        if kind == 'punctuation':
+            if text in '([{':
+                depth += 1
+            elif text in BRACKETS:
+                if depth == 0:
+                    break
+                depth -= 1
+            elif text == ',' and depth == 0:
+                break
+        value_end += 1
+    return tokens[value_start:value_end]
+
+def _get_value(tokens):
+    """ ['string', value], ['environ', variable name] or ['unknown'] """
+
+    texts = [text for kind, text, start, end in tokens]
+    if len(tokens) == 1 and tokens[0][0] == 'string':
+        value = _get_string(texts[0])
+        if value is not None:
+            return ['string', value]
+    # process.env.VARIABLE or process.env['VARIABLE']
+    if texts[:3] == ['process', '.', 'env']:
+        if len(texts) == 5 and texts[3] == '.' and tokens[4][0] == 'name':
+            return ['environ', texts[4]]
+        if len(texts) == 6 and texts[3] == '[' and tokens[4][0] == 'string' and texts[5] == ']' and _get_string(texts[4]) is not None:
+            return ['environ', _get_string(texts[4])]
+    return ['unknown']
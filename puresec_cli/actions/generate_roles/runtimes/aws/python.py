@@ -1,3 +1,4 @@
+import json
 import pkg_resources
 import os
 import re
@@ -5,16 +6,21 @@ import subprocess
 
 from puresec_cli.utils import eprint, get_inner_parentheses
 from puresec_cli.actions.generate_roles.runtimes.aws.base import Base
-from puresec_cli.actions.generate_roles.runtimes.aws.python_api import PythonApi
+from puresec_cli.actions.generate_roles.runtimes.aws.python_api import PythonApi, SERVICE_INIT_METHODS
+from puresec_cli.matchers import ScanBudgetExceeded
 
 class PythonRuntime(Base, PythonApi):
     PYTHON_FILENAME_PATTERN = re.compile(r"\.py$", re.IGNORECASE)
+    # provided by the Lambda environment, yet often bundled with the function
+    EXCLUDED_PACKAGES = ('boto3', 'botocore', 's3transfer')
 
     def _walk(self, processor, *args, **kwargs):
         """
-        >>> from collections import namedtuple
         >>> from tests.mock import Mock
+        >>> from puresec_cli.actions.generate_roles.runtimes import base as runtime_base
+        >>> from puresec_cli.actions.generate_roles.runtimes.file_index import FileIndex
         >>> mock = Mock(__name__)
+        >>> mock.mock(runtime_base, 'open', lambda *args, **kwargs: mock.open(*args, **kwargs))
 
         >>> mock.mock(pkg_resources, 'resource_filename', "/path/to/list-dependencies.py")
 
@@ -22,12 +28,8 @@ class PythonRuntime(Base, PythonApi):
         >>> def processor(filename, contents, custom_positional, custom_keyword):
         ...     processed.append((filename, contents, custom_positional, custom_keyword))
 
-        >>> def stat(self, filename):
-        ...     return namedtuple('Stat', ('st_size',))(5*1024*1024 if filename == "/path/to/function/large-file" else 512)
-        >>> mock.mock(PythonRuntime, '_stat', stat)
-
         >>> mock.filesystem = {'': {'path': {'to': {'function': {
-        ...     'large-file': True,
+        ...     'large-file': 5*1024*1024,
         ...     'config': True,
         ...     'unreferenced': True,
         ... }}}}}
@@ -40,35 +42,69 @@ class PythonRuntime(Base, PythonApi):
         >>> PythonRuntime('/path/to/function', resource_properties={'Handler': "src/index.handler", 'Runtime': 'python2.7'}, provider=object()) \\
         ...     ._walk(processor, 'positional', custom_keyword='keyword')
         >>> mock.calls_for('subprocess.check_output')
-        ['python2.7', '/path/to/list-dependencies.py', '/path/to/function/src/index.py', '/path/to/function'], stderr=-2
+        ['python2.7', '/path/to/list-dependencies.py', '--exclude', 'boto3', '--exclude', 'botocore', '--exclude', 's3transfer', '/path/to/function/src/index.py', '/path/to/function'],
+            stderr=-2
         >>> processed
         [('/path/to/function/src/index.py', 'some code config large-file more code', 'positional', 'keyword'),
          ('/path/to/function/config', 'some config', 'positional', 'keyword')]
+
+        Without a handler, walking everything but the excluded packages (also from puresec.yml):
+        >>> class Provider:
+        ...     config = {'excluded_packages': ['numpy']}
+        >>> mock.filesystem = {'': {'path': {'to': {'function': {
+        ...     'config': True,
+        ...     'botocore': {'endpoints.json': True},
+        ...     'vendor': {'numpy': {'core.py': True}},
+        ... }}}}}
+        >>> processed = []
+        >>> PythonRuntime('/path/to/function', resource_properties={}, provider=Provider())._walk(processor, 'positional', custom_keyword='keyword')
+        >>> processed
+        [('/path/to/function/config', 'some config', 'positional', 'keyword')]
+        >>> FileIndex.INDEXES.clear()
         """
 
         if hasattr(self, '_dependencies'):
             # cached
             for filename in self._dependencies:
-                with open(filename, 'r', errors='replace') as file:
-                    processor(filename, file.read(), *args, **kwargs)
+                processor(filename, self._read_file(filename), *args, **kwargs)
             return
 
-        # getting main Python file (from Handler)
-        handler = self.resource_properties.get('Handler')
-        if not handler:
+        filename = self._get_handler_filename()
+        if filename is None:
             # dummy CloudFormation? walking everything
             super()._walk(processor, *args, **kwargs)
             return
-        module = '.'.join(handler.split('.')[0:-1]) # all except the last part which is the method
-        filename = os.path.abspath(os.path.join(self.root, "{}.py".format(module.replace('.', '/'))))
         if not os.path.exists(filename):
             return
 
+        dependencies = self._get_dependencies(filename)
+        self._dependencies = dependencies[:] # cache
+
+        # getting all non-dependency files (without excluded packages)
+        resources = [ # (abspath, filename)
+            (os.path.abspath(entry.path), entry.name)
+            for entry in self._get_file_index().files
+            if not PythonRuntime.PYTHON_FILENAME_PATTERN.search(entry.name) and entry.size < PythonRuntime.MAX_FILE_SIZE
+        ]
+
+        self._walk_dependencies(dependencies, resources, processor, *args, **kwargs)
+
+    def _get_handler_filename(self):
+        """ Main Python file (from Handler), None without a handler. """
+
+        handler = self.resource_properties.get('Handler')
+        if not handler:
+            return None
+        module = '.'.join(handler.split('.')[0:-1]) # all except the last part which is the method
+        return os.path.abspath(os.path.join(self.root, "{}.py".format(module.replace('.', '/'))))
+
+    def _list_dependencies(self, filename):
         # acquiring dependencies with the correct Python version using resources/list-dependencies.py script
         list_dependencies_script_path = pkg_resources.resource_filename('puresec_cli', 'resources/list-dependencies.py')
         python_executable = self.resource_properties['Runtime'] # e.g 'python2.7'
         try:
-            dependencies = subprocess.check_output([python_executable, list_dependencies_script_path, filename, self.root], stderr=subprocess.STDOUT)
+            excludes = [argument for package in self.excluded_packages for argument in ('--exclude', package)]
+            dependencies = subprocess.check_output([python_executable, list_dependencies_script_path] + excludes + [filename, self.root], stderr=subprocess.STDOUT)
         except FileNotFoundError:
             eprint("error: function runtime ({}) must be installed", python_executable)
             raise SystemExit(-1)
@@ -78,36 +114,81 @@ class PythonRuntime(Base, PythonApi):
 
         dependencies = dependencies.decode().split('\n')
         dependencies.pop() # last empty line
-        self._dependencies = dependencies[:] # cache
+        return dependencies
 
-        # getting all non-dependency files
-        resources = [] # (abspath, filename)
-        for path, dirs, filenames in os.walk(self.root):
-            paths_generator = (
-                (os.path.abspath(os.path.join(path, filename)), filename)
-                for filename in filenames
-                if not PythonRuntime.PYTHON_FILENAME_PATTERN.search(filename)
-            )
-            resources.extend(
-                paths_tuple for paths_tuple in paths_generator
-                if self._stat(paths_tuple[0]).st_size < PythonRuntime.MAX_FILE_SIZE
-            )
-
-        while dependencies:
-            filename = dependencies.pop(0)
-            with open(filename, 'r', errors='replace') as file:
-                # adding resources referenced by current file
-                used_resources_indexes = []
-                contents = file.read()
-                for index, (resource_abspath, resource_filename) in enumerate(resources):
-                    if resource_filename in contents:
-                        dependencies.append(resource_abspath)
-                        self._dependencies.append(resource_abspath)
-                        used_resources_indexes.append(index)
-                for index in reversed(used_resources_indexes):
-                    resources.pop(index)
-                # processing current file
-                processor(filename, contents, *args, **kwargs)
+    @classmethod
+    def prepare(cls, runtimes):
+        """ Lists the dependencies of all handlers with one list-dependencies.py process per Python version,
+        skipping handlers whose dependencies didn't change since a previous run.
+
+        Failures are left for _walk, which lists the dependencies of each handler on its own.
+
+        >>> import json
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> mock.mock(pkg_resources, 'resource_filename', "/path/to/list-dependencies.py")
+        >>> for function in ('a', 'b', 'c'):
+        ...     with mock.open("/path/to/{}/index.py".format(function), 'w') as f:
+        ...         f.write("some code") and None
+
+        >>> runtimes = [
+        ...     PythonRuntime('/path/to/a', resource_properties={'Handler': "index.handler", 'Runtime': 'python3.6'}, provider=object()),
+        ...     PythonRuntime('/path/to/b', resource_properties={'Handler': "index.handler", 'Runtime': 'python3.6'}, provider=object()),
+        ...     PythonRuntime('/path/to/c', resource_properties={'Handler': "index.handler", 'Runtime': 'python2.7'}, provider=object()),
+        ...     PythonRuntime('/path/to/d', resource_properties={'Handler': "index.handler", 'Runtime': 'python2.7'}, provider=object()),
+        ...     PythonRuntime('/path/to/e', resource_properties={}, provider=object()),
+        ... ]
+        >>> def check_output(command, input, stderr):
+        ...     return json.dumps([[script, script.replace('index.py', 'lib.py')] for script, path, excludes in json.loads(input.decode())]).encode()
+        >>> mock.mock(subprocess, 'check_output', check_output)
+
+        >>> PythonRuntime.prepare(runtimes)
+        >>> mock.calls_for('subprocess.check_output')
+        ['python2.7', '/path/to/list-dependencies.py', '--batch'], input=b'[["/path/to/c/index.py", ["/path/to/c"], ["boto3", "botocore", "s3transfer"]]]', stderr=-3
+        ['python3.6', '/path/to/list-dependencies.py', '--batch'],
+            input=b'[["/path/to/a/index.py", ["/path/to/a"], ["boto3", "botocore", "s3transfer"]], ["/path/to/b/index.py", ["/path/to/b"], ["boto3", "botocore", "s3transfer"]]]',
+            stderr=-3
+        >>> [runtime._resolved_dependencies for runtime in runtimes]
+        [['/path/to/a/index.py', '/path/to/a/lib.py'], ['/path/to/b/index.py', '/path/to/b/lib.py'], ['/path/to/c/index.py', '/path/to/c/lib.py'], None, None]
+
+        >>> mock.mock(None, 'eprint')
+        >>> mock.mock(subprocess, 'check_output', lambda command, input, stderr: b"not JSON")
+        >>> runtime = PythonRuntime('/path/to/a', resource_properties={'Handler': "index.handler", 'Runtime': 'python3.6'}, provider=object())
+        >>> PythonRuntime.prepare([runtime])
+        >>> mock.calls_for('eprint')
+        'warn: failed to list dependencies with {} for {} functions at once, listing them one by one:\\n{}', 'python3.6', 1, JSONDecodeError(...)
+        >>> runtime._resolved_dependencies
+        """
+
+        # { python executable: [(runtime, filename)] }
+        batches = {}
+        for runtime in runtimes:
+            filename = runtime._get_handler_filename()
+            if filename is None or not os.path.exists(filename):
+                continue
+            dependencies = runtime._get_cached_dependencies(filename)
+            if dependencies is not None:
+                # unchanged since a previous run
+                runtime._resolved_dependencies = dependencies
+            else:
+                batches.setdefault(runtime.resource_properties['Runtime'], []).append((runtime, filename))
+
+        list_dependencies_script_path = pkg_resources.resource_filename('puresec_cli', 'resources/list-dependencies.py')
+        for python_executable, batch in sorted(batches.items(), key=lambda item: item[0]):
+            try:
+                output = subprocess.check_output(
+                    [python_executable, list_dependencies_script_path, '--batch'],
+                    input=json.dumps([[filename, [runtime.root], runtime.excluded_packages] for runtime, filename in batch]).encode(),
+                    stderr=subprocess.DEVNULL,
+                )
+                results = json.loads(output.decode())
+            except (OSError, subprocess.CalledProcessError, ValueError) as e:
+                eprint("warn: failed to list dependencies with {} for {} functions at once, listing them one by one:\n{}", python_executable, len(batch), e)
+                continue
+            for (runtime, filename), dependencies in zip(batch, results):
+                runtime._resolved_dependencies = dependencies
+                runtime._set_cached_dependencies(filename, dependencies)
 
     # Processors
 
@@ -142,17 +223,20 @@ class PythonRuntime(Base, PythonApi):
         >>> pprint(normalize_dict(runtime._permissions))
         {'s3': {'default_region': {'default_account': {}}}}
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
 
         >>> runtime._get_services("filename.py", ".client('s3', region_name='localhost')")
         >>> pprint(normalize_dict(runtime._permissions))
         {'s3': {'default_region': {'default_account': {}}}}
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
 
         >>> runtime._get_services("filename.py", ".client('s3', region_name='us-east-1')")
         >>> pprint(normalize_dict(runtime._permissions))
         {'s3': {'us-east-1': {'default_account': {}}}}
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.py", '''
         ... boto3. \\
         ...     client('s3',
@@ -163,6 +247,7 @@ class PythonRuntime(Base, PythonApi):
         {'s3': {'us-east-1': {'default_account': {}}}}
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.py", '''
         ... boto3.
         ...     client('s3',
@@ -175,6 +260,7 @@ class PythonRuntime(Base, PythonApi):
         >>> mock.mock(None, 'eprint')
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.py", '''
         ... boto3.
         ...     client('s3',
@@ -187,6 +273,7 @@ class PythonRuntime(Base, PythonApi):
         'warn: incomprehensive region: {} (in {})', "'s3',\\n        region_name=getRegion()\\n    ", 'filename.py'
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.py", '''
         ... boto3.
         ...     client('s3',
@@ -199,6 +286,7 @@ class PythonRuntime(Base, PythonApi):
         'warn: incomprehensive region: {} (in {})', "'s3',\\n        region_name='us-' + region\\n    ", 'filename.py'
 
         >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
         >>> runtime._get_services("filename.py", '''
         ... boto3.
         ...     client('s3',
@@ -209,36 +297,94 @@ class PythonRuntime(Base, PythonApi):
         {'s3': {'default_region': {'*': {}}}}
         >>> mock.calls_for('eprint')
         'warn: unknown account: {} (in {})', "'s3',\\n        aws_access_key_id='some key'\\n    ", 'filename.py'
+
+        >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
+        >>> runtime._get_services("filename.py", "import boto3, os\\ns3 = boto3.client('s3', region_name=os.environ['REGION'])\\n")
+        >>> pprint(normalize_dict(runtime._permissions))
+        {'s3': {'*': {'default_account': {}}}}
+        >>> mock.calls_for('eprint')
+        'warn: incomprehensive region: {} (in {})', "'s3', region_name=os.environ['REGION']", 'filename.py'
+
+        Budget exceeded while indexing the file:
+        >>> runtime._permissions.clear()
+        >>> runtime._file_index.clear()
+        >>> runtime.scan_budget = 10
+        >>> from puresec_cli.actions.generate_roles.runtimes.aws import base as aws_base
+        >>> mock.mock(aws_base, 'eprint')
+        >>> mock.mock(runtime, '_get_scan_deadline', 0)
+        >>> runtime._get_services("filename.py", "import boto3\\ns3 = boto3.client('s3')\\n")
+        >>> pprint(normalize_dict(runtime._permissions))
+        {'s3': {'*': {'*': {}}}}
+        >>> mock.calls_for('puresec_cli.actions.generate_roles.runtimes.aws.base.eprint')
+        "warn: scan budget of {} seconds exceeded (in {}), falling back to '*'", 10, 'filename.py'
         """
 
         if not PythonRuntime.PYTHON_FILENAME_PATTERN.search(filename):
             return
 
-        for service, pattern in PythonApi.SERVICE_CALL_PATTERNS:
-            for service_match in pattern.finditer(contents):
-                arguments = get_inner_parentheses(service_match.group(1))
-                if arguments:
-                    # region
-                    region = self._get_variable_from_arguments(arguments, PythonRuntime.REGION_PATTERN)
-                    if region is None or region == 'localhost':
-                        region = self.provider.default_region
-                    elif not region:
-                        eprint("warn: incomprehensive region: {} (in {})", arguments, filename)
-                        region = '*'
-                    elif not any(pattern.match(region) for pattern in PythonRuntime.REGION_PATTERNS.values()):
-                        eprint("warn: incomprehensive region: {} (in {})", arguments, filename)
-                        region = '*'
-                    # account
-                    if PythonRuntime.AUTH_PATTERN.search(arguments):
-                        eprint("warn: unknown account: {} (in {})", arguments, filename)
-                        account = '*'
-                    else:
-                        account = self.provider.default_account
-                else:
-                    region = self.provider.default_region
-                    account = self.provider.default_account
-
-                self._permissions[service][region][account] # accessing to initialize defaultdict
+        # [(service, region - see _get_variable_from_arguments, authenticated, arguments)]
+        try:
+            call_index = self._get_call_index(filename, contents)
+            if call_index is not None:
+                service_calls = [
+                    (service, self._get_variable_from_value(region), authenticated, arguments)
+                    for service, region, authenticated, arguments in call_index['services']
+                ]
+            else:
+                service_calls = [
+                    (
+                        service,
+                        self._get_variable_from_arguments(arguments, PythonRuntime.REGION_PATTERN) if arguments else None,
+                        bool(arguments) and PythonRuntime.AUTH_PATTERN.search(arguments) is not None,
+                        arguments,
+                    )
+                    for service, arguments in self._get_cached(filename, contents, 'service_calls',
+                                                               lambda: self._get_service_calls(contents, self._get_scan_deadline(filename)))
+                ]
+        except ScanBudgetExceeded:
+            self._set_any_services(filename, contents, PythonApi.SERVICE_CALL_MATCHERS)
+            return
+
+        for service, region, authenticated, arguments in service_calls:
+            # region
+            if region is None or region == 'localhost':
+                region = self.provider.default_region
+            elif not region:
+                eprint("warn: incomprehensive region: {} (in {})", arguments, filename)
+                region = '*'
+            elif not self._is_region(region):
+                eprint("warn: incomprehensive region: {} (in {})", arguments, filename)
+                region = '*'
+            # account
+            if authenticated:
+                eprint("warn: unknown account: {} (in {})", arguments, filename)
+                account = '*'
+            else:
+                account = self.provider.default_account
+
+            self._permissions[service][region][account] # accessing to initialize defaultdict
+
+    def _get_service_calls(self, contents, deadline=None):
+        """ [(service, arguments within parentheses or None)]
+
+        Matchers only run over contents containing their literals, a substring search rejects most files at once.
+        deadline: see CallMatcher.finditer
+
+        >>> runtime = PythonRuntime('path/to/function', resource_properties={}, provider=object())
+        >>> runtime._get_service_calls("boto3.client('s3') boto3.resource('dynamodb', region_name='us-east-1')")
+        [('dynamodb', "'dynamodb', region_name='us-east-1'"), ('s3', "'s3'")]
+        >>> runtime._get_service_calls("s3 = 'dynamodb'")
+        []
+        """
+
+        if not any(method in contents for method in SERVICE_INIT_METHODS):
+            return []
+        return [
+            (service, get_inner_parentheses(arguments))
+            for service, matcher in PythonApi.SERVICE_CALL_MATCHERS
+            for arguments in matcher.finditer(contents, deadline)
+        ]
 
     def _get_regions(self, filename, contents, regions, service, account):
         processor = PythonRuntime.SERVICE_REGIONS_PROCESSOR.get(service)
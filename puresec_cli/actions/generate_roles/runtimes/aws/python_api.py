@@ -2,17 +2,32 @@
 
 from functools import partial
 from itertools import chain
+from puresec_cli.actions.generate_roles.runtimes.aws.base_api import index_action_calls
+from puresec_cli.actions.generate_roles.runtimes.aws.python_calls import get_call_index
+from puresec_cli.matchers import CallMatcher, ScanBudgetExceeded
 from puresec_cli.utils import snakecase
 import re
 
-CALL_PATTERN_TEMPLATE = r"\.[\s\\]*{0}(\(.{{0,512}})" # .VALUE(OUTPUT... including opening parantheses and 512 characters after
-SERVICE_INIT_PATTERN = r"\.[\s\\]*(?:client|resource)(\([\s\\]*['\"]{0}['\"].{{0,512}})" # .client('VALUE'OUTPUT... or .resource("VALUE"OUTPUT...
-# .VALUE(OUTPUT) or .generate_presigned_url('VALUE'OUTPUT) including opening paranthesis and 512 characters after
-SIGNED_URL_PATTERN_TEMPLATE = r"{0}|\.[\s\\]*generate_presigned_url(\([\s\\]*['\"]{{0}}['\"].{{{{0,512}}}})".format(CALL_PATTERN_TEMPLATE)
+SERVICE_INIT_METHODS = ('client', 'resource') # .client('VALUE'OUTPUT... or .resource("VALUE"OUTPUT...
+SIGNED_URL_METHOD = 'generate_presigned_url'
+CALL_TOKEN_PATTERN = re.compile(r"\.[\s\\]*(\w+)\(") # .VALUE(
+SIGNED_URL_TOKEN_PATTERN = re.compile(r"\.[\s\\]*generate_presigned_url\([\s\\]*['\"](\w+)['\"]") # .generate_presigned_url('VALUE'
+
+def signed_url_token(method):
+    return "{}('{}')".format(SIGNED_URL_METHOD, method)
+
+def call(method):
+    """ Call tokens of .method(...) """
+    return (method,)
+
+def signed_url_call(method):
+    """ Call tokens of .method(...) or .generate_presigned_url('method', ...) """
+    return (method, signed_url_token(method))
 
 class PythonApi:
-    SERVICE_CALL_PATTERNS = [
-        (name, re.compile(SERVICE_INIT_PATTERN.format(client_name), re.MULTILINE | re.DOTALL))
+    # [(service, CallMatcher)]
+    SERVICE_CALL_MATCHERS = [
+        (name, CallMatcher(SERVICE_INIT_METHODS, first_argument=client_name, line_continuation=True))
         for name, client_name in (
                 ('dynamodb', r"dynamodb"),
                 ('kinesis', r"kinesis"),
@@ -25,6 +40,11 @@ class PythonApi:
         )
     ]
 
+    # { client name: service }
+    SERVICE_CLIENT_NAMES = dict((matcher.first_argument, service) for service, matcher in SERVICE_CALL_MATCHERS)
+    # 'VALUE' or "VALUE" of any client name, within every file constructing a service
+    SERVICE_CLIENT_NAME_PATTERN = re.compile(r"['\"](?:{})['\"]".format('|'.join(re.escape(name) for name in sorted(SERVICE_CLIENT_NAMES))))
+
     SERVICE_ACTIONS_PROCESSOR = {
         # service: function(self, filename, contents, actions)
         'dynamodb': lambda self: partial(self._get_generic_actions, service='dynamodb'),
@@ -37,12 +57,12 @@ class PythonApi:
         'states':   lambda self: partial(self._get_generic_actions, service='states'),
     }
 
-    # { service: (action, pattern) }
-    ACTION_CALL_PATTERNS = {
+    # { service: ((action, call tokens)) }
+    ACTION_CALLS = {
         'dynamodb': tuple(
             (
                 "dynamodb:{}".format(action),
-                re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                signed_url_call(snakecase(action))
             )
             for action in (
                     'BatchGetItem', 'BatchWriteItem', 'CreateTable', 'DeleteItem', 'DeleteTable',
@@ -54,7 +74,7 @@ class PythonApi:
         'kinesis': tuple(
             (
                 "kinesis:{}".format(action),
-                re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                signed_url_call(snakecase(action))
             )
             for action in (
                     'AddTagsToStream', 'CreateStream', 'DecreaseStreamRetentionPeriod', 'DeleteStream', 'DescribeLimits',
@@ -67,7 +87,7 @@ class PythonApi:
             (
                 (
                     "kms:{}".format(action),
-                    re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                    signed_url_call(snakecase(action))
                 )
                 for action in (
                         'CancelKeyDeletion', 'CreateAlias', 'CreateGrant', 'CreateKey', 'Decrypt',
@@ -78,7 +98,7 @@ class PythonApi:
                         'PutKeyPolicy', 'RevokeGrant', 'ScheduleKeyDeletion', 'UpdateAlias', 'UpdateKeyDescription',
                 )
             ), (
-                ("kms:{}".format(action), re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("kms:{}".format(action), signed_url_call(method))
                 for action, method in (
                         ('ReEncryptFrom', 're_encrypt'),
                         ('ReEncryptTo', 're_encrypt'),
@@ -89,7 +109,7 @@ class PythonApi:
             (
                 (
                     "lambda:{}".format(action),
-                    re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                    signed_url_call(snakecase(action))
                 )
                 for action in (
                         'AddPermission', 'CreateAlias', 'CreateEventSourceMapping', 'CreateFunction', 'DeleteAlias',
@@ -99,7 +119,7 @@ class PythonApi:
                         'UpdateAlias', 'UpdateEventSourceMapping', 'UpdateFunctionCode', 'UpdateFunctionConfiguration',
                 )
             ), (
-                ("lambda:{}".format(action), re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("lambda:{}".format(action), signed_url_call(method))
                 for action, method in (
                         ('InvokeFunction', 'invoke'),
                 )
@@ -109,7 +129,7 @@ class PythonApi:
             (
                 (
                     "s3:{}".format(action),
-                    re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                    signed_url_call(snakecase(action))
                 )
                 for action in (
                         'AbortMultipartUpload', 'CreateBucket', 'DeleteBucket', 'DeleteBucketPolicy', 'DeleteBucketWebsite',
@@ -121,7 +141,7 @@ class PythonApi:
                         'PutObjectTagging', 'RestoreObject',
                 )
             ), (
-                ("s3:{}".format(action), re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("s3:{}".format(action), signed_url_call(method))
                 for action, method in (
                         ('DeleteObject', 'delete_objects'),
                         ('DeleteReplicationConfiguration', 'delete_bucket_replication'),
@@ -178,7 +198,7 @@ class PythonApi:
             (
                 (
                     "ses:{}".format(action),
-                    re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                    signed_url_call(snakecase(action))
                 )
                 for action in (
                         'CloneReceiptRuleSet', 'CreateReceiptFilter', 'CreateReceiptRule', 'CreateReceiptRuleSet', 'DeleteIdentity',
@@ -191,7 +211,7 @@ class PythonApi:
                         'VerifyDomainDkim', 'VerifyDomainIdentity', 'VerifyEmailAddress', 'VerifyEmailIdentity',
                 )
             ), (
-                ("ses:{}".format(action), re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(method), re.MULTILINE | re.DOTALL))
+                ("ses:{}".format(action), signed_url_call(method))
                 for action, method in (
                         #('CreateConfigurationSet'),
                         #('CreateConfigurationSetEventDestination'),
@@ -209,7 +229,7 @@ class PythonApi:
         'sns': tuple(
             (
                 "sns:{}".format(action),
-                re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                signed_url_call(snakecase(action))
             )
             for action in (
                     'AddPermission', 'CheckIfPhoneNumberIsOptedOut', 'ConfirmSubscription', 'CreatePlatformApplication', 'CreatePlatformEndpoint',
@@ -223,7 +243,7 @@ class PythonApi:
         'states': tuple(
             (
                 "states:{}".format(action),
-                re.compile(SIGNED_URL_PATTERN_TEMPLATE.format(snakecase(action)), re.MULTILINE | re.DOTALL)
+                signed_url_call(snakecase(action))
             )
             for action in (
                     'CreateActivity', 'CreateStateMachine', 'DeleteActivity', 'DeleteStateMachine', 'DescribeActivity',
@@ -234,10 +254,13 @@ class PythonApi:
         ),
     }
 
-    def _get_generic_actions(self, filename, contents, actions, service, patterns=None):
+    # { service: { call token: {actions} } }
+    ACTION_CALL_TOKENS = index_action_calls(ACTION_CALLS)
+
+    def _get_generic_actions(self, filename, contents, actions, service):
         """
-        >>> from io import StringIO
-        >>> runtime = PythonApi()
+        >>> from puresec_cli.actions.generate_roles.runtimes.aws.python import PythonRuntime
+        >>> runtime = PythonRuntime('path/to/function', resource_properties={}, provider=object())
 
         >>> actions = set()
         >>> runtime._get_generic_actions("path/to/file.py", "code .put_item() code", actions, service='dynamodb')
@@ -245,13 +268,56 @@ class PythonApi:
         ['dynamodb:PutItem']
 
         >>> actions = set()
-        >>> runtime._get_generic_actions("path/to/file.py", "code .put_object(params) .generate_presigned_url('get_object', params) code", actions, service='s3')
+        >>> runtime._get_generic_actions("path/to/other.py", "code .put_object(params) .generate_presigned_url('get_object', params) code", actions, service='s3')
         >>> sorted(actions)
         ['s3:GetObject', 's3:PutObject']
         """
-        if patterns is None:
-            patterns = PythonApi.ACTION_CALL_PATTERNS[service]
-        for action, pattern in patterns:
-            if pattern.search(contents):
-                actions.add(action)
 
+        action_call_tokens = PythonApi.ACTION_CALL_TOKENS[service]
+        try:
+            call_index = self._get_call_index(filename, contents)
+        except ScanBudgetExceeded:
+            call_index = None # the regular expressions are linear to the contents anyway
+        if call_index is not None:
+            tokens = call_index['calls']
+        else:
+            tokens = self._get_indexed(filename, 'call_tokens', lambda: self._get_call_tokens(contents))
+        for token in tokens:
+            actions.update(action_call_tokens.get(token, ()))
+
+    def _get_call_index(self, filename, contents):
+        """ Services and calls from parsing the file (see get_call_index), None if not valid Python - regular expressions
+        are used instead.
+
+        Parsing costs far more than the regular expressions, so only files that might construct a service are parsed.
+
+        >>> from pprint import pprint
+        >>> from puresec_cli.actions.generate_roles.runtimes.aws.python import PythonRuntime
+        >>> runtime = PythonRuntime('path/to/function', resource_properties={}, provider=object())
+
+        >>> pprint(runtime._get_call_index("path/to/file.py", "boto3.client('stepfunctions').start_execution()"))
+        {'calls': ['client', 'start_execution'], 'services': [['states', None, False, None]]}
+        >>> runtime._get_call_index("path/to/other.py", "boto3.client('stepfunctions') ) (")
+        >>> runtime._get_call_index("path/to/another.py", "table.put_item()")
+        """
+
+        def get_file_call_index():
+            if not any(method in contents for method in SERVICE_INIT_METHODS):
+                return False
+            if not PythonApi.SERVICE_CLIENT_NAME_PATTERN.search(contents):
+                return False
+            # False for invalid sources too, as None is a miss of the analysis cache
+            return get_call_index(contents, PythonApi.SERVICE_CLIENT_NAMES, SERVICE_INIT_METHODS, SIGNED_URL_METHOD, self._get_scan_deadline(filename)) or False
+
+        return self._get_cached(filename, contents, 'call_index', get_file_call_index) or None
+
+    def _get_call_tokens(self, contents):
+        """ Tokenizes the contents once into all method calls, so that matching actions is a lookup.
+
+        >>> sorted(PythonApi()._get_call_tokens("code .put_object(params) .generate_presigned_url('get_object', params) code"))
+        ['generate_presigned_url', "generate_presigned_url('get_object')", 'put_object']
+        """
+
+        tokens = set(match.group(1) for match in CALL_TOKEN_PATTERN.finditer(contents))
+        tokens.update(signed_url_token(match.group(1)) for match in SIGNED_URL_TOKEN_PATTERN.finditer(contents))
+        return tokens
@@ -0,0 +1,190 @@
+""" Index of AWS SDK usage within Python sources, from a single parse of each file. """
+
+from puresec_cli.matchers import check_deadline
+import ast
+
+# keyword arguments of clients and resources with other credentials, possibly of another account
+AUTH_KEYWORDS = frozenset(('aws_access_key_id', 'aws_secret_access_key', 'aws_session_token'))
+
+def get_call_index(contents, client_names, init_methods, signed_url_method, deadline=None):
+    """ Parses contents once into the service constructions and method calls, None if it isn't valid Python.
+
+    client_names: { client name (e.g 'stepfunctions'): service (e.g 'states') }
+    init_methods: methods constructing a service (e.g 'client' and 'resource')
+    signed_url_method: method getting a signed URL of another method, a call token of its own (e.g 'generate_presigned_url')
+    deadline: time.monotonic() value, raising ScanBudgetExceeded once passed - checked after parsing and while walking
+        the nodes, the parse itself can't be interrupted
+
+    Returns (JSON-serializable):
+        'services': [[service, region, authenticated, arguments]]
+            region: None if not given, ['string', value], ['environ', variable name] or ['unknown']
+            arguments: source of the call's arguments (for warnings), None without region and authentication
+        'calls': [call token] - called methods, and signed_url_method('method') for signed URLs
+
+    >>> from pprint import pprint
+    >>> pprint(get_call_index('''
+    ... import boto3, os
+    ... s3 = boto3.client('s3')
+    ... table = boto3.resource(service_name='dynamodb', region_name=os.environ.get('REGION')).Table('table')
+    ... sfn = boto3.client("stepfunctions", region_name='x', aws_access_key_id=k)
+    ... sns = boto3.client('sns', region_name=get_region())
+    ... other = boto3.client('other')
+    ... # boto3.client('kms')
+    ... def handler(event, context):
+    ...     table.put_item(Item={})
+    ...     s3.generate_presigned_url('get_object', Params={})
+    ...     s3.generate_presigned_url(ClientMethod='put_object')
+    ... ''', {'s3': 's3', 'dynamodb': 'dynamodb', 'stepfunctions': 'states', 'sns': 'sns', 'kms': 'kms'},
+    ... ('client', 'resource'), 'generate_presigned_url'))
+    {'calls': ['Table',
+               'client',
+               'generate_presigned_url',
+               "generate_presigned_url('get_object')",
+               "generate_presigned_url('put_object')",
+               'get',
+               'put_item',
+               'resource'],
+     'services': [['s3', None, False, None],
+                  ['dynamodb', ['environ', 'REGION'], False, "service_name='dynamodb', region_name=os.environ.get('REGION')"],
+                  ['states', ['string', 'x'], True, '"stepfunctions", region_name=\\'x\\', aws_access_key_id=k'],
+                  ['sns', ['unknown'], False, "'sns', region_name=get_region()"]]}
+
+    >>> get_call_index("boto3.\\n    client('s3')", {'s3': 's3'}, ('client', 'resource'), 'generate_presigned_url')
+
+    >>> from puresec_cli.matchers import ScanBudgetExceeded
+    >>> try:
+    ...     get_call_index("boto3.client('s3')", {'s3': 's3'}, ('client', 'resource'), 'generate_presigned_url', deadline=0)
+    ... except ScanBudgetExceeded:
+    ...     print("exceeded")
+    exceeded
+    """
+
+    try:
+        tree = ast.parse(contents)
+    except (SyntaxError, ValueError, MemoryError, RuntimeError): # RuntimeError: too deeply nested (RecursionError)
+        return None
+
+    check_deadline(deadline)
+
+    services = []
+    calls = set()
+    source = _Source(contents)
+    # ast.walk is breadth-first, sorting by position for the order of the source
+    for node in sorted(_get_calls(tree, deadline), key=_get_position):
+        if not isinstance(node.func, ast.Attribute):
+            continue
+        method = node.func.attr
+        calls.add(method)
+
+        if method == signed_url_method:
+            signed_method = _get_argument(node, 0, 'ClientMethod')
+            if signed_method is not None:
+                calls.add("{}('{}')".format(signed_url_method, signed_method))
+
+        elif method in init_methods:
+            service = client_names.get(_get_argument(node, 0, 'service_name'))
+            if service is None:
+                continue
+            keywords = dict((keyword.arg, keyword.value) for keyword in node.keywords if keyword.arg)
+            region = _get_value(keywords['region_name']) if 'region_name' in keywords else None
+            authenticated = not AUTH_KEYWORDS.isdisjoint(keywords)
+            arguments = source.get_arguments(node) if authenticated or region is not None else None
+            services.append([service, region, authenticated, arguments])
+
+    return {
+        'services': services,
+        'calls': sorted(calls),
+    }
+
+def _get_calls(tree, deadline):
+    """ Yields the ast.Call nodes, checking the deadline every few thousand nodes. """
+
+    for count, node in enumerate(ast.walk(tree)):
+        if not count & 0xfff:
+            check_deadline(deadline)
+        if isinstance(node, ast.Call):
+            yield node
+
+def _get_position(node):
+    return (node.lineno, node.col_offset)
+
+def _get_string(node):
+    """ Value of a string literal, None for other nodes. """
+
+    # ast.Str up to Python 3.7, ast.Constant since
+    node_type = type(node).__name__
+    if node_type == 'Str':
+        return node.s
+    if node_type == 'Constant' and isinstance(node.value, str):
+        return node.value
+    return None
+
+def _get_argument(call, index, name):
+    """ String literal of a positional (at index) or keyword (name) argument, None if not given or not a literal. """
+
+    if len(call.args) > index:
+        return _get_string(call.args[index])
+    for keyword in call.keywords:
+        if keyword.arg == name:
+            return _get_string(keyword.value)
+    return None
+
+def _get_value(node):
+    """ ['string', value], ['environ', variable name] or ['unknown'] """
+
+    value = _get_string(node)
+    if value is not None:
+        return ['string', value]
+
+    variable = None
+    if isinstance(node, ast.Subscript) and _is_attribute(node.value, 'os', 'environ'):
+        # os.environ['VARIABLE'] - an Index node up to Python 3.8
+        index = node.slice.value if type(node.slice).__name__ == 'Index' else node.slice
+        variable = _get_string(index)
+    elif isinstance(node, ast.Call) and node.args and (
+            _is_attribute(node.func, 'os', 'getenv') or # os.getenv('VARIABLE', ...)
+            (isinstance(node.func, ast.Attribute) and node.func.attr == 'get' and _is_attribute(node.func.value, 'os', 'environ')) # os.environ.get('VARIABLE', ...)
+    ):
+        variable = _get_string(node.args[0])
+    if variable is not None:
+        return ['environ', variable]
+
+    return ['unknown']
+
+def _is_attribute(node, name, attribute):
+    """ Whether node is `name.attribute` """
+    return isinstance(node, ast.Attribute) and node.attr == attribute and isinstance(node.value, ast.Name) and node.value.id == name
+
+class _Source:
+    """ Text of nodes within the source, for warnings. """
+
+    def __init__(self, contents):
+        self.contents = contents
+        self._line_offsets = None
+
+    def get_arguments(self, call):
+        """ Text within the parentheses of a call - the whole line of the call before Python 3.8 (no end positions). """
+
+        func_end = self._get_offset(getattr(call.func, 'end_lineno', None), getattr(call.func, 'end_col_offset', None))
+        call_end = self._get_offset(getattr(call, 'end_lineno', None), getattr(call, 'end_col_offset', None))
+        if func_end is None or call_end is None:
+            return self.contents.split('\n')[call.lineno - 1].strip()
+        arguments = self.contents[func_end:call_end].strip()
+        # within the parentheses
+        return arguments[1:-1]
+
+    def _get_offset(self, lineno, col_offset):
+        """ Offset within contents of a node position (col_offset counts UTF-8 bytes). """
+
+        if lineno is None or col_offset is None:
+            return None
+        if self._line_offsets is None:
+            # contents are read with universal newlines, same lines as the parser's
+            self._line_offsets = [0]
+            offset = self.contents.find('\n')
+            while offset != -1:
+                self._line_offsets.append(offset + 1)
+                offset = self.contents.find('\n', offset + 1)
+        line_start = self._line_offsets[lineno - 1]
+        line = self.contents[line_start:line_start + col_offset] # at most col_offset characters for col_offset bytes
+        return line_start + len(line.encode('utf-8')[:col_offset].decode('utf-8', 'ignore'))
@@ -1,8 +1,12 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 import abc
+import locale
 import os
 
 from puresec_cli import stats
+from puresec_cli.actions.generate_roles.runtimes.file_index import FileIndex
+from puresec_cli.actions.generate_roles.runtimes.ignore import IGNORE_FILENAME, IgnoreRules
+from puresec_cli.matchers import KeywordMatcher
 
 class Base:
     __metaclass__ = abc.ABCMeta
@@ -14,12 +18,21 @@ class Base:
         self.root = root
         self.provider = provider
 
+    @classmethod
+    def prepare(cls, runtimes):
+        """ Called once with all the runtimes of this class before processing them, for sharing work between functions. """
+        pass
+
+    # larger files are not kept in memory, but streamed in chunks (see _read_chunks)
     MAX_FILE_SIZE = 5 * 1024 * 1024 # 5MB
+    CHUNK_SIZE = 1024 * 1024 # 1MB
+    # longer than any match the processors look for (e.g calls with `.{0,512}` of arguments)
+    CHUNK_OVERLAP = 4 * 1024 # 4KB
 
     # processor: function(filename, contents, *args, **kwargs)
+    # contents is None for files larger than MAX_FILE_SIZE, read with _read_chunks(filename) instead
     def _walk(self, processor, *args, **kwargs):
         """
-        >>> from collections import namedtuple
         >>> from tests.mock import Mock
         >>> mock = Mock(__name__)
 
@@ -31,7 +44,7 @@ class Base:
         >>> mock.filesystem = {'path': {'to': {'function': {
         ...     'a': True,
         ...     'b': {'c': True, 'd': True},
-        ...     'e': True,
+        ...     'e': 5*1024*1024,
         ... }}}}
         >>> with mock.open("path/to/function/a", 'w') as f:
         ...     f.write("a content") and None
@@ -42,26 +55,216 @@ class Base:
 
         >>> runtime = Runtime('path/to/function', None)
 
-        >>> def stat(filename):
-        ...     return namedtuple('Stat', ('st_size',))(5*1024*1024 if filename == "path/to/function/e" else 512)
-        >>> mock.mock(runtime, '_stat', stat)
-
         >>> runtime._walk(runtime.processor, 'positional', custom_keyword='keyword')
         >>> sorted(processed)
         [('path/to/function/a', 'a content', 'positional', 'keyword'),
          ('path/to/function/b/c', 'c content', 'positional', 'keyword'),
-         ('path/to/function/b/d', 'd content', 'positional', 'keyword')]
+         ('path/to/function/b/d', 'd content', 'positional', 'keyword'),
+         ('path/to/function/e', None, 'positional', 'keyword')]
+        >>> FileIndex.INDEXES.clear()
+        """
+
+        for entry in self._get_file_index().files:
+            # skipping symlinks and hardlinks to files already processed
+            if entry.duplicate:
+                continue
+
+            if entry.size >= Base.MAX_FILE_SIZE:
+                processor(entry.path, None, *args, **kwargs)
+                continue
+            processor(entry.path, self._read_file(entry.path), *args, **kwargs)
+
+    def _read_file(self, filename):
+        """ Contents of filename, None if larger than MAX_FILE_SIZE. """
+
+        with open(filename, 'rb') as file:
+            data = file.read(Base.MAX_FILE_SIZE)
+            if file.read(1):
+                return None
+        return self._decode(filename, data)
+
+    def _decode(self, filename, data):
+        """ Raw bytes of filename to text, same as reading it in text mode (locale encoding, universal newlines) - but
+        decoded at once, with the raw bytes still at hand for subclasses (e.g digests).
+
+        >>> Base('path/to/function', None)._decode('path/to/function/a', b"a\\r\\nb\\rc\\n")
+        'a\\nb\\nc\\n'
+        """
+
+        contents = data.decode(locale.getpreferredencoding(False), 'replace')
+        if '\r' in contents:
+            contents = contents.replace('\r\n', '\n').replace('\r', '\n')
+        return contents
+
+    def _read_chunks(self, filename):
+        """ Contents of filename in pieces of about CHUNK_SIZE, keeping memory bounded for large files.
+
+        Each piece starts with the last CHUNK_OVERLAP characters of the previous one, so that a match shorter than the
+        overlap is always whole within one of them. Pieces end after a line or a statement (';') when possible.
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+        >>> mock.mock(Base, 'CHUNK_SIZE', 16)
+        >>> mock.mock(Base, 'CHUNK_OVERLAP', 4)
+        >>> with mock.open("path/to/function/bundle.js", 'w') as f:
+        ...     f.write("a.s3({x: 1});\\nb.sns({y: 2}); c.sqs({z: 3});") and None
+
+        >>> list(Base('path/to/function', None)._read_chunks("path/to/function/bundle.js"))
+        ['a.s3({x: 1});\\n', '});\\nb.sns({y: 2});', '2}); c.sqs({z: 3});']
         """
 
-        for path, dirs, filenames in os.walk(self.root):
-            for filename in filenames:
-                filename = os.path.join(path, filename)
+        with open(filename, 'r', errors='replace') as file:
+            overlap = ''
+            pending = '' # read after the end of the previous piece
+            while True:
+                data = file.read(Base.CHUNK_SIZE)
+                if not data:
+                    if pending:
+                        yield overlap + pending
+                    return
+                data = pending + data
+                # ending after the last line or statement within the second half
+                end = max(data.rfind('\n', len(data) // 2), data.rfind(';', len(data) // 2)) + 1 or len(data)
+                chunk = overlap + data[:end]
+                pending = data[end:]
+                overlap = chunk[-Base.CHUNK_OVERLAP:]
+                yield chunk
+
+    def _get_file_index(self):
+        return FileIndex.get(self.root, self.ignore_rules)
+
+    @property
+    def ignore_rules(self):
+        """ From .puresecignore of the project and of the function, and from `ignore` in puresec.yml (relative to the project).
+
+        >>> from tempfile import TemporaryDirectory
+        >>> directory = TemporaryDirectory()
+        >>> project_root = os.path.join(directory.name, 'project')
+        >>> os.makedirs(os.path.join(project_root, 'function'))
+        >>> with open(os.path.join(project_root, '.puresecignore'), 'w') as f:
+        ...     f.write("*.md\\n") and None
+        >>> with open(os.path.join(project_root, 'function', '.puresecignore'), 'w') as f:
+        ...     f.write("!README.md\\n") and None
+
+        >>> class Provider:
+        ...     path = project_root
+        ...     config = {'ignore': ["/tests"]}
+        >>> class Runtime(Base):
+        ...     pass
+        >>> ignore_rules = Runtime(os.path.join(project_root, 'function'), Provider()).ignore_rules
+        >>> ignore_rules.is_ignored(os.path.join(project_root, 'function', 'CHANGES.md'), False)
+        True
+        >>> ignore_rules.is_ignored(os.path.join(project_root, 'function', 'README.md'), False)
+        False
+        >>> ignore_rules.is_ignored(os.path.join(project_root, 'tests'), True)
+        True
+        >>> ignore_rules.is_ignored(os.path.join(project_root, 'function', 'tests'), True)
+        False
+
+        >>> directory.cleanup()
+        """
+
+        if not hasattr(self, '_ignore_rules'):
+            self._ignore_rules = IgnoreRules()
+            project_root = getattr(self.provider, 'path', None)
+            if project_root is not None:
+                if os.path.abspath(project_root) != os.path.abspath(self.root):
+                    self._ignore_rules.add_file(os.path.join(project_root, IGNORE_FILENAME), base=project_root)
+                config = getattr(self.provider, 'config', None) or {}
+                patterns = config.get('ignore') or ()
+                if isinstance(patterns, str):
+                    patterns = patterns.splitlines()
+                self._ignore_rules.add_patterns(patterns, base=project_root)
+            self._ignore_rules.add_file(os.path.join(self.root, IGNORE_FILENAME), base=self.root)
+        return self._ignore_rules
+
+    # the automaton of KeywordMatcher takes about as long as 100 substring checks (`in`) over the same text
+    MAX_SUBSTRING_RESOURCES = 100
+
+    def _walk_dependencies(self, dependencies, resources, processor, *args, **kwargs):
+        """ Processes the dependencies, and the resources their contents reference by filename (e.g configuration files).
+
+        dependencies: [abspath], resources: [(abspath, filename)]
+        Referenced resources are appended to self._dependencies, and are also searched for further references.
+
+        >>> from tests.mock import Mock
+        >>> mock = Mock(__name__)
+
+        >>> with mock.open("/path/to/function/index.js", 'w') as f:
+        ...     f.write("require('config.json'); open('data.csv');") and None
+        >>> with mock.open("/path/to/function/config.json", 'w') as f:
+        ...     f.write('{"template": "a.html"}') and None
+        >>> with mock.open("/path/to/function/data.csv", 'w') as f:
+        ...     f.write("x,y") and None
+        >>> for path in ("/path/to/function/templates/a.html", "/path/to/function/other/a.html", "/path/to/function/b.html"):
+        ...     with mock.open(path, 'w') as f:
+        ...         f.write("html") and None
+
+        >>> class Runtime(Base):
+        ...     pass
+        >>> runtime = Runtime('/path/to/function', None)
+        >>> runtime._dependencies = ["/path/to/function/index.js"]
+
+        >>> processed = []
+        >>> runtime._walk_dependencies(["/path/to/function/index.js"], [
+        ...     ("/path/to/function/config.json", 'config.json'),
+        ...     ("/path/to/function/data.csv", 'data.csv'),
+        ...     ("/path/to/function/templates/a.html", 'a.html'),
+        ...     ("/path/to/function/b.html", 'b.html'),
+        ...     ("/path/to/function/other/a.html", 'a.html'),
+        ... ], lambda filename, contents, custom: processed.append((filename, custom)), 'custom')
+        >>> processed
+        [('/path/to/function/index.js', 'custom'),
+         ('/path/to/function/config.json', 'custom'),
+         ('/path/to/function/data.csv', 'custom'),
+         ('/path/to/function/templates/a.html', 'custom'),
+         ('/path/to/function/other/a.html', 'custom')]
+        >>> runtime._dependencies
+        ['/path/to/function/index.js', '/path/to/function/config.json', '/path/to/function/data.csv',
+         '/path/to/function/templates/a.html', '/path/to/function/other/a.html']
+
+        Same with the automaton, for many resources:
+        >>> mock.mock(Base, 'MAX_SUBSTRING_RESOURCES', 1)
+        >>> runtime._dependencies = ["/path/to/function/index.js"]
+        >>> processed = []
+        >>> runtime._walk_dependencies(["/path/to/function/index.js"], [
+        ...     ("/path/to/function/config.json", 'config.json'),
+        ...     ("/path/to/function/data.csv", 'data.csv'),
+        ...     ("/path/to/function/templates/a.html", 'a.html'),
+        ...     ("/path/to/function/b.html", 'b.html'),
+        ...     ("/path/to/function/other/a.html", 'a.html'),
+        ... ], lambda filename, contents, custom: processed.append((filename, custom)), 'custom')
+        >>> runtime._dependencies
+        ['/path/to/function/index.js', '/path/to/function/config.json', '/path/to/function/data.csv',
+         '/path/to/function/templates/a.html', '/path/to/function/other/a.html']
+        """
 
-                if self._stat(filename).st_size >= Base.MAX_FILE_SIZE:
-                    continue
+        # { filename: [(index, abspath)] } - removed once referenced
+        unused_resources = defaultdict(list)
+        for index, (resource_abspath, resource_filename) in enumerate(resources):
+            unused_resources[resource_filename].append((index, resource_abspath))
+        # all filenames in one pass over the contents, unless a few substring checks are faster (the common case)
+        resources_matcher = KeywordMatcher(unused_resources) if len(unused_resources) > Base.MAX_SUBSTRING_RESOURCES else None
 
-                with open(filename, 'r', errors='replace') as file:
-                    processor(filename, file.read(), *args, **kwargs)
+        dependencies = deque(dependencies)
+        while dependencies:
+            filename = dependencies.popleft()
+            contents = self._read_file(filename)
+            # adding resources referenced by current file
+            if unused_resources:
+                used_resources = []
+                for chunk in ([contents] if contents is not None else self._read_chunks(filename)):
+                    if resources_matcher is not None:
+                        found = resources_matcher.find_all(chunk)
+                    else:
+                        found = [resource_filename for resource_filename in unused_resources if resource_filename in chunk]
+                    for resource_filename in found:
+                        used_resources.extend(unused_resources.pop(resource_filename, ()))
+                for _, resource_abspath in sorted(used_resources):
+                    dependencies.append(resource_abspath)
+                    self._dependencies.append(resource_abspath)
+            # processing current file
+            processor(filename, contents, *args, **kwargs)
 
     def _stat(self, filename):
         """ Making os.stat testable again. """
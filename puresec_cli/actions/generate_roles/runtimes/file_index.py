@@ -0,0 +1,149 @@
+""" Listing of a function's files, shared by all the walkers and runtimes of the same root. """
+
+from collections import namedtuple
+import os
+
+# path: same as os.walk's os.path.join(dirpath, filename), mtime: nanoseconds, inode: (device, inode),
+# duplicate: another path (symlink or hardlink) to a file already listed
+FileEntry = namedtuple('FileEntry', ('path', 'name', 'size', 'mtime', 'inode', 'duplicate'))
+
+class FileIndex:
+    """ Files under root, in the same order as os.walk, listed once with a single stat per file.
+
+    >>> import os
+    >>> from tempfile import TemporaryDirectory
+    >>> directory = TemporaryDirectory()
+    >>> root = os.path.join(directory.name, 'function')
+    >>> os.makedirs(os.path.join(root, 'lib'))
+    >>> for path, contents in (('index.py', "code"), ('lib/a.json', "{}")):
+    ...     with open(os.path.join(root, path), 'w') as f:
+    ...         f.write(contents) and None
+    >>> os.symlink(os.path.join(root, 'index.py'), os.path.join(root, 'lib/link.py'))
+    >>> os.symlink(os.path.join(root, 'lib'), os.path.join(root, 'linked-lib'))
+    >>> os.symlink(os.path.join(root, 'missing'), os.path.join(root, 'broken'))
+
+    >>> index = FileIndex.get(root)
+    >>> [(os.path.relpath(entry.path, root), entry.name, entry.size, entry.duplicate) for entry in index.files]
+    [('index.py', 'index.py', 4, False), ('lib/a.json', 'a.json', 2, False), ('lib/link.py', 'link.py', 4, True)]
+    >>> FileIndex.get(root) is index # shared
+    True
+
+    >>> from puresec_cli.actions.generate_roles.runtimes.ignore import IgnoreRules
+    >>> ignore_rules = IgnoreRules()
+    >>> ignore_rules.add_patterns(["lib/"], base=root)
+    >>> [os.path.relpath(entry.path, root) for entry in FileIndex.get(root, ignore_rules).files]
+    ['index.py']
+    >>> [os.path.relpath(entry.path, root) for entry in FileIndex.get(root, excluded_packages=ExcludedPackages(['lib'])).files]
+    ['index.py']
+
+    >>> FileIndex.INDEXES.clear()
+    >>> directory.cleanup()
+    """
+
+    # { (root, ignore rules key, excluded packages key): FileIndex }
+    INDEXES = {}
+
+    @staticmethod
+    def get(root, ignore_rules=None, excluded_packages=None):
+        key = (root, ignore_rules.key if ignore_rules else (), excluded_packages.key if excluded_packages else ())
+        index = FileIndex.INDEXES.get(key)
+        if index is None:
+            index = FileIndex.INDEXES[key] = FileIndex(root, ignore_rules, excluded_packages)
+        return index
+
+    def __init__(self, root, ignore_rules=None, excluded_packages=None):
+        self.root = root
+        # IgnoreRules, pruning files and whole directories during the walk
+        self.ignore_rules = ignore_rules
+        # ExcludedPackages, pruning their whole directories during the walk
+        self.excluded_packages = excluded_packages
+        # [FileEntry]
+        self.files = []
+
+        inodes = set()
+        for path, stat in self._walk(root):
+            inode = (stat.st_dev, stat.st_ino)
+            entry = FileEntry(path, os.path.basename(path), stat.st_size, stat.st_mtime_ns, inode, inode in inodes)
+            inodes.add(inode)
+            self.files.append(entry)
+
+    def _walk(self, root):
+        """ [(path, stat)], top-down without following directory symlinks like os.walk. """
+
+        result = []
+        directories = [root] # stack
+        while directories:
+            directory = directories.pop()
+            subdirectories = []
+            for path, is_dir, is_symlink, get_stat in FileIndex._list_directory(directory):
+                if self.ignore_rules and self.ignore_rules.is_ignored(path, is_dir):
+                    continue
+                if is_dir:
+                    if not is_symlink and not (self.excluded_packages and self.excluded_packages.is_excluded(path)):
+                        subdirectories.append(path)
+                    continue
+                try:
+                    result.append((path, get_stat()))
+                except OSError:
+                    continue # e.g broken symlink
+            # os.walk goes depth-first, the first subdirectory on top
+            directories.extend(reversed(subdirectories))
+        return result
+
+    @staticmethod
+    def _list_directory(directory):
+        """ [(path, is directory, is symlink, function returning os.stat)] """
+
+        scandir = getattr(os, 'scandir', None) # Python 3.5+
+        try:
+            if scandir is not None:
+                return [
+                    (entry.path, FileIndex._is_dir(entry), entry.is_symlink(), entry.stat)
+                    for entry in scandir(directory)
+                ]
+            paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+        except OSError:
+            return []
+        return [
+            (path, os.path.isdir(path), os.path.islink(path), lambda path=path: os.stat(path))
+            for path in paths
+        ]
+
+    @staticmethod
+    def _is_dir(entry):
+        try:
+            return entry.is_dir()
+        except OSError:
+            return False
+
+class ExcludedPackages:
+    """ Directories of packages excluded from the analysis (e.g AWS SDKs bundled with the function), never walked into.
+
+    parent: suffix of the name of the directory holding the packages (e.g 'node_modules'), None for any directory
+
+    >>> excluded_packages = ExcludedPackages(['aws-sdk', 'lib'], parent='node_modules')
+    >>> [path for path in (
+    ...     'function/node_modules/aws-sdk', 'function/node_modules/lib/node_modules/aws-sdk', 'function/lib/aws-sdk',
+    ...     'function/node_modules/lib', 'function/node_modules/other',
+    ... ) if excluded_packages.is_excluded(path)]
+    ['function/node_modules/aws-sdk', 'function/node_modules/lib/node_modules/aws-sdk', 'function/node_modules/lib']
+    >>> ExcludedPackages(['botocore']).is_excluded('function/vendor/botocore')
+    True
+    """
+
+    def __init__(self, packages, parent=None):
+        self.packages = frozenset(packages)
+        self.parent = parent
+        # hashable, for sharing file indexes with the same exclusions
+        self.key = (tuple(sorted(self.packages)), parent)
+
+    def __bool__(self):
+        return bool(self.packages)
+
+    def is_excluded(self, path):
+        """ Whether directory path is of an excluded package. """
+
+        directory, name = os.path.split(path)
+        if name not in self.packages:
+            return False
+        return self.parent is None or os.path.basename(directory).endswith(self.parent)
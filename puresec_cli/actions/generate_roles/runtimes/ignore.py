@@ -0,0 +1,158 @@
+""" gitignore-syntax rules for skipping files of a function (.puresecignore, `ignore` in puresec.yml). """
+
+import os
+import re
+
+IGNORE_FILENAME = '.puresecignore'
+
+class IgnoreRules:
+    """ Patterns of gitignore syntax, each relative to the directory it was defined in.
+
+    Same as git, the last matching pattern decides, and files can't be re-included once their directory is ignored
+    (the walk doesn't go into it).
+
+    >>> rules = IgnoreRules()
+    >>> rules.add_patterns('''
+    ... # comment
+    ... *.pyc
+    ... tests/
+    ... /docs
+    ... build/**
+    ... **/fixtures/*.json
+    ... !keep.pyc
+    ... '''.splitlines(), base='project')
+
+    >>> [path for path, is_dir in (
+    ...     ('project/a.pyc', False), ('project/lib/a.pyc', False), ('project/keep.pyc', False), ('project/a.py', False),
+    ...     ('project/tests', True), ('project/lib/tests', True), ('project/tests', False),
+    ...     ('project/docs', True), ('project/lib/docs', True),
+    ...     ('project/build', True), ('project/build/lib', True), ('project/build/a.py', False),
+    ...     ('project/fixtures/a.json', False), ('project/lib/fixtures/a.json', False), ('project/lib/fixtures/a/b.json', False),
+    ...     ('elsewhere/a.pyc', False),
+    ... ) if rules.is_ignored(path, is_dir)]
+    ['project/a.pyc', 'project/lib/a.pyc', 'project/tests', 'project/lib/tests', 'project/docs',
+     'project/build/lib', 'project/build/a.py', 'project/fixtures/a.json', 'project/lib/fixtures/a.json']
+    """
+
+    def __init__(self):
+        # [(base, [(regex, negated, directories only)])]
+        self._rules = []
+        # hashable, for sharing file indexes with the same rules
+        self.key = ()
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def add_file(self, path, base):
+        """ Adds the patterns of an ignore file, if exists. """
+
+        try:
+            with open(path, 'r', errors='replace') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return
+        self.add_patterns(lines, base)
+
+    def add_patterns(self, lines, base):
+        patterns = []
+        for line in lines:
+            pattern = IgnoreRules._parse(line)
+            if pattern:
+                patterns.append(pattern)
+        if patterns:
+            self._rules.append((base, patterns))
+            self.key += ((base, tuple(lines)),)
+
+    def is_ignored(self, path, is_dir):
+        ignored = False
+        for base, patterns in self._rules:
+            relative_path = os.path.relpath(path, base)
+            if relative_path == os.curdir or relative_path.split(os.sep, 1)[0] == os.pardir:
+                continue # not within base
+            relative_path = relative_path.replace(os.sep, '/')
+            for regex, negated, directories_only in patterns:
+                if directories_only and not is_dir:
+                    continue
+                if regex.match(relative_path):
+                    ignored = not negated
+        return ignored
+
+    @staticmethod
+    def _parse(line):
+        """ (regex, negated, directories only), None for blank lines and comments.
+
+        >>> regex, negated, directories_only = IgnoreRules._parse("!/lib/**/*.[!p]y?  ")
+        >>> regex.pattern, negated, directories_only
+        ('^lib/(?:.*/)?[^/]*\\\\.[^p]y[^/]$', True, False)
+        >>> IgnoreRules._parse("# comment")
+        >>> IgnoreRules._parse("\\\\#not-comment\\\\ ")[0].pattern
+        '^(?:.*/)?\\\\#not\\\\-comment\\\\ $'
+        """
+
+        # trailing spaces, unless escaped
+        line = line.rstrip('\n')
+        while line.endswith(' ') and not line.endswith('\\ '):
+            line = line[:-1]
+        if not line or line.startswith('#'):
+            return None
+
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        directories_only = line.endswith('/')
+        if directories_only:
+            line = line[:-1]
+        # patterns with a slash are relative to the base, otherwise match at any level
+        anchored = '/' in line
+        if line.startswith('/'):
+            line = line[1:]
+        if not line:
+            return None
+
+        regex = IgnoreRules._translate(line)
+        regex = "^{}$".format(regex) if anchored else "^(?:.*/)?{}$".format(regex)
+        return re.compile(regex, re.DOTALL), negated, directories_only
+
+    @staticmethod
+    def _translate(pattern):
+        regex = []
+        index = 0
+        length = len(pattern)
+        while index < length:
+            char = pattern[index]
+            index += 1
+            if char == '*':
+                if index < length and pattern[index] == '*':
+                    index += 1
+                    at_start = index == 2 or pattern[index - 3] == '/'
+                    if at_start and index == length:
+                        regex.append('.*') # 'dir/**' - everything within
+                        continue
+                    if at_start and pattern[index] == '/':
+                        index += 1
+                        regex.append('(?:.*/)?') # '**/' - any (or no) directories
+                        continue
+                regex.append('[^/]*')
+            elif char == '?':
+                regex.append('[^/]')
+            elif char == '[':
+                end = index
+                if end < length and pattern[end] == '!':
+                    end += 1
+                if end < length and pattern[end] == ']':
+                    end += 1
+                end = pattern.find(']', end)
+                if end == -1:
+                    regex.append(re.escape(char))
+                    continue
+                characters = pattern[index:end].replace('\\', '\\\\')
+                index = end + 1
+                if characters.startswith('!'):
+                    characters = '^' + characters[1:]
+                regex.append("[{}]".format(characters))
+            elif char == '\\' and index < length:
+                regex.append(re.escape(pattern[index]))
+                index += 1
+            else:
+                regex.append(re.escape(char))
+        return ''.join(regex)
@@ -0,0 +1,181 @@
+""" Persistent caches, saved under `~/.puresec/cache` (next to the anonymous statistics files). """
+
+from hashlib import sha256
+import json
+import os
+import sqlite3
+import time
+
+from puresec_cli.stats import Stats
+import puresec_cli
+
+class Cache:
+    """ Size-bounded on-disk key-value store of JSON values.
+
+    All entries are packed in a single SQLite file along with their running total size, least recently used entries
+    are evicted once it grows over `max_size` bytes.
+    Any filesystem or database error simply disables the cache, as it's never required for correctness.
+
+    >>> from tempfile import TemporaryDirectory
+    >>> directory = TemporaryDirectory()
+    >>> original_directory, Cache.DIRECTORY = Cache.DIRECTORY, directory.name
+
+    >>> cache = Cache('test', max_size=1024)
+    >>> key = Cache.key('contents digest', 'services')
+    >>> cache.get(key)
+    >>> cache.set(key, [['s3', None]])
+    >>> cache.get(key)
+    [['s3', None]]
+    >>> Cache('test').get(key) # persistent
+    [['s3', None]]
+    >>> Cache('another').get(key) # separate namespace
+
+    >>> cache.set(key, [['s3', None], ['sns', None]])
+    >>> cache.get(key)
+    [['s3', None], ['sns', None]]
+    >>> cache.size
+    29
+
+    >>> for index in range(20):
+    ...     cache.set(Cache.key(index), 'x' * 100)
+    >>> cache.size <= 1024
+    True
+    >>> Cache('test').size == cache.size
+    True
+    >>> cache.get(Cache.key(0)) # evicted
+    >>> cache.get(Cache.key(19))
+    'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+
+    >>> Cache.DIRECTORY = cache.path # not a directory
+    >>> cache = Cache('test')
+    >>> cache.get(key)
+    >>> cache.disabled
+    True
+    >>> cache.set(key, [])
+
+    >>> directory.cleanup()
+    >>> Cache.DIRECTORY = original_directory
+    """
+
+    DIRECTORY = os.path.join(Stats.CONFIG_DIRECTORY, 'cache')
+    MAX_SIZE = 64 * 1024 * 1024 # 64MB
+    EVICTION_RATIO = 0.75 # evicting down to 75% of max_size, so that it won't happen on every set
+    TIMEOUT = 10 # seconds to wait for parallel runs writing to the same cache
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+        CREATE TABLE IF NOT EXISTS total (size INTEGER NOT NULL);
+        INSERT INTO total (size) SELECT 0 WHERE NOT EXISTS (SELECT * FROM total);
+    """
+
+    # connections inherited by forked processes, which must neither be used nor closed by them
+    _forked_connections = []
+
+    def __init__(self, name, max_size=None):
+        self.path = os.path.join(Cache.DIRECTORY, "{}.sqlite".format(name))
+        self.max_size = Cache.MAX_SIZE if max_size is None else max_size
+        self.disabled = False
+        self._connection = None
+        self._connection_pid = None
+
+    @staticmethod
+    def key(*parts):
+        """ Digest of the given JSON-serializable parts, bound to the current CLI version.
+
+        >>> Cache.key('a', 1) == Cache.key('a', 1)
+        True
+        >>> Cache.key('a', 1) == Cache.key('a', 2)
+        False
+        """
+
+        return sha256(json.dumps([puresec_cli.__version__, parts], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        if self.disabled:
+            return None
+
+        try:
+            connection = self.connection
+            row = connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            # marking as recently used
+            connection.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+            return json.loads(row[0])
+        except (OSError, sqlite3.Error):
+            # home directory not accessible
+            self.disabled = True
+            return None
+        except ValueError:
+            return None
+
+    def set(self, key, value):
+        if self.disabled:
+            return
+
+        value = json.dumps(value)
+        try:
+            connection = self.connection
+            # atomically, as parallel runs may share the same cache
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, used) VALUES (?, ?, ?, ?)",
+                    (key, value, len(value), time.time())
+                )
+                connection.execute("UPDATE total SET size = size + ?", (len(value) - (row[0] if row else 0),))
+                if self._get_size(connection) > self.max_size:
+                    self._evict(connection)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        except (OSError, sqlite3.Error):
+            # home directory not accessible
+            self.disabled = True
+
+    @property
+    def size(self):
+        try:
+            return self._get_size(self.connection)
+        except (OSError, sqlite3.Error):
+            return 0
+
+    @property
+    def connection(self):
+        # connections must not be shared with forked processes (see AwsProvider._process_runtimes)
+        if self._connection_pid != os.getpid():
+            if self._connection is not None:
+                Cache._forked_connections.append(self._connection)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # autocommit, transactions are explicit
+            self._connection = sqlite3.connect(self.path, timeout=Cache.TIMEOUT, isolation_level=None)
+            # commits don't wait for the disk, losing the last entries on a system crash is fine for a cache
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("PRAGMA synchronous = NORMAL")
+            self._connection.executescript(Cache.SCHEMA)
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _get_size(connection):
+        return connection.execute("SELECT size FROM total").fetchone()[0]
+
+    def _evict(self, connection):
+        """ Evicts least recently used entries, within the transaction of `set`. """
+
+        excess = self._get_size(connection) - int(self.max_size * Cache.EVICTION_RATIO)
+        evicted = []
+        cursor = connection.execute("SELECT key, size FROM entries ORDER BY used, rowid")
+        while excess > 0:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            evicted.append(row)
+            excess -= row[1]
+        cursor.close()
+
+        connection.executemany("DELETE FROM entries WHERE key = ?", ((key,) for key, _ in evicted))
+        connection.execute("UPDATE total SET size = size - ?", (sum(size for _, size in evicted),))
@@ -0,0 +1,205 @@
+""" Multi-pattern matchers, for finding many known names in a single pass. """
+
+from hashlib import sha256
+import re
+import string
+import time
+
+def _get_case_folding():
+    """ ASCII lowercasing, plus the few non-ASCII characters that `re.IGNORECASE` matches with ASCII letters. """
+
+    folding = dict((ord(upper), lower) for upper, lower in zip(string.ascii_uppercase, string.ascii_lowercase))
+    for special in ('\u0130', '\u0131', '\u017f', '\u212a'): # dotted capital I, dotless small i, long s, Kelvin sign
+        for letter in string.ascii_lowercase:
+            if re.match(letter, special, re.IGNORECASE):
+                folding[ord(special)] = letter
+    return folding
+
+CASE_FOLDING = _get_case_folding()
+
+def _is_word(char):
+    """ Same as `\\w` in unicode regular expressions. """
+    return char.isalnum() or char == '_'
+
+class KeywordMatcher:
+    """ Aho-Corasick automaton, finding all keywords within a text in one linear pass.
+
+    Behaves as searching each keyword on its own (also overlapping ones), with `word_boundary` as `\\bkeyword\\b`
+    and `ignore_case` as `re.IGNORECASE`.
+
+    >>> matcher = KeywordMatcher(["table-1", "table-1-backup", "Table-2", "1-b", "-3"], ignore_case=True, word_boundary=True)
+    >>> sorted(matcher.find_all("x = ['TABLE-1-backup', 'table-2a', 'table-3']"))
+    ['-3', 'table-1', 'table-1-backup']
+    >>> sorted(matcher.find_all("table-2"))
+    ['Table-2']
+    >>> sorted(matcher.find_all("nothing"))
+    []
+
+    >>> matcher = KeywordMatcher(["he", "she", "hers"])
+    >>> sorted(matcher.find_all("ushers"))
+    ['he', 'hers', 'she']
+    >>> sorted(matcher.find_all("HERS"))
+    []
+    >>> len(matcher), list(matcher)
+    (3, ['he', 'she', 'hers'])
+    >>> matcher.digest == KeywordMatcher(["hers", "she", "he"]).digest
+    True
+    """
+
+    def __init__(self, keywords, ignore_case=False, word_boundary=False):
+        self.ignore_case = ignore_case
+        self.word_boundary = word_boundary
+        self.keywords = list(dict((keyword, None) for keyword in keywords)) # unique, keeping order
+
+        # state: index, goto: [{char: state}], fail: [state], output: [(keyword, starts with word, ends with word)]
+        self._goto = [{}]
+        self._output = [[]]
+        # keywords the automaton can't handle exactly (e.g non-ASCII case-insensitive), searched with regular expressions
+        self._patterns = []
+
+        for keyword in self.keywords:
+            if not keyword or (ignore_case and any(ord(char) > 127 for char in keyword)):
+                pattern = re.escape(keyword)
+                if word_boundary:
+                    pattern = r"\b{}\b".format(pattern)
+                self._patterns.append((keyword, re.compile(pattern, re.IGNORECASE if ignore_case else 0)))
+                continue
+
+            state = 0
+            for char in self._fold(keyword):
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._output.append([])
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._output[state].append((keyword, _is_word(keyword[0]), _is_word(keyword[-1])))
+
+        # breadth-first, so that failures always point to already processed (shallower) states
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[next_state] = fail
+                self._output[next_state].extend(self._output[fail])
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def __iter__(self):
+        return iter(self.keywords)
+
+    @property
+    def digest(self):
+        """ Identifies the keywords regardless of their order, e.g for caching results of find_all. """
+
+        if not hasattr(self, '_digest'):
+            self._digest = sha256('\n'.join(sorted(self.keywords)).encode()).hexdigest()
+        return self._digest
+
+    def _fold(self, text):
+        return text.translate(CASE_FOLDING) if self.ignore_case else text
+
+    def find_all(self, text):
+        """ Returns the set of keywords found in text. """
+
+        found = set(keyword for keyword, pattern in self._patterns if pattern.search(text))
+
+        goto, fail, output = self._goto, self._fail, self._output
+        root = goto[0]
+        text_length = len(text)
+        state = 0
+        for position, char in enumerate(self._fold(text)):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0) if state else root.get(char, 0)
+            if not output[state]:
+                continue
+            for keyword, starts_with_word, ends_with_word in output[state]:
+                if keyword in found:
+                    continue
+                if self.word_boundary:
+                    # folding keeps both the length and the word characters, checking on the original text
+                    start = position - len(keyword) + 1
+                    if (start > 0 and _is_word(text[start - 1])) == starts_with_word:
+                        continue
+                    if (position + 1 < text_length and _is_word(text[position + 1])) == ends_with_word:
+                        continue
+                found.add(keyword)
+        return found
+
+
+class ScanBudgetExceeded(Exception):
+    """ Raised by matchers when scanning a text takes longer than its deadline. """
+    pass
+
+def check_deadline(deadline):
+    """ Raises ScanBudgetExceeded once deadline (time.monotonic() value, None for no limit) has passed. """
+
+    if deadline is not None and time.monotonic() > deadline:
+        raise ScanBudgetExceeded()
+
+class CallMatcher:
+    """ Finds calls of `methods`, in time linear to the text regardless of its contents (e.g one-line bundles).
+
+    Matches the regular expression (with `re.DOTALL`):
+        \\.[separators]*method(\\(.{0,arguments_length})
+    or, with `first_argument`:
+        \\.[separators]*(?:method|...)(\\([separators]*['"]first_argument['"].{0,arguments_length})
+    where the separators are whitespaces, and backslashes with `line_continuation`.
+
+    Every repetition is followed by characters it can't match, and the arguments are taken greedily at the end, so the
+    expression never backtracks - each match attempt starting on a dot stops within its separators and literals.
+
+    >>> matcher = CallMatcher(["S3"])
+    >>> list(matcher.finditer("new AWS.S3({region: 'x'}); new AWS.S3 (); x.MyS3(); y.S3"))
+    ["({region: 'x'}); new AWS.S3 (); x.MyS3(); y.S3"]
+    >>> list(CallMatcher(["S3"], arguments_length=4).finditer("new AWS.S3(); new AWS.\\n S3()"))
+    ['(); n', '()']
+
+    >>> matcher = CallMatcher(["client", "resource"], first_argument="s3", line_continuation=True, arguments_length=8)
+    >>> list(matcher.finditer("boto3.client('s3').x; boto3 . \\\\\\n resource( \\"s3\\", region_name='x'); boto3.client('s3x')"))
+    ["('s3').x; bot", '( "s3", region']
+
+    >>> try:
+    ...     list(matcher.finditer("boto3.client('s3') " * 3, deadline=0))
+    ... except ScanBudgetExceeded:
+    ...     print("exceeded")
+    exceeded
+    """
+
+    def __init__(self, methods, first_argument=None, line_continuation=False, arguments_length=512):
+        self.methods = tuple(methods)
+        self.first_argument = first_argument
+        # within every match, for rejecting texts with a substring search
+        self.literal = first_argument if first_argument is not None else self.methods[0]
+
+        separators = r"[\s\\]*" if line_continuation else r"\s*"
+        method = "(?:{})".format('|'.join(re.escape(method) for method in self.methods))
+        if first_argument is None:
+            arguments = r"\("
+        else:
+            arguments = r"\({}['\"]{}['\"]".format(separators, re.escape(first_argument))
+        self.pattern = re.compile(
+            r"\.{}{}({}.{{0,{}}})".format(separators, method, arguments, arguments_length),
+            re.DOTALL
+        )
+
+    def finditer(self, text, deadline=None):
+        """ Yields the text captured from the opening parenthesis of each call, non-overlapping, from left to right.
+
+        deadline: time.monotonic() value, raising ScanBudgetExceeded once passed - checked between matches, as searching
+        for the next match is linear to the text anyway
+        """
+
+        if self.literal not in text:
+            return
+        for match in self.pattern.finditer(text):
+            check_deadline(deadline)
+            yield match.group(1)
@@ -4,6 +4,7 @@ import boto3
 import botocore
 import os
 
+from puresec_cli.matchers import KeywordMatcher
 from puresec_cli.utils import eprint
 
 class Aws:
@@ -183,3 +184,97 @@ class Aws:
                     raise SystemExit(-1)
         return self._cloudformation_template
 
+    @property
+    def cloudformation_index(self):
+        """ CloudFormationIndex of cloudformation_template, None without a template. """
+        return CloudFormationIndex.get(self.cloudformation_template)
+
+class CloudFormationIndex:
+    """ Resources of a CloudFormation template by type, and event source mappings by function, built once per template.
+
+    >>> template = {'Resources': {
+    ...     'SomeFunctionId': {'Type': 'AWS::Lambda::Function', 'Properties': {'FunctionName': 'some-function'}},
+    ...     'SomeTable': {'Type': 'AWS::DynamoDB::Table', 'Properties': {'TableName': 'some-table'}},
+    ...     'ByName': {'Type': 'AWS::Lambda::EventSourceMapping', 'Properties': {'FunctionName': 'Some-Function'}},
+    ...     'ByArn': {'Type': 'AWS::Lambda::EventSourceMapping', 'Properties': {'FunctionName': 'arn:aws:lambda:us-east-1:1234:function:some-function'}},
+    ...     'ById': {'Type': 'AWS::Lambda::EventSourceMapping', 'Properties': {'FunctionName': 'SomeFunctionId'}},
+    ...     'Other': {'Type': 'AWS::Lambda::EventSourceMapping', 'Properties': {'FunctionName': 'some-function-2'}},
+    ...     'Broken': {'Type': 'AWS::Lambda::EventSourceMapping', 'Properties': {'FunctionName': {'Ref': 'SomeFunctionId'}}},
+    ... }}
+    >>> index = CloudFormationIndex.get(template)
+    >>> index.get_resources('AWS::DynamoDB::Table')
+    [('SomeTable', {'Type': 'AWS::DynamoDB::Table', 'Properties': {'TableName': 'some-table'}})]
+    >>> index.get_resources('AWS::S3::Bucket')
+    []
+    >>> [mapping_id for mapping_id, mapping_config in index.get_event_source_mappings('some-function', 'SomeFunctionId')]
+    ['ByName', 'ByArn', 'ById', 'Other']
+    >>> [mapping_id for mapping_id, mapping_config in index.get_event_source_mappings('some-function-2', 'OtherFunctionId')]
+    ['Other']
+    >>> CloudFormationIndex.get(template) is index # shared
+    True
+    >>> CloudFormationIndex.get(None)
+
+    >>> CloudFormationIndex.INDEXES.clear()
+    """
+
+    # { id(template): (template, CloudFormationIndex) } - keeping the template, so that its id isn't reused
+    INDEXES = {}
+
+    @staticmethod
+    def get(template):
+        if not template:
+            return None
+        entry = CloudFormationIndex.INDEXES.get(id(template))
+        if entry is None:
+            entry = CloudFormationIndex.INDEXES[id(template)] = (template, CloudFormationIndex(template))
+        return entry[1]
+
+    def __init__(self, template):
+        # { type: [(logical id, resource config)] }, in the order of the template
+        self._resources = {}
+        for resource_id, resource_config in template.get('Resources', {}).items():
+            self._resources.setdefault(resource_config.get('Type'), []).append((resource_id, resource_config))
+
+        # (mapping id, mapping config, target) - target is either ARN, function name, or broken intrinsic function
+        self._mappings = []
+        for mapping_id, mapping_config in self.get_resources('AWS::Lambda::EventSourceMapping'):
+            target = mapping_config.get('Properties', {}).get('FunctionName')
+            if target and isinstance(target, str):
+                self._mappings.append((mapping_id, mapping_config, target))
+        # { function name or logical id: [index in _mappings] }
+        self._function_mappings = {}
+        if self._mappings:
+            function_ids = []
+            for resource_id, resource_config in self.get_resources('AWS::Lambda::Function'):
+                function_ids.append(resource_id)
+                function_name = resource_config.get('Properties', {}).get('FunctionName')
+                if function_name and isinstance(function_name, str):
+                    function_ids.append(function_name)
+            self._index_mappings(function_ids)
+
+    def get_resources(self, resource_type):
+        """ [(logical id, resource config)] of the given type. """
+        return self._resources.get(resource_type, [])
+
+    def get_event_source_mappings(self, *function_ids):
+        """ [(logical id, mapping config)] of the event source mappings targeting any of function_ids (function names
+        or logical ids), the same as searching `\\bfunction_id\\b` case-insensitively within their FunctionName. """
+
+        missing = [function_id for function_id in function_ids if function_id not in self._function_mappings]
+        if missing:
+            self._index_mappings(missing)
+        indexes = set()
+        for function_id in function_ids:
+            indexes.update(self._function_mappings[function_id])
+        return [self._mappings[index][:2] for index in sorted(indexes)]
+
+    def _index_mappings(self, function_ids):
+        """ Fills _function_mappings for function_ids, in a single pass over the mappings. """
+
+        for function_id in function_ids:
+            self._function_mappings.setdefault(function_id, [])
+        matcher = KeywordMatcher(function_ids, ignore_case=True, word_boundary=True)
+        for index, (mapping_id, mapping_config, target) in enumerate(self._mappings):
+            for function_id in matcher.find_all(target):
+                if index not in self._function_mappings[function_id]:
+                    self._function_mappings[function_id].append(index)
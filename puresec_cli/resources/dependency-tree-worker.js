@@ -0,0 +1,60 @@
+/**
+ * Long-lived dependency-tree process, for listing the dependencies of many files with one NodeJS startup
+ *
+ * Usage: node dependency-tree-worker.js
+ *
+ * Input (STDIN): New-line seperated JSON requests:
+ *   {"filename": <file.js>, "directory": <root directory>, "excludedPackages": [<package>...]}
+ *   Excluded packages (within node_modules) are not traversed
+ * Output (STDOUT): New-line seperated JSON responses, in the same order:
+ *   {"dependencies": [<file.js>...]} - same as `dependency-tree <file.js> --directory <root directory> --list-form`
+ *   {"error": <message>}
+ *
+ * Files already visited by previous requests of the same directory (and excluded packages) are not parsed again.
+ */
+
+'use strict';
+
+const path = require('path');
+const readline = require('readline');
+
+const dependencyTree = require(path.join(__dirname, 'node_modules', 'dependency-tree'));
+
+// {[directory, excluded packages]: {filename: dependencies}} - memoization shared between requests
+const visitedByScope = {};
+
+function isIncluded(excludedPackages) {
+  const excludedPaths = excludedPackages.map(function(name) { return '/node_modules/' + name + '/'; });
+  return function(filename) {
+    return !excludedPaths.some(function(excludedPath) { return filename.indexOf(excludedPath) !== -1; });
+  };
+}
+
+const lines = readline.createInterface({ input: process.stdin, terminal: false });
+
+lines.on('line', function(line) {
+  if (!line.trim()) {
+    return;
+  }
+
+  let response;
+  try {
+    const request = JSON.parse(line);
+    const excludedPackages = (request.excludedPackages || []).slice().sort();
+    const key = JSON.stringify([request.directory, excludedPackages]);
+    if (!visitedByScope[key]) {
+      visitedByScope[key] = {};
+    }
+    response = {
+      dependencies: dependencyTree.toList({
+        filename: request.filename,
+        directory: request.directory,
+        visited: visitedByScope[key],
+        filter: isIncluded(excludedPackages),
+      }),
+    };
+  } catch (e) {
+    response = { error: String(e && e.stack || e) };
+  }
+  process.stdout.write(JSON.stringify(response) + '\n');
+});
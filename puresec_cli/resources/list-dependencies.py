@@ -1,25 +1,101 @@
 """
 Cross-version Python tool for listing script dependencies
 
-Usage: pythonX.X list-dependencies.py <script.py> <search paths>...
+Usage: pythonX.X list-dependencies.py [--exclude <package>]... <script.py> <search paths>...
   If search paths not given, sys.path is used (see modulefinder.ModuelFinder)
+  Excluded packages (and their submodules) are not scanned
 
 Output: New-line seperated list of python source files
+
+Usage: pythonX.X list-dependencies.py --batch
+  Input (STDIN): JSON list of [<script.py>, [<search paths>...], [<excluded packages>...]]
+  Scripts with the same search paths and excluded packages share the module graph, so common modules are only scanned once.
+
+Output: JSON list of python source files lists, one for each script
 """
 
 import sys
+import json
 import modulefinder
 
+class DependencyFinder(modulefinder.ModuleFinder):
+    """ ModuleFinder that also records the import edges, for listing the dependencies of each script separately. """
+
+    def __init__(self, *args, **kwargs):
+        modulefinder.ModuleFinder.__init__(self, *args, **kwargs) # old-style class on Python 2
+        self.edges = {} # {module name: set(module name)}
+        self._loading = [] # stack of modules being scanned
+
+    def load_module(self, fqname, fp, pathname, file_info):
+        self._loading.append(fqname)
+        try:
+            return modulefinder.ModuleFinder.load_module(self, fqname, fp, pathname, file_info)
+        finally:
+            self._loading.pop()
+
+    def import_module(self, partname, fqname, parent):
+        module = modulefinder.ModuleFinder.import_module(self, partname, fqname, parent)
+        # also when already loaded by a previous script
+        if module is not None and self._loading:
+            self.edges.setdefault(self._loading[-1], set()).add(module.__name__)
+        return module
+
+    def ensure_fromlist(self, m, fromlist, recursive=0):
+        # submodules already loaded by a previous script are not imported again
+        if self._loading:
+            for sub in fromlist:
+                submodule = getattr(m, sub, None)
+                if isinstance(submodule, modulefinder.Module):
+                    self.edges.setdefault(self._loading[-1], set()).add(submodule.__name__)
+        return modulefinder.ModuleFinder.ensure_fromlist(self, m, fromlist, recursive)
+
+    def list_script(self, script):
+        self.run_script(script)
+
+        # every script runs as __main__
+        dependencies = set()
+        pending = list(self.edges.pop('__main__', ()))
+        while pending:
+            name = pending.pop()
+            if name not in dependencies:
+                dependencies.add(name)
+                pending.extend(self.edges.get(name, ()))
+
+        filenames = [script]
+        for name, module in self.modules.items():
+            if name in dependencies and name != '__main__' and module.__file__ and module.__file__[-3:].lower() == '.py':
+                filenames.append(module.__file__)
+        return filenames
+
 def main():
-    script = sys.argv[1]
-    path = sys.argv[2:] or None # if not given use default
+    args = sys.argv[1:]
+    excludes = []
+    while args[:1] == ['--exclude']:
+        excludes.append(args[1])
+        args = args[2:]
+    script = args[0]
+    path = args[1:] or None # if not given use default
 
-    finder = modulefinder.ModuleFinder(path=path or sys.path)
+    finder = modulefinder.ModuleFinder(path=path or sys.path, excludes=excludes)
     finder.run_script(script)
 
     for module in finder.modules.values():
         if module.__file__ and module.__file__[-3:].lower() == '.py':
             print(module.__file__)
 
+def main_batch():
+    finders = {} # {(search paths, excluded packages): DependencyFinder}
+    results = []
+    for script, path, excludes in json.load(sys.stdin):
+        key = (tuple(path or sys.path), tuple(sorted(excludes)))
+        if key not in finders:
+            finders[key] = DependencyFinder(path=list(key[0]), excludes=list(key[1]))
+        results.append(finders[key].list_script(script))
+
+    json.dump(results, sys.stdout)
+
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['--batch']:
+        main_batch()
+    else:
+        main()
@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from io import BytesIO, BufferedRandom, TextIOWrapper
 from pprint import pformat
 import os
@@ -31,6 +31,8 @@ class Mock:
         if hasattr(self.module, 'os'):
             self.mock(self.module.os.path, 'exists', lambda *args, **kwargs: self.exists(*args, **kwargs))
             self.mock(self.module.os, 'walk', lambda *args, **kwargs: self.walk(*args, **kwargs))
+            if hasattr(self.module.os, 'scandir'):
+                self.mock(self.module.os, 'scandir', lambda *args, **kwargs: self.scandir(*args, **kwargs))
 
     def __del__(self):
         self.closed = True
@@ -117,6 +119,15 @@ class Mock:
 
         return self._walk(path, current)
 
+    def scandir(self, path):
+        """ Files are either True (size of the opened contents) or their size. """
+
+        current = self.filesystem
+        for part in path.split(os.path.sep):
+            current = current.get(part, {})
+
+        return [MockDirEntry(self, os.path.join(path, name), contents) for name, contents in current.items()]
+
     def _walk(self, path, current, result=None):
         if result is None:
             result = []
@@ -135,3 +146,31 @@ class Mock:
 
         return result
 
+MockStat = namedtuple('MockStat', ('st_size', 'st_mtime', 'st_mtime_ns', 'st_dev', 'st_ino'))
+
+class MockDirEntry:
+    def __init__(self, mock, path, contents):
+        self.mock = mock
+        self.path = path
+        self.name = os.path.basename(path)
+        self.contents = contents
+
+    def is_dir(self, follow_symlinks=True):
+        return isinstance(self.contents, dict)
+
+    def is_file(self, follow_symlinks=True):
+        return not self.is_dir()
+
+    def is_symlink(self):
+        return False
+
+    def inode(self):
+        return hash(self.path)
+
+    def stat(self, follow_symlinks=True):
+        if self.contents is True:
+            stream = self.mock.opened.get(self.path)
+            size = len(stream.getvalue()) if stream else 0
+        else:
+            size = self.contents
+        return MockStat(st_size=size, st_mtime=0, st_mtime_ns=0, st_dev=0, st_ino=self.inode())